@@ -2,9 +2,9 @@
 """
 Created on Thu Oct 10 11:26:49 2019
 
-Functions (above) and script that calls functions (below) to get data for a 
-selected event from an input Antelope database and write to a Hypoinverse-
-compatible file
+Functions to get data for selected events from an input Antelope database 
+and write them to Hypoinverse-compatible files, with a command line interface
+(see main, or run with --help)
 
 Antelope tables are in a slightly modified version of CSS (Center for Seismic
 Studies) scehma
@@ -13,410 +13,2534 @@ Assumes Antelope database tables are stored in the following way for database
 named AntDB as an example:
 
 workingdirectory/AntDB - name of directory where tables are stored
-tables have names AntDB.origin, AntDB.arrival, etc.
+tables have names AntDB.origin, AntDB.arrival, etc. and may be compressed
+(AntDB.arrival.gz, .bz2, .xz or .zst, the last needs the zstandard package)
 
-Check the output after running to see if data was not written to the
-output file because of length issues; this script will not write data to 
-the file if it's the wrong length, but it will run and output the data that
-could not be written to the command line
+Check the log after running to see if data was not written to the output 
+file because of length issues; this script will not write data to the file 
+if it's the wrong length, but it will run and log the data that could not be
+written (logger "Antelope2HypoInverse", warnings go to standard error unless 
+logging is configured otherwise). Counts and timings of a run can be 
+collected with collectMetrics
 
 @author: Rachel
 """
-import pandas as pd
+import array
+import ast
+import bisect
+import contextlib
+import functools
+import hashlib
+import importlib
+import io
+import json
+import logging
+import math
+import mmap
+import multiprocessing
+import os
+import pickle
+import re
+import sys
+import tempfile
 import time
-import numpy as np
+import weakref
+import zipfile
 
-def getData(eventid, dbid, dbfoldername):
-    print('Fetching data for event ' + str(eventid)+'\n')    
+class _LazyModule(object):
+    #Stand-in for a module that is imported the first time one of its 
+    #attributes is used; the module then replaces the stand-in in the 
+    #globals of this module. pandas and numpy are loaded this way so the 
+    #command line and the single event path (see eventLines) start without
+    #them
+    
+    def __init__(self, name, alias):
+        self._name = name
+        self._alias = alias
+    
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)
+        globals()[self._alias] = module
+        return getattr(module, attr)
+
+pd = _LazyModule('pandas', 'pd')
+np = _LazyModule('numpy', 'np')
+
+logger = logging.getLogger('Antelope2HypoInverse')
+
+class Metrics(object):
+    #Instrumentation of a conversion, collected while a Metrics object is 
+    #active (see collectMetrics):
+    #  stages    - calls and wall time of each stage (parse, index, join, 
+    #              format, write, stations); stages may nest, e.g. tables 
+    #              first needed during a join are parsed inside it
+    #  tablerows - rows read from each table
+    #  mergerows - rows of the joined data after each merge, by table joined
+    #  counters  - events and lines formatted and written
+    #  skipped   - picks and station lines not written, by reason
+    #  rejected  - fields that could not be written at their width, by field
+    #Events formatted in worker processes (convertCatalog workers > 1) are 
+    #counted as written but their formatting is not timed or counted
+    
+    def __init__(self):
+        self.stages = {} #stage -> [calls, seconds]
+        self.tablerows = {}
+        self.mergerows = {}
+        self.counters = {}
+        self.skipped = {}
+        self.rejected = {}
+    
+    @contextlib.contextmanager
+    def stage(self, name):
+        #time a stage
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            calls, seconds = self.stages.get(name, (0, 0.0))
+            self.stages[name] = [calls + 1, 
+                                 seconds + time.perf_counter() - started]
+    
+    def count(self, kind, name, n=1):
+        #add n to counter name of kind (tablerows, mergerows, counters, 
+        #skipped or rejected)
+        counts = getattr(self, kind)
+        counts[name] = counts.get(name, 0) + int(n)
+    
+    def report(self):
+        #all metrics as a dict of plain values
+        return {'stages': {name: {'calls': calls, 'seconds': round(seconds, 6)}
+                           for name, (calls, seconds) in self.stages.items()},
+                'rows_read': dict(self.tablerows),
+                'rows_after_merge': dict(self.mergerows),
+                'counters': dict(self.counters),
+                'skipped': dict(self.skipped),
+                'rejected_fields': dict(self.rejected)}
+    
+    def toJson(self, path=None):
+        #metrics report as a JSON string, also written to path if given
+        text = json.dumps(self.report(), indent=2)
+        if path is not None:
+            with open(path, 'w') as jsonfile:
+                jsonfile.write(text + '\n')
+        return text
+
+_metrics = None #active Metrics object, None when not collecting
+
+@contextlib.contextmanager
+def collectMetrics(metrics=None):
+    #context manager collecting metrics of everything run inside it, e.g.
+    #  with collectMetrics() as metrics:
+    #      convertCatalog(...)
+    #  print(metrics.toJson())
+    global _metrics
+    previous = _metrics
+    _metrics = Metrics() if metrics is None else metrics
+    try:
+        yield _metrics
+    finally:
+        _metrics = previous
+
+def _stage(name):
+    #stage timer of the active Metrics, a no-op when not collecting
+    if _metrics is None:
+        return contextlib.nullcontext()
+    return _metrics.stage(name)
+
+def _count(kind, name, n=1):
+    #add to a counter of the active Metrics, if any
+    if _metrics is not None and n:
+        _metrics.count(kind, name, n)
+
+#CSS3.0/Antelope schema of each table read by the functions below: fields in
+#record order as (name, width, type) where type is 'i' integer, 'f' float,
+#'s' string or 'c' string stored as a categorical (station/channel codes).
+#Fields are separated by one space, so the offset of a field is the sum of 
+#the widths of the fields before it plus one per field
+TABLE_SCHEMA = {
+    'event': [('evid',8,'i'),('evname',15,'s'),('prefor',8,'i'),
+              ('auth',15,'s'),('commid',8,'i'),('lddate',17,'f')],
+    'origin': [('lat',9,'f'),('lon',9,'f'),('depth',9,'f'),('time',17,'f'),
+               ('orid',8,'i'),('evid',8,'i'),('jdate',8,'i'),('nass',4,'i'),
+               ('ndef',4,'i'),('ndp',4,'i'),('grn',8,'i'),('srn',8,'i'),
+               ('etype',7,'s'),('review',4,'s'),('depdp',9,'f'),
+               ('dtype',1,'s'),('mb',7,'f'),('mbid',8,'i'),('ms',7,'f'),
+               ('msid',8,'i'),('ml',7,'f'),('mlid',8,'i'),
+               ('algorithm',15,'s'),('auth',15,'s'),('commid',8,'i'),
+               ('lddate',17,'f')],
+    'assoc': [('arid',8,'i'),('orid',8,'i'),('sta',6,'c'),('phase',8,'s'),
+              ('belief',4,'f'),('delta',8,'f'),('seaz',7,'f'),('esaz',7,'f'),
+              ('timeres',8,'f'),('timedef',1,'s'),('azres',7,'f'),
+              ('azdef',1,'s'),('slores',7,'f'),('slodef',1,'s'),
+              ('emares',7,'f'),('wgt',6,'f'),('vmodel',15,'s'),
+              ('commid',8,'i'),('lddate',17,'f')],
+    'arrival': [('sta',6,'c'),('time',17,'f'),('arid',8,'i'),('jdate',8,'i'),
+                ('stassid',8,'i'),('chanid',8,'i'),('chan',8,'c'),
+                ('iphase',8,'s'),('stype',1,'s'),('detim',6,'f'),
+                ('azimuth',7,'f'),('delaz',7,'f'),('slow',7,'f'),
+                ('delslo',7,'f'),('ema',7,'f'),('rect',7,'f'),('amp',10,'f'),
+                ('per',7,'f'),('logat',7,'f'),('clip',1,'s'),('fm',2,'s'),
+                ('snr',10,'f'),('qual',1,'s'),('auth',15,'s'),
+                ('commid',8,'i'),('lddate',17,'f')],
+    'snetsta': [('net',8,'c'),('sta',6,'c'),('staid',6,'c'),
+                ('lddate',17,'f')],
+    'site': [('sta',6,'c'),('ondate',8,'i'),('offdate',8,'i'),('lat',9,'f'),
+             ('lon',9,'f'),('elev',9,'f'),('staname',50,'s'),
+             ('statype',4,'s'),('refsta',6,'s'),('dnorth',9,'f'),
+             ('deast',9,'f'),('lddate',17,'f')],
+    'sitechan': [('sta',6,'c'),('chan',8,'c'),('ondate',8,'i'),
+                 ('chanid',8,'i'),('offdate',8,'i'),('ctype',4,'s'),
+                 ('edepth',9,'f'),('hang',6,'f'),('vang',6,'f'),
+                 ('descrip',50,'s'),('lddate',17,'f')],
+    'sensor': [('sta',6,'c'),('chan',8,'c'),('time',17,'f'),
+               ('endtime',17,'f'),('inid',8,'i'),('chanid',8,'i'),
+               ('jdate',8,'i'),('calratio',16,'f'),('calper',16,'f'),
+               ('tshift',6,'f'),('instant',1,'s'),('lddate',17,'f')],
+    'instrument': [('inid',8,'i'),('insname',50,'s'),('instype',6,'s'),
+                   ('band',1,'s'),('digital',1,'s'),('samprate',11,'f'),
+                   ('ncalib',16,'f'),('ncalper',16,'f'),('dir',64,'s'),
+                   ('dfile',32,'s'),('rsptype',6,'s'),('lddate',17,'f')],
+    }
+
+#column names for each table, in record order
+TABLE_COLUMNS = {table: [name for name, width, ftype in fields]
+                 for table, fields in TABLE_SCHEMA.items()}
+
+#columns loaded by default, i.e. those used by the conversion; unused ones
+#such as commid, slores or azres are skipped when parsing
+TABLE_USECOLS = {
+    'event': ['evid','prefor','auth','lddate'],
+    'origin': ['lat','lon','depth','time','orid','evid','jdate','nass','ndef',
+               'etype','algorithm','auth','lddate'],
+    'assoc': ['arid','orid','sta','phase','delta','esaz','timeres','wgt',
+              'lddate'],
+    'arrival': ['sta','time','arid','jdate','chanid','chan','iphase','fm',
+                'auth','lddate'],
+    'snetsta': ['net','sta','staid','lddate'],
+    'site': ['sta','ondate','offdate','lat','lon','elev'],
+    'sitechan': ['sta','chan','ondate','chanid','offdate'],
+    'sensor': ['sta','chan','time','endtime','inid','chanid','jdate'],
+    'instrument': ['inid','insname','ncalib'],
+    }
+
+#compressed table files (suffix, module that reads them), looked for when a
+#table has no plain text file; they are decompressed as they are read
+TABLE_COMPRESSION = [('.gz', 'gzip'), ('.bz2', 'bz2'), ('.xz', 'lzma'),
+                     ('.zst', 'zstandard')]
+
+def findTable(path):
+    #file holding the table at path: path itself if it exists, otherwise
+    #the first compressed variant found (e.g. path.gz), otherwise path
+    if os.path.exists(path):
+        return path
+    for suffix, module in TABLE_COMPRESSION:
+        if os.path.exists(path + suffix):
+            return path + suffix
+    return path
+
+def tableCompression(path):
+    #module that decompresses the table file at path, None if it is plain
+    for suffix, module in TABLE_COMPRESSION:
+        if path.endswith(suffix):
+            return module
+    return None
+
+def openTable(path):
+    #open the table file at path for reading bytes, decompressing it on 
+    #the fly if it is compressed (see TABLE_COMPRESSION); zstd tables need 
+    #the optional zstandard package
+    module = tableCompression(path)
+    if module is None:
+        return open(path, 'rb')
+    if module != 'zstandard':
+        return importlib.import_module(module).open(path, 'rb')
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError('Table '+path+' is zstd compressed, install the '+\
+        'zstandard package to read it')
+    reader = zstandard.ZstdDecompressor().stream_reader(
+        open(path, 'rb'), read_across_frames=True, closefd=True)
+    return io.BufferedReader(reader)
+
+def tableSize(path):
+    #size in bytes of the text of the table file at path. Compressed files
+    #do not record it reliably (gzip keeps it modulo 4 GB, bz2 not at all)
+    #so they are decompressed and counted in blocks
+    if tableCompression(path) is None:
+        return os.path.getsize(path)
+    size = 0
+    with openTable(path) as tablefile:
+        while True:
+            block = tablefile.read(1 << 24)
+            if not block:
+                return size
+            size += len(block)
+
+def recordLength(table):
+    #length of one record of table, not counting the newline
+    fields = TABLE_SCHEMA[table]
+    return sum(width for name, width, ftype in fields) + len(fields) - 1
+
+def _typedColumn(values, ftype):
+    #convert an array of fixed-width byte strings to the schema type
+    if ftype == 'i':
+        return values.astype('int64')
+    if ftype == 'f':
+        return values.astype('float64')
+    values = np.char.strip(values).astype(str)
+    if ftype == 'c':
+        return pd.Categorical(values)
+    return values.astype(object)
+
+def parseRecords(data, table, columns=None):
+    #function parses the bytes data holding whole records of table into a
+    #dataframe of the given columns (default TABLE_USECOLS[table]) using the
+    #fixed field offsets of TABLE_SCHEMA. Returns None if the records do not
+    #have the schema record length, the single space between fields or 
+    #values of the field types, e.g. for tables split on white space
+    if columns is None:
+        columns = TABLE_USECOLS[table]
+    reclen = recordLength(table)
+    
+    nrecords = -(-len(data)//(reclen + 1))
+    if len(data) - nrecords*(reclen + 1) in (0, -1):
+        #every record may be exactly reclen long (last newline optional), 
+        #view the buffer as a 2D array without splitting it into lines
+        records = np.frombuffer(data + b'\n'*(len(data) % (reclen + 1) != 0),
+                                dtype=np.uint8).reshape(nrecords, reclen + 1)
+        if not (records[:, -1] == 10).all():
+            records = None
+    else:
+        records = None
+    
+    if records is None:
+        #tolerate stripped trailing white space and CRLF line ends, reject 
+        #records that are longer than the schema
+        lines = [line.rstrip(b'\r') for line in data.split(b'\n')]
+        if len(lines) > 0 and lines[-1] == b'':
+            lines = lines[:-1]
+        if any(len(line) > reclen for line in lines):
+            return None
+        records = np.frombuffer(b''.join(line.ljust(reclen) 
+                                         for line in lines), 
+                                dtype=np.uint8).reshape(len(lines), reclen)
+    
+    widths = [width for name, width, ftype in TABLE_SCHEMA[table]]
+    separators = np.cumsum(np.array(widths[:-1]) + 1) - 1
+    if not (records[:, separators] == ord(' ')).all():
+        return None
+    
+    fields = {}
+    start = 0
+    for name, width, ftype in TABLE_SCHEMA[table]:
+        if name in columns:
+            values = np.ascontiguousarray(records[:, start:start + width])
+            values = values.view('S' + str(width)).ravel()
+            try:
+                fields[name] = _typedColumn(values, ftype)
+            except ValueError:
+                return None
+        start += width + 1
+    return pd.DataFrame({name: fields[name] for name in columns})
+
+def _readTableText(data, table, columns):
+    #fallback for tables that do not follow the fixed record layout: split 
+    #the bytes data on white space (or infer fixed width columns for tables
+    #with free-text fields) and convert the columns to the schema types
+    if table in ['site','sensor','instrument']:
+        tbl = pd.read_fwf(io.BytesIO(data),header=None,colspecs='infer',
+                          names=TABLE_COLUMNS[table])
+    else:
+        tbl = pd.read_csv(io.BytesIO(data),header=None,sep=r'\s+',
+                          names=TABLE_COLUMNS[table])
+    tbl = tbl[columns]
+    for name, width, ftype in TABLE_SCHEMA[table]:
+        if name in columns and ftype == 'c':
+            tbl[name] = tbl[name].astype(str).astype('category')
+    return tbl
+
+def readTable(path, table, columns=None):
+    #function reads a single Antelope table at path into a dataframe with
+    #the given columns (default TABLE_USECOLS[table]), named and typed as in
+    #TABLE_SCHEMA. Compressed tables are decompressed in memory
+    if columns is None:
+        columns = TABLE_USECOLS[table]
+    with openTable(path) as tablefile:
+        data = tablefile.read()
+    tbl = parseRecords(data, table, columns)
+    if tbl is None:
+        logger.warning('Table %s does not have fixed-width CSS3.0 records, '
+                       'splitting on white space', path)
+        tbl = _readTableText(data, table, columns)
+    return tbl
+
+CACHE_VERSION = 2 #bump when the dataframes produced by readTable change
+
+def cacheFormat():
+    #sidecar table cache format: memory-mapped Feather files when pyarrow is
+    #installed, otherwise pickled dataframes
+    try:
+        import pyarrow.feather #noqa: F401
+    except ImportError:
+        return 'pickle'
+    return 'feather'
+
+def _writeCacheFile(tbl, datapath, fmt):
+    #write dataframe tbl to datapath in cache format fmt, replacing any old 
+    #file in one step so a reader never sees a partial file
+    tmppath = datapath + '.tmp'
+    if fmt == 'feather':
+        tbl.to_feather(tmppath)
+    else:
+        tbl.to_pickle(tmppath)
+    os.replace(tmppath, datapath)
+
+def _readCacheFile(datapath, fmt):
+    if fmt == 'feather':
+        import pyarrow.feather
+        return pyarrow.feather.read_table(datapath, memory_map=True).to_pandas()
+    return pd.read_pickle(datapath)
+
+#dataframes parsed by any AntelopeDB, by (device, inode, modification time,
+#size) of the table file and columns; databases whose tables are the same 
+#file (e.g. a station inventory linked into several databases) share one 
+#parse while any of them holds it
+_parsedTables = weakref.WeakValueDictionary()
+
+class AntelopeDB(object):
+    #Handle on an Antelope database that parses each table once and keeps 
+    #it in memory so repeated calls to getData and writeSta2Hypoinverse do 
+    #not re-read the table files. A table is reloaded when the modification 
+    #time or size of its file changes. A table file already parsed by 
+    #another AntelopeDB (the same file through another path or link) is 
+    #shared rather than parsed again.
+    #If cachedir is given, each parsed table is also saved there as a typed
+    #binary sidecar file (see cacheFormat) and later runs load that file 
+    #instead of parsing the text table again. A sidecar is only used while 
+    #the modification time and size of its source table are unchanged.
+    #Dataframes returned by table() are shared between callers and should
+    #not be modified in place.
+    
+    def __init__(self, dbid, dbfoldername, cachedir=None, columns=None):
+        self.dbid = dbid
+        self.dbfoldername = dbfoldername
+        self.cachedir = cachedir
+        #table name -> columns to load, TABLE_USECOLS by default; use 
+        #TABLE_COLUMNS to load every column
+        self.columns = dict(TABLE_USECOLS)
+        if columns is not None:
+            self.columns.update(columns)
+        self.tables = {} #table name -> (file stamp, dataframe)
+        #table name -> (file stamp, bytes of the file parsed, dataframe) as
+        #last seen by refresh()
+        self.reported = {}
+        self.joinindex = None #JoinIndex, see index()
+        
+    def tablePath(self, table):
+        #file of table, which may be compressed (see findTable)
+        return findTable(self.dbfoldername + '/' + self.dbid + '.' + table)
+    
+    def table(self, table):
+        #return the dataframe for table, re-reading the file if it changed
+        #since it was last loaded
+        path = self.tablePath(table)
+        filestat = os.stat(path)
+        stamp = (filestat.st_mtime_ns, filestat.st_size)
+        cached = self.tables.get(table)
+        if cached is None or cached[0] != stamp:
+            key = (filestat.st_dev, filestat.st_ino) + stamp + \
+            tuple(self.columns[table])
+            tbl = _parsedTables.get(key)
+            if tbl is None:
+                with _stage('parse'):
+                    tbl = self.loadTable(table, path, stamp)
+                _count('tablerows', table, len(tbl))
+                _parsedTables[key] = tbl
+            else:
+                _count('counters', 'tables shared')
+            cached = (stamp, tbl)
+            self.tables[table] = cached
+        return cached[1]
+    
+    def refresh(self, table):
+        #pick up rows appended to table since the previous refresh (or, on
+        #the first call, since it was loaded) by parsing only the new bytes 
+        #of its file (up to the last complete line). Rows are reported even
+        #if table() has loaded them in between. Returns a dataframe of the 
+        #new rows, or None if the whole table was reloaded instead: when the
+        #file shrank, changed without growing (rewritten in place) or could
+        #not be parsed. A compressed table is always reloaded whole when its
+        #file changes. self.reported keeps the rows seen before the reload
+        path = self.tablePath(table)
+        if table not in self.reported:
+            self.reported[table] = self._reportedTable(table)
+        filestat = os.stat(path)
+        stamp = (filestat.st_mtime_ns, filestat.st_size)
+        oldstamp, offset, tbl = self.reported[table]
+        if filestat.st_size < offset or (stamp != oldstamp and (
+            tableCompression(path) or filestat.st_size == oldstamp[1])):
+            self.reported[table] = self._reportedTable(table)
+            return None
+        
+        data = b''
+        if filestat.st_size > offset:
+            with open(path, 'rb') as tablefile:
+                tablefile.seek(offset)
+                data = tablefile.read(filestat.st_size - offset)
+            data = data[:data.rfind(b'\n') + 1]
+        newrows = parseRecords(data, table, self.columns[table])
+        if newrows is None:
+            self.tables.pop(table, None)
+            self.reported[table] = self._reportedTable(table)
+            return None
+        if len(newrows) > 0:
+            tbl = _appendRows(tbl, newrows)
+            _count('tablerows', table, len(newrows))
+        self.reported[table] = (stamp, offset + len(data), tbl)
+        #keep a table already reloaded up to date by table()
+        if table not in self.tables or self.tables[table][0] != stamp:
+            self.tables[table] = (stamp, tbl)
+        return newrows
+    
+    def _reportedTable(self, table):
+        #the whole table as loaded by table(), as a starting point for 
+        #refresh()
+        tbl = self.table(table)
+        stamp = self.tables[table][0]
+        return (stamp, stamp[1], tbl)
+    
+    def loadTable(self, table, path, stamp):
+        #parse table from path, going through the sidecar cache if enabled
+        if self.cachedir is None:
+            return readTable(path, table, self.columns[table])
+        
+        #sidecars are named after the database folder too, so databases 
+        #with the same name in different folders can share a cachedir
+        fmt = cacheFormat()
+        folderkey = hashlib.sha1(os.path.abspath(self.dbfoldername)
+                                 .encode()).hexdigest()[:12]
+        cachename = os.path.join(self.cachedir, self.dbid + '.' + folderkey +
+                                 '.' + table)
+        datapath = cachename + '.' + fmt
+        metapath = cachename + '.json'
+        meta = {'version': CACHE_VERSION, 'format': fmt, 
+                'mtime_ns': stamp[0], 'size': stamp[1],
+                'columns': list(self.columns[table])}
+        
+        if os.path.exists(metapath) and os.path.exists(datapath):
+            with open(metapath) as metafile:
+                try:
+                    oldmeta = json.load(metafile)
+                except ValueError:
+                    oldmeta = None
+            if oldmeta == meta:
+                return _readCacheFile(datapath, fmt)
+        
+        tbl = readTable(path, table, self.columns[table])
+        os.makedirs(self.cachedir, exist_ok=True)
+        try:
+            _writeCacheFile(tbl, datapath, fmt)
+        except Exception as err:
+            logger.warning('Cannot cache table %s: %s', path, err)
+            return tbl
+        with open(metapath, 'w') as metafile:
+            json.dump(meta, metafile)
+        return tbl
+    
+    def clear(self):
+        #drop all tables held in memory (sidecar files are kept)
+        self.tables = {}
+        self.joinindex = None
+    
+    def tableStamps(self, tables):
+        #modification time and size of the files of tables
+        stamps = {}
+        for table in tables:
+            filestat = os.stat(self.tablePath(table))
+            stamps[table] = [filestat.st_mtime_ns, filestat.st_size]
+        return stamps
+    
+    def indexPath(self):
+        #file a JoinIndex is saved to, alongside the database tables
+        return self.dbfoldername + '/' + self.dbid + '.a2hindex.npz'
+    
+    def index(self):
+        #return the JoinIndex of the database: the one held in memory or 
+        #saved alongside the database if it is still up to date with the 
+        #tables and readable, otherwise a newly built one
+        stamps = self.tableStamps(JoinIndex.KEYS)
+        joinindex = self.joinindex
+        if joinindex is None or joinindex.stamps != stamps:
+            joinindex = None
+            if os.path.exists(self.indexPath()):
+                try:
+                    joinindex = JoinIndex.load(self.indexPath())
+                except (KeyError, ValueError, EOFError, OSError,
+                        zipfile.BadZipFile) as error:
+                    #damaged, or written by a version that pickled arrays
+                    logger.info('Cannot read saved index %s (%s), '
+                                'rebuilding it', self.indexPath(), error)
+                if joinindex is not None and joinindex.stamps != stamps:
+                    joinindex = None
+            if joinindex is None:
+                joinindex = JoinIndex.build(self, stamps)
+            self.joinindex = joinindex
+        return joinindex
+    
+    def saveIndex(self):
+        #build (if needed) and save the JoinIndex alongside the database
+        joinindex = self.index()
+        joinindex.save(self.indexPath())
+        return joinindex
+
+def keyValues(tbl, columns):
+    #key array for columns of dataframe tbl used by JoinIndex and 
+    #EpochIndex; string codes and multiple columns are joined into one 
+    #string key. Always a NumPy array (pandas 3 gives string columns an
+    #extension array)
+    if len(columns) == 1 and pd.api.types.is_integer_dtype(tbl[columns[0]]):
+        return np.asarray(tbl[columns[0]].values)
+    keys = tbl[columns[0]].astype(str)
+    for col in columns[1:]:
+        keys = keys + '\t' + tbl[col].astype(str)
+    return np.asarray(keys, dtype=str)
+
+class JoinIndex(object):
+    #Key to row position indexes over the tables joined by getData, so the
+    #rows of one event are found in O(picks) instead of scanning whole 
+    #tables: evid->event rows, evid->origin rows, orid->assoc rows, 
+    #arid->arrival rows, sta->snetsta rows and (sta,chan)->sitechan rows 
+    #(the epochs of the channel). For each table the row positions are 
+    #stored sorted by key (stable, so rows with the same key stay in table 
+    #order) next to the sorted keys for binary search.
+    #stamps holds the file modification time and size of each table when 
+    #the index was built; an index with stale stamps must be rebuilt.
+    
+    #table -> key column(s)
+    KEYS = {'event': ['evid'], 'origin': ['evid'], 'assoc': ['orid'],
+            'arrival': ['arid'], 'snetsta': ['sta'], 
+            'sitechan': ['sta','chan']}
+    
+    def __init__(self, keys, rows, stamps):
+        self.keys = keys #table -> sorted key array
+        self.rows = rows #table -> row positions in key order
+        self.stamps = stamps
+    
+    @classmethod
+    def build(cls, db, stamps=None):
+        keys = {}
+        rows = {}
+        for table, columns in cls.KEYS.items():
+            values = keyValues(db.table(table), columns)
+            rows[table] = np.argsort(values, kind='stable')
+            keys[table] = values[rows[table]]
+        if stamps is None:
+            stamps = db.tableStamps(cls.KEYS)
+        return cls(keys, rows, stamps)
+    
+    def save(self, path):
+        arrays = {'stamps': np.array(json.dumps(self.stamps))}
+        for table in self.KEYS:
+            arrays[table + '.keys'] = self.keys[table]
+            arrays[table + '.rows'] = self.rows[table]
+        tmppath = path + '.tmp.npz'
+        np.savez(tmppath, **arrays)
+        os.replace(tmppath, path)
+    
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            keys = {table: arrays[table + '.keys'] for table in cls.KEYS}
+            rows = {table: arrays[table + '.rows'] for table in cls.KEYS}
+            stamps = json.loads(str(arrays['stamps']))
+        return cls(keys, rows, stamps)
+    
+    def lookup(self, table, values):
+        #row positions of table whose key is in values, in table order
+        keys = np.asarray(self.keys[table])
+        values = np.asarray(values, dtype=str if keys.dtype.kind == 'U' 
+                            else keys.dtype)
+        first = np.searchsorted(keys, values, 'left')
+        last = np.searchsorted(keys, values, 'right')
+        if len(values) == 0 or (last - first).sum() == 0:
+            return np.zeros(0, dtype='int64')
+        positions = np.concatenate([self.rows[table][i:j] 
+                                    for i, j in zip(first, last)])
+        return np.unique(positions)
+    
+    def eventTables(self, db, evids, origin='all'):
+        #rows of the event, origin, assoc, arrival, snetsta and sitechan 
+        #tables of db that the join of events evids uses, as dataframes 
+        #keyed by table name; origin selects the origins whose picks are
+        #looked up, see selectOrigins
+        tables = {}
+        for table in ['event','origin']:
+            tables[table] = db.table(table).iloc[self.lookup(table, evids)]
+        tables['origin'] = selectOrigins(tables['event'], tables['origin'], 
+                                         origin)
+        tables['assoc'] = db.table('assoc').iloc[
+            self.lookup('assoc', tables['origin'].orid.values)]
+        tables['arrival'] = db.table('arrival').iloc[
+            self.lookup('arrival', tables['assoc'].arid.values)]
+        stas = np.unique(tables['assoc'].sta.astype(str))
+        tables['snetsta'] = db.table('snetsta').iloc[
+            self.lookup('snetsta', stas)]
+        chans = np.unique(tables['arrival'].chan.astype(str))
+        stachans = [sta + '\t' + chan 
+                    for sta in np.unique(tables['snetsta'].staid.astype(str)) 
+                    for chan in chans]
+        tables['sitechan'] = db.table('sitechan').iloc[
+            self.lookup('sitechan', stachans)]
+        return tables
+
+def _appendRows(tbl, newrows):
+    #concatenate newrows to dataframe tbl keeping categorical columns 
+    #categorical
+    columns = {}
+    for col in tbl.columns:
+        if isinstance(tbl[col].dtype, pd.CategoricalDtype):
+            columns[col] = pd.api.types.union_categoricals(
+                [tbl[col], newrows[col]], ignore_order=True)
+        else:
+            columns[col] = np.concatenate([tbl[col].values, 
+                                           newrows[col].values])
+    return pd.DataFrame(columns)
+
+_databases = {} #(dbfoldername, dbid) -> AntelopeDB shared by the functions
+
+def openDatabase(dbid, dbfoldername, cachedir=None):
+    #return the shared AntelopeDB handle for database dbid in dbfoldername,
+    #turning on the sidecar table cache in cachedir if given
+    key = (dbfoldername, dbid)
+    if key not in _databases:
+        _databases[key] = AntelopeDB(dbid, dbfoldername)
+    if cachedir is not None:
+        _databases[key].cachedir = cachedir
+    return _databases[key]
+
+def jdateToEpoch(jdates):
+    #convert Antelope julian dates (YYYYDDD) to the epoch time of the start
+    #of that day
+    jdates = np.asarray(jdates, dtype='int64')
+    years = (jdates//1000 - 1970).astype('datetime64[Y]')
+    days = years.astype('datetime64[D]') + (jdates % 1000 - 1)
+    return days.astype('datetime64[s]').astype('int64').astype(float)
+
+class EpochIndex(object):
+    #Interval index over the epochs (rows with a start and end) of a table 
+    #such as sitechan, site or sensor, so a (key, date) query resolves 
+    #straight to the single active row instead of joining every epoch and 
+    #filtering. The active epoch is the one with the latest start on or 
+    #before the date, provided it has not ended before the date. Open 
+    #epochs (Antelope offdate -1, endtime 9999999999.999) never end.
+    
+    def __init__(self, keys, starts, ends):
+        keys = np.asarray(keys).astype(str)
+        starts = np.asarray(starts, dtype=float)
+        ends = np.asarray(ends, dtype=float)
+        
+        #rank every epoch by key code then start so one binary search finds
+        #the latest start for a key
+        self.ukeys, keycode = np.unique(keys, return_inverse=True)
+        self.ustarts = np.unique(starts)
+        combined = keycode*(len(self.ustarts) + 1) + \
+        np.searchsorted(self.ustarts, starts)
+        self.rows = np.argsort(combined, kind='stable')
+        self.combined = combined[self.rows]
+        self.keycode = keycode[self.rows]
+        self.ends = ends[self.rows]
+    
+    @classmethod
+    def fromTable(cls, tbl, keycols, startcol, endcol):
+        #epoch index of dataframe tbl keyed on keycols. Julian date ends of 
+        #-1 and epoch time ends of 9999999999 or more are open
+        ends = tbl[endcol].values.astype(float)
+        ends = np.where((ends == -1) | (ends >= 9999999999.0), np.inf, ends)
+        return cls(keyValues(tbl, keycols), tbl[startcol].values, ends)
+    
+    def active(self, keys, dates):
+        #row position (in the indexed table) of the epoch active on each 
+        #date for each key, -1 where there is none
+        keys = np.asarray(keys).astype(str)
+        dates = np.asarray(dates, dtype=float)
+        if len(self.ukeys) == 0 or len(keys) == 0:
+            return np.full(len(keys), -1, dtype='int64')
+        qkey = np.minimum(np.searchsorted(self.ukeys, keys), 
+                          len(self.ukeys) - 1)
+        qrank = np.searchsorted(self.ustarts, dates, 'right') - 1
+        pos = np.searchsorted(self.combined, 
+                              qkey*(len(self.ustarts) + 1) + qrank, 'right') - 1
+        found = (self.ukeys[qkey] == keys) & (qrank >= 0) & (pos >= 0)
+        pos = np.maximum(pos, 0)
+        found &= (self.keycode[pos] == qkey) & (self.ends[pos] >= dates)
+        return np.where(found, self.rows[pos], -1)
+
+def _attachRows(left, right, positions, keycols, suffix):
+    #add to each row of dataframe left the columns of the row of right at 
+    #positions (none where -1), like a left merge on keycols with suffixes 
+    #['', suffix] but with at most one right row per left row
+    right = right.drop(columns=keycols).reset_index(drop=True)
+    right = right.rename(columns={col: col + suffix for col in right.columns
+                                  if col in left.columns})
+    right = right.reindex(positions).reset_index(drop=True)
+    return pd.concat([left.reset_index(drop=True), right], axis=1)
+
+def selectEvents(db, starttime=None, endtime=None, minlat=None, maxlat=None,
+                 minlon=None, maxlon=None, mindepth=None, maxdepth=None,
+                 etype=None, auth=None, origin='prefor'):
+    #function returns the rows of the event table of AntelopeDB handle db 
+    #whose origin chosen by origin (see selectOrigins) matches all of the 
+    #given filters, so the origin written for an event is the one filtered
+    #on; with origin='all' an event matches if any of its origins does. 
+    #Filters left as None are not applied. starttime/endtime are epoch 
+    #times, lat/lon/depth bounds are inclusive, etype and auth (origin 
+    #author) may be a single string or a list of strings
+    evtbl = db.table('event')
+    filters = [starttime, endtime, minlat, maxlat, minlon, maxlon, mindepth,
+               maxdepth, etype, auth]
+    if all(f is None for f in filters):
+        return evtbl
+    
+    ortbl = db.table('origin')
+    if not (isinstance(origin, str) and origin == 'all'):
+        ortbl = selectOrigins(evtbl, ortbl, origin)
+    keep = np.ones(len(ortbl), dtype=bool)
+    for col, lower, upper in [('time', starttime, endtime),
+                              ('lat', minlat, maxlat),
+                              ('lon', minlon, maxlon),
+                              ('depth', mindepth, maxdepth)]:
+        if lower is not None:
+            keep &= (ortbl[col] >= lower).values
+        if upper is not None:
+            keep &= (ortbl[col] <= upper).values
+    for col, values in [('etype', etype), ('auth', auth)]:
+        if values is not None:
+            if isinstance(values, str):
+                values = [values]
+            keep &= ortbl[col].isin(values).values
+    
+    return evtbl[evtbl.evid.isin(ortbl.evid[keep])]
+
+def iterEvids(dbid, dbfoldername, db=None, **filters):
+    #generator yielding, in increasing order, the event ids present in the 
+    #.event table of database dbid. Keyword filters are those of 
+    #selectEvents (e.g. starttime, maxdepth, etype, auth, origin)
+    if db is None:
+        db = openDatabase(dbid, dbfoldername)
+    for evid in np.unique(selectEvents(db, **filters).evid):
+        yield int(evid)
+
+def selectOrigins(eventinfo, ortbl, origin='prefor'):
+    #function returns the rows of origin table ortbl joined to the events in
+    #eventinfo (rows of the event table), one origin per event unless 
+    #origin is 'all':
+    #  'prefor' - the event's preferred origin (event.prefor), or its latest
+    #             origin if the preferred one is missing
+    #  'latest' - the origin with the latest lddate (the later row on ties)
+    #  dict     - the latest origin whose columns match all items, e.g. 
+    #             {'auth': 'oa', 'algorithm': 'locsat'}; a value may be a 
+    #             list of accepted values. Events without such an origin get
+    #             none
+    #  'all'    - every origin of the event, each with its own picks
+    #Rows are returned in table order
+    if isinstance(origin, str) and origin == 'all':
+        return ortbl
+    ortbl = ortbl[ortbl.evid.isin(eventinfo.evid)]
+    
+    candidates = ortbl
+    if isinstance(origin, dict):
+        keep = np.ones(len(ortbl), dtype=bool)
+        for col, values in origin.items():
+            if isinstance(values, str) or not np.iterable(values):
+                values = [values]
+            keep &= ortbl[col].isin(values).values
+        candidates = ortbl[keep]
+    elif origin not in ('prefor', 'latest'):
+        raise ValueError('origin must be prefor, latest, all or a dict of '+\
+        'origin columns, not '+str(origin))
+    
+    #latest origin of each event: last of the rows ordered by evid, lddate
+    #and table position
+    order = np.lexsort((np.arange(len(candidates)), 
+                        candidates['lddate'].values, candidates['evid'].values))
+    evids = candidates['evid'].values[order]
+    last = np.ones(len(order), dtype=bool)
+    last[:-1] = evids[1:] != evids[:-1]
+    selected = np.zeros(len(candidates), dtype=bool)
+    selected[order[last]] = True
+    
+    if origin == 'prefor':
+        prefor = pd.Series(eventinfo['prefor'].values, 
+                           index=eventinfo['evid'].values)
+        prefor = prefor[~prefor.index.duplicated()]
+        preferred = (ortbl['orid'].values == 
+                     prefor.reindex(ortbl['evid'].values).values)
+        haspreferred = ortbl['evid'].isin(ortbl['evid'][preferred]).values
+        selected = preferred | (selected & ~haspreferred)
+    return candidates[selected]
+
+def getData(eventid, dbid, dbfoldername, db=None, origin='prefor'):
+    logger.info('Fetching data for event %s', eventid)
     
     #function merges key Antelope tables and extracts event information to 
     #return eventdb, a labeled dataframe with event location and pick 
     #information. Feed the dataframe into function write2Hypoinverse to write 
     #data to a properly formatted text file.
+    #db is an optional AntelopeDB handle; by default the shared handle for
+    #dbid/dbfoldername is used so tables are only parsed once per run
+    #origin chooses the origin(s) of the event that are joined to its 
+    #picks, see selectOrigins
     
     eventdb = []
     
-    #set paths to relevant tables
-    pathevtbl = dbfoldername + '/' + dbid + '.event'
-    pathortbl = dbfoldername + '/' + dbid + '.origin'
-    pathassoctbl = dbfoldername + '/' + dbid + '.assoc'
-    patharrivtbl = dbfoldername + '/' + dbid + '.arrival'
-    pathnetwktbl = dbfoldername + '/' + dbid + '.snetsta'    
-    #pathsitetbl = dbfoldername + '/' + dbid + '.site'
-    pathsitechantbl = dbfoldername + '/' + dbid + '.sitechan'
+    if db is None:
+        db = openDatabase(dbid, dbfoldername)
         
-    #load antelope tables to dataframes and pull event related rows
-    evtbl = pd.read_csv(pathevtbl,header=None,delim_whitespace=True,
-                        names=['evid','evname','prefor','auth','commid',
-                        'lddate'])
-    ortbl = pd.read_csv(pathortbl,header=None,delim_whitespace=True,
-                        names=['lat','lon','depth','time','orid','evid',
-                               'jdate','nass','ndef','ndp','grn','srn','etype',
-                               'review','depdp','dtype','mb','mbid','ms',
-                               'msid','ml',
-                               'mlid','algorithm','auth','commid','lddate'])
-    assoctbl = pd.read_csv(pathassoctbl,header=None,delim_whitespace=True,
-                           names=['arid','orid','sta','phase','belief',
-                                  'delta','seaz','esaz','timeres','timedef',
-                                  'azres','azdef','slores','slodef','emares',
-                                  'wgt','vmodel','commid','lddate'])                            
-    arrivtbl = pd.read_csv(patharrivtbl,header=None,delim_whitespace=True,
-                           names=['sta','time','arid','jdate','stassid',
-                                  'chanid','chan','iphase','stype','detim',
-                                  'azimuth','delaz','slow','delslo','ema',
-                                  'rect','amp','per','logat','clip','fm',
-                                  'snr','qual','auth','commid','lddate'])
-    netwktbl = pd.read_csv(pathnetwktbl,header=None,delim_whitespace=True,
-                           names=['netwk','sta','staid','lddate'])
-    #sitetbl = pd.read_fwf(pathsitetbl,header=None,
-    #                      names=['sta','ondate','offdate','lat','lon','elev',
-    #                             'staname','statype','refsta','dnorth','deast',
-    #                             'lddate'])
-    sitechantbl = pd.read_csv(pathsitechantbl,header=None,
-                              delim_whitespace=True,names=['staid','chan',
-                              'ondate','chanid','offdate','ctype','edepth',
-                              'hang','vang','descrip','lddate'])
-                           
-    eventinfo = evtbl[evtbl.evid==eventid]  
+    #pull event related rows through the join index so only the rows of 
+    #this event are merged
+    with _stage('index'):
+        index = db.index()
+        tables = index.eventTables(db, [eventid], origin)
+    eventinfo = tables.pop('event')
     
     #join data from other tables associated with event
-    eventdb = pd.merge(eventinfo, ortbl, on='evid', how='left',
-                       suffixes=['_ev','_or']) 
-    eventdb = eventdb.merge(assoctbl, 
-                            on='orid', how='left',suffixes=['','_assoc'])
-    eventdb = eventdb.merge(arrivtbl, 
-                            on='arid', how='left',suffixes=['','_arriv'])
-    eventdb = eventdb.merge(netwktbl, 
-                            on='sta', how='left',suffixes=['','_netsta'])
-    eventdb = eventdb.merge(sitechantbl,
-                            on=['staid','chan'], how='left',suffixes=['','_site'])
+    eventdb = joinTables(eventinfo, db, tables, origin)
      
     return eventdb
+
+def joinTables(eventinfo, db, tables=None, origin='prefor'):
+    #function joins rows of the event table (eventinfo) to the origin, 
+    #assoc, arrival, snetsta and sitechan tables of AntelopeDB handle db. 
+    #Used by getData for a single event and by convertCatalog for a whole 
+    #catalog in one pass. tables optionally maps table names to dataframes
+    #that replace the full tables of db, e.g. the rows of one event found 
+    #through a JoinIndex or one partition when streaming. Origins are 
+    #selected (see selectOrigins) before assoc is joined, so only the picks
+    #of the chosen origin of each event are pulled in
+    
+    #load antelope tables to dataframes
+    tables = dict(tables or {})
+    for table in ['origin','assoc','arrival','snetsta','sitechan']:
+        if table not in tables:
+            tables[table] = db.table(table)
+    ortbl = selectOrigins(eventinfo, tables['origin'], origin)
+    if isinstance(origin, dict):
+        eventinfo = eventinfo[eventinfo.evid.isin(ortbl.evid)]
+    assoctbl = tables['assoc']
+    arrivtbl = tables['arrival']
+    netwktbl = tables['snetsta'].rename(columns={'net':'netwk'})
+    sitechantbl = tables['sitechan'].rename(columns={'sta':'staid'})
+    
+    with _stage('join'):
+        eventdb = pd.merge(eventinfo, ortbl, on='evid', how='left',
+                           suffixes=['_ev','_or']) 
+        _count('mergerows', 'origin', len(eventdb))
+        eventdb = eventdb.merge(assoctbl, 
+                                on='orid', how='left',suffixes=['','_assoc'])
+        _count('mergerows', 'assoc', len(eventdb))
+        eventdb = eventdb.merge(arrivtbl, 
+                                on='arid', how='left',suffixes=['','_arriv'])
+        _count('mergerows', 'arrival', len(eventdb))
+        eventdb = eventdb.merge(netwktbl, 
+                                on='sta', how='left',suffixes=['','_netsta'])
+        _count('mergerows', 'snetsta', len(eventdb))
+        #attach the single sitechan epoch of each pick's channel that is 
+        #active on the origin date rather than every epoch of the channel
+        epochs = EpochIndex.fromTable(sitechantbl, ['staid','chan'], 
+                                      'ondate', 'offdate')
+        active = epochs.active(keyValues(eventdb, ['staid','chan']), 
+                               eventdb['jdate'].values)
+        eventdb = _attachRows(eventdb, sitechantbl, active, ['staid','chan'],
+                              '_site')
+        _count('mergerows', 'sitechan', len(eventdb))
+    return eventdb
+    
+def hypoTimes(etimes):
+    #Vectorized conversion of an array of epoch times to the time fields 
+    #used by Hypoinverse. Returns integer arrays of year, month-day-hour-
+    #minute (MMDDHHMM, write with 8 digits zero padded) and the seconds in 
+    #hundredths within that minute. The fractional second is rounded to 
+    #hundredths first, so a time that rounds up to a whole minute carries 
+    #into the next minute (and hour, day, ...) instead of giving 60.00 s
+    etimes = np.asarray(etimes, dtype=float)
+    centisec = np.round(etimes % 1*100, 0).astype('int64')
+    esec = np.floor(etimes).astype('int64') + centisec//100
+    centisec = centisec % 100
+    edays = esec.astype('datetime64[s]').astype('datetime64[D]')
+    emonths = edays.astype('datetime64[M]')
+    year = emonths.astype('datetime64[Y]').astype('int64') + 1970
+    month = emonths.astype('int64') % 12 + 1
+    day = (edays - emonths).astype('int64') + 1
+    mdhm = ((month*100 + day)*100 + esec//3600 % 24)*100 + esec//60 % 60
+    return year, mdhm, esec % 60*100 + centisec
+
+@functools.lru_cache(maxsize=65536)
+def hypoTime(etime):
+    #memoized single time version of hypoTimes; returns year (int), 8-char 
+    #MMDDHHMM string and seconds in hundredths (int)
+    centisec = int(round(etime % 1*100, 0))
+    esec = int(math.floor(etime)) + centisec//100
+    gmt = time.gmtime(esec)
+    mdhmstr = '%02d%02d%02d%02d' % (gmt.tm_mon, gmt.tm_mday, gmt.tm_hour, 
+                                    gmt.tm_min)
+    return gmt.tm_year, mdhmstr, gmt.tm_sec*100 + centisec % 100
+
+class RecordLayout(object):
+    #Declarative description of a fixed-width Hypoinverse line, compiled 
+    #once into a batch formatter. fields are (name, width, format, 
+    #justification) in line order, where format is
+    #  'i' - integer
+    #  's' - string
+    #  anything else - a literal written as is on every line (name None),
+    #        e.g. a constant column or the newline
+    #and justification is '<' left, '>' right, '0' right and zero filled or
+    #'=' the value must fill the field exactly.
+    #A value that does not fit its field is rejected and the field is left
+    #blank, so every line is exactly length characters. format() writes a 
+    #whole batch of records into one preallocated buffer of character codes,
+    #a field (column of the buffer) at a time; line() formats one record 
+    #with string operations only.
+    
+    def __init__(self, name, fields, length):
+        self.name = name
+        self.length = length
+        self.fields = [] #(name, offset, width, format, justification)
+        self._template = None #see template
+        self.parts = [] #text of each field of a blank line, see line()
+        offset = 0
+        for fname, width, fmt, just in fields:
+            self.parts.append(' '*width if fname else fmt)
+            if fname is None:
+                if len(fmt) != width:
+                    raise ValueError('literal '+repr(fmt)+' is not '+\
+                    str(width)+' characters')
+            elif fmt not in ('i', 's') or just not in ('<', '>', '0', '='):
+                raise ValueError('field '+fname+' has an unknown format')
+            elif fmt == 'i' and just == '<':
+                raise ValueError('integer field '+fname+' cannot be left '+\
+                'justified')
+            else:
+                self.fields.append((fname, offset, width, fmt, just))
+            offset += width
+        self.slots = {fname: (i, width, fmt, just) for i, (fname, width, 
+                      fmt, just) in enumerate(fields) if fname is not None}
+        if offset != length:
+            raise ValueError(name+' layout is '+str(offset)+\
+            ' characters, not '+str(length))
+    
+    @property
+    def template(self):
+        #character codes of a blank line, built when first needed by 
+        #format()
+        if self._template is None:
+            self._template = np.array([ord(c) for c in ''.join(self.parts)],
+                                      dtype=np.uint32)
+        return self._template
+    
+    def format(self, values, nrows=1, where=None):
+        #format nrows records. values maps field names to a scalar or an 
+        #array of nrows values (fields without values are left blank), where
+        #optionally maps field names to a boolean mask of the rows the value
+        #is written to. Returns the nrows x length buffer of character codes
+        #and a dict of field name -> boolean mask of rows whose value was 
+        #rejected
+        buf = np.empty((nrows, self.length), dtype=np.uint32)
+        buf[:] = self.template
+        rejected = {}
+        for fname, offset, width, fmt, just in self.fields:
+            if fname not in values:
+                continue
+            if fmt == 'i':
+                cells, bad = _intCells(values[fname], nrows, width, just)
+            else:
+                cells, bad = _strCells(values[fname], nrows, width, just)
+            if where is not None and fname in where:
+                bad = bad & where[fname]
+                keep = where[fname] & ~bad
+            else:
+                keep = ~bad
+            if keep.all():
+                buf[:, offset:offset + width] = cells
+            elif keep.any():
+                buf[keep, offset:offset + width] = cells[keep]
+            rejected[fname] = bad
+        return buf, rejected
+    
+    def line(self, values):
+        #format a single record with string operations, which is faster 
+        #than format() for one line. Returns the line and a dict of field 
+        #name -> True for the fields whose value was rejected
+        parts = list(self.parts)
+        rejected = {}
+        for fname, value in values.items():
+            i, width, fmt, just = self.slots[fname]
+            text = str(int(value)) if fmt == 'i' else str(value)
+            if just == '<':
+                text = text.ljust(width)
+            elif just == '>':
+                text = text.rjust(width)
+            elif just == '0':
+                text = text.zfill(width)
+            if len(text) == width:
+                parts[i] = text
+            else:
+                rejected[fname] = True
+        return ''.join(parts), rejected
+    
+    def lines(self, values, nrows=1, where=None):
+        #format nrows records as a list of line strings, see format
+        buf, rejected = self.format(values, nrows, where)
+        lines = buf.view('U' + str(self.length)).ravel().tolist()
+        return lines, rejected
+
+    def parse(self, cells, names=None):
+        #read fields back from an nrows x length array of character codes
+        #(e.g. lines of a file, see HypoFile), the reverse of format(). 
+        #names optionally limits the fields read.
+        #Returns a dict of field name -> array of nrows values: integer
+        #fields as floats with NaN where the field is blank, string fields
+        #with the padding removed
+        cells = np.asarray(cells)
+        values = {}
+        for fname, offset, width, fmt, just in self.fields:
+            if names is not None and fname not in names:
+                continue
+            field = cells[:, offset:offset + width]
+            if fmt == 'i':
+                values[fname] = _parseIntCells(field)
+            else:
+                #strip each distinct value once, fields are mostly codes
+                text = np.ascontiguousarray(field, dtype=np.uint8)\
+                .view('S' + str(width)).ravel()
+                text, inverse = np.unique(text, return_inverse=True)
+                text = np.char.strip(text.astype('U' + str(width)))
+                values[fname] = text[inverse.ravel()]
+        return values
+
+def _parseIntCells(cells):
+    #integer values of an nrows x width array of character codes, NaN for
+    #blank cells (see RecordLayout.parse)
+    isdigit = (cells >= ord('0')) & (cells <= ord('9'))
+    values = np.zeros(len(cells))
+    for k in range(cells.shape[1]):
+        values = np.where(isdigit[:, k], values*10 + (cells[:, k] - ord('0')),
+                          values)
+    values[(cells == ord('-')).any(axis=1)] *= -1
+    values[~isdigit.any(axis=1)] = np.nan
+    return values
+
+def _intCells(values, nrows, width, just):
+    #character codes of integer values right justified in width characters
+    #(see RecordLayout), with a mask of the values that do not fit
+    values = np.broadcast_to(np.asarray(values, dtype='int64'), (nrows,))
+    negative = values < 0
+    magnitude = np.abs(values)
+    cells = np.empty((nrows, width), dtype=np.uint32)
+    ndigits = np.ones(nrows, dtype='int64')
+    for k in range(width):
+        digit = magnitude//10**k % 10 + ord('0')
+        if k == 0:
+            cells[:, width - 1] = digit
+            continue
+        more = magnitude >= 10**k
+        ndigits += more
+        if just == '0':
+            cells[:, width - 1 - k] = digit
+        else:
+            cells[:, width - 1 - k] = np.where(more, digit, ord(' '))
+    ndigits += (magnitude >= 10**width) #too long whatever the remainder
+    nchars = ndigits + negative
+    if negative.any():
+        rows = np.nonzero(negative & (nchars <= width))[0]
+        signcol = 0 if just == '0' else width - nchars[rows]
+        cells[rows, signcol] = ord('-')
+    if just == '=':
+        return cells, nchars != width
+    return cells, nchars > width
+
+def _strCells(values, nrows, width, just):
+    #character codes of string values justified in width characters (see
+    #RecordLayout), with a mask of the values that do not fit
+    values = np.asarray(values, dtype=str)
+    if values.ndim == 0:
+        cells, bad = _strCells(values.reshape(1), 1, width, just)
+        return np.broadcast_to(cells, (nrows, width)), \
+        np.broadcast_to(bad, (nrows,))
+    nchars = np.char.str_len(values)
+    bad = nchars != width if just == '=' else nchars > width
+    values = values.astype('U' + str(width))
+    if just == '>':
+        values = np.char.rjust(values, width)
+    elif just == '0':
+        values = np.char.zfill(values, width)
+    cells = values.astype('U' + str(width)).view(np.uint32)\
+    .reshape(len(values), width).copy()
+    cells[cells == 0] = ord(' ')
+    return cells, bad
+
+def _reportRejected(rejected, kind):
+    #log and count fields rejected by RecordLayout.format or line for lines
+    #of kind; rejected maps field names to a mask of the rejected lines, or
+    #for lines made one at a time by line() to True or a list of booleans
+    if not rejected:
+        return
+    masks = list(rejected.values())
+    if all(isinstance(bad, (bool, list)) for bad in masks):
+        masks = [bad if isinstance(bad, list) else [bad] for bad in masks]
+        nbad = sum(map(any, zip(*masks)))
+        counts = [sum(bad) for bad in masks]
+    else:
+        nbad = np.sum(np.logical_or.reduce(masks))
+        counts = [np.sum(bad) for bad in masks]
+    if nbad:
+        logger.warning('Cannot change string for %d %s lines, check '
+                       'proposed string lengths', nbad, kind)
+        if _metrics is not None:
+            for fname, nfield in zip(rejected, counts):
+                _metrics.count('rejected', kind + ' ' + fname, nfield)
+
+#Hypoinverse archive lines. Field formats in the comments are those of the
+#Hypoinverse documentation; blank fields are left for Hypoinverse to fill
+HEADER_LAYOUT = RecordLayout('header', [
+    ('year', 4, 'i', '='), #year (I4)
+    ('mdhm', 8, 's', '='), #month, day, hour, minute (4I2)
+    ('ortime', 4, 'i', '>'), #origin time in s (F4.2)
+    ('latdeg', 2, 'i', '>'), #lat in degrees (F2.0)
+    ('ns', 1, 's', '<'), #S for south, blank otherwise (A1)
+    ('latmin', 4, 'i', '>'), #lat in min (F4.2)
+    ('londeg', 3, 'i', '>'), #long in degrees (F3.0)
+    ('ew', 1, 's', '<'), #E for east, otherwise blank (A1)
+    ('lonmin', 4, 'i', '>'), #long in min (F4.2)
+    ('dep', 5, 'i', '>'), #depth in km (F5.2)
+    #magnitude from max S amplitude from NCSN stations (F3.2), 0 placeholder
+    #because NCSN mag not calculated
+    (None, 3, '  0', None),
+    ('numt', 3, 's', '>'), #number p and s times (I3)
+    ('mazgap', 3, 'i', '>'), #max azimuthal gap in degrees (I3)
+    ('stadist', 3, 'i', '>'), #distance to nearest station in degrees (F3.0)
+    ('rmstt', 4, 'i', '>'), #rms travel time residual (F4.2)
+    ('aziprin1', 3, 'i', '>'), #azimuth of largest principal error (F3.0)
+    ('dipprin1', 2, 'i', '>'), #dip of largest principal error (F2.0)
+    ('sizprin1', 4, 'i', '>'), #size of largest principal error (F4.2)
+    ('aziprin2', 3, 'i', '>'), #azimuth of intermediate principal error 
+    ('dipprin2', 2, 'i', '>'), #dip of intermediate principal error (F2.0)
+    ('sizprin2', 4, 'i', '>'), #size of intermediate principal error (F4.2)
+    ('codamag', 3, 'i', '>'), #coda duration magnitude, NCSN stations (F3.2)
+    ('evrmk', 3, 's', '<'), #event location remark (A3)
+    ('sizprin3', 4, 'i', '>'), #size of smallest principal error (F4.2)
+    ('auxrmk', 2, 's', '<'), #auxiliary remark (2A1)
+    ('numst', 3, 'i', '>'), #num s times (I3)
+    ('horzerr', 4, 'i', '>'), #horizontal error (F4.2)
+    ('verterr', 4, 'i', '>'), #vertical error  (F4.2)
+    ('numpfm', 3, 'i', '>'), #number of p first motions (I3)
+    ('smagweights', 4, 'i', '>'), #sum of s amplitude mag weights (F4.1)
+    ('durmagweights', 4, 'i', '>'), #sum duration mag weights (F4.1)
+    ('madsmag', 3, 'i', '>'), #median absolute difference s-amp mag (F3.2)
+    ('maddurmag', 3, 'i', '>'), #median absolute difference dur mag (F3.2)
+    ('emod', 3, 's', '<'), #3-letter code for crust/delay model (A3)
+    ('eqauth', 1, 's', '<'), #last authority for earthquake (A1)
+    ('scode', 1, 's', '<'), #most common P and S source code (A1)
+    ('durcode', 1, 's', '<'), #most common duration source code (A1)
+    ('ampcode', 1, 's', '<'), #most common amplitude source code (A1)
+    ('cdm', 1, 's', '<'), #coda duration magnitude type code (A1)
+    ('validpicks', 3, 'i', '>'), #number valid p and s picks (I3)
+    ('smagcode', 1, 's', '<'), #s amp magnitude type code (A1)
+    ('extmagcode', 1, 's', '<'), #external amplitude mag type code (A1)
+    ('extmag', 3, 'i', '>'), #external magnitude (F3.2)
+    ('extmagweights', 3, 'i', '>'), #sum of external magnitude weights (F3.1)
+    ('altamptype', 1, 's', '<'), #alternate amplitude mag label code (A1)
+    ('altamp', 3, 'i', '>'), #alternate amplitude magnitude (F3.2)
+    ('altampweights', 3, 'i', '>'), #sum of alternative mag weights (F3.2)
+    ('evid', 10, 'i', '>'), #event ID (I10)
+    ('prefmaglab', 1, 's', '<'), #preferred mag label (A1)
+    ('prefmag', 3, 'i', '>'), #preferred mag chosen by PRE command (F3.2)
+    ('prefmagweights', 4, 'i', '>'), #sum of preferred mag weights (F4.1)
+    ('altdurmagtype', 1, 's', '<'), #alt code duration mag type code (A1)
+    ('altdurmag', 3, 'i', '>'), #alt code duration magnitude (F3.2)
+    ('altdurmagweights', 4, 'i', '>'), #sum of alt duration mag weights 
+    ('versnum', 1, 's', '<'), #QDDS version number (A1)
+    ('oriversnum', 1, 's', '<'), #origin instance version num (A1)
+    (None, 1, '\n', None)], 165)
+
+PICK_LAYOUT = RecordLayout('pick', [
+    ('sta', 5, 's', '<'), #station code (A5)
+    ('net', 2, 's', '<'), #seismic network code (A2)
+    (None, 1, ' ', None),
+    ('comp1', 1, 's', '<'), #station component code, 1 letter (A1)
+    ('comp3', 3, 's', '<'), #station component code, 3 letters (A3)
+    (None, 1, ' ', None),
+    ('prmk', 2, 's', '<'), #P remark (A2)
+    ('pfm', 1, 's', '<'), #P first motion (A1)
+    ('pweight', 1, 's', '<'), #P weight code (I1)
+    ('year', 4, 'i', '='), #year (I4)
+    ('mdhm', 8, 'i', '0'), #month, day, hour, minute (4I2)
+    ('psec', 5, 'i', '>'), #P second (F5.2)
+    ('pres', 4, 'i', '>'), #P travel time residual (F4.2)
+    ('pwt', 3, 'i', '>'), #normalized P weight used (F3.2)
+    ('ssec', 5, 'i', '>'), #S second (F5.2)
+    ('srmk', 2, 's', '<'), #S remark (A2)
+    (None, 1, ' ', None),
+    ('sweight', 1, 's', '<'), #S weight code (I1)
+    #S travel time residual, amplitude, units, weights, delays, epicentral
+    #distance, emergence angle, magnitude codes, coda duration, azimuth,
+    #importances, source codes, location code, amplitude type and alternate
+    #component code are left blank
+    (None, 70, ' '*70, None),
+    (None, 1, '\n', None)], 121)
+
+TERMINATOR_LAYOUT = RecordLayout('terminator', [
+    (None, 6, ' '*6, None),
+    ('trialhrmin', 4, 's', '='), #trial hour and minute (A4)
+    ('trialsec', 4, 'i', '>'), #trial second (2I2)
+    ('triallatdeg', 2, 'i', '>'), #trial latitude (F2.0)
+    (None, 1, ' ', None),
+    ('triallatmin', 4, 'i', '>'), #trial latitude minutes (F4.2)
+    ('triallongdeg', 3, 'i', '>'), #trial longitude (F3.0)
+    (None, 1, ' ', None),
+    ('triallongmin', 4, 'i', '>'), #trial longitude minutes (F4.2)
+    ('trialdepth', 5, 'i', '>'), #trial depth (F5.2)
+    (None, 28, ' '*28, None),
+    ('trialidnum', 10, 'i', '>'), #trial ID number (I10)
+    (None, 1, '\n', None)], 73)
+
+def operationalPicks(eventdb):
+    #boolean mask of the rows of eventdb (see formatPickLines) whose 
+    #instrument was operational on the arrival date; an offdate of -1 means
+    #the channel is still open
+    jdate = np.trunc(eventdb['jdate'].values.astype(float))
+    offdate = np.trunc(eventdb['offdate'].values.astype(float))
+    return (jdate >= np.trunc(eventdb['ondate'].values.astype(float))) & \
+    ((jdate <= offdate) | (offdate == -1))
+
+def formatPickLines(eventdb):
+    #Builds the Hypoinverse pick lines for every row of dataframe eventdb 
+    #(created by getData, or a joined catalog of many events) in one batch
+    #with PICK_LAYOUT. Rows where the instrument was not operational on the
+    #event date are skipped.
+    #Returns a series of 121-character lines (including newline) indexed like
+    #eventdb and a boolean mask of the lines that have the correct length
+    
+    #skip rows if instrument not operational when event recorded
+    picks = eventdb[operationalPicks(eventdb)]
+    npicks = len(picks)
+    _count('skipped', 'pick: channel not operational', len(eventdb) - npicks)
+    if npicks == 0:
+        empty = pd.Series([], dtype=object)
+        return empty, empty.astype(bool)
+    
+    #station component code is V for vertical channels, H otherwise
+    chan = np.asarray(picks['chan'].values, dtype=str)
+    
+    #pick second is written in the P or S column depending on phase; P and S
+    #weight codes DEFAULT TO 2...
+    iphase = picks['iphase'].values
+    isP = iphase == 'P'
+    isS = iphase == 'S'
+    fm = picks['fm'].values
+    year, mdhm, centisec = hypoTimes(picks['time_arriv'].values)
+    
+    values = {'sta': picks['sta'].values, 'net': picks['netwk'].values,
+              'comp1': np.where(np.char.find(chan, 'Z') >= 0, 'V', 'H'),
+              'comp3': chan.astype('U3'),
+              'prmk': 'iP', 'pfm': fm, 'pweight': '2',
+              'year': year, 'mdhm': mdhm, 'psec': centisec, 
+              'ssec': centisec, 'srmk': 'ES', 'sweight': '2'}
+    where = {'prmk': isP, 'pfm': isP & ((fm == 'U') | (fm == 'D')),
+             'pweight': isP, 'psec': isP,
+             'ssec': isS, 'srmk': isS, 'sweight': isS}
+    plines, rejected = PICK_LAYOUT.lines(values, npicks, where)
+    _reportRejected(rejected, 'pick')
+    
+    plines = pd.Series(plines, index=picks.index, dtype=object)
+    return plines, plines.str.len() == 121
+
+BUFFER_SIZE = 1024*1024 #default characters held by OutputSink before writing
+
+class OutputSink(object):
+    #Single buffered output for Hypoinverse archive and station files.
+    #target is a file name, an already-open file or stream, or '-' for 
+    #standard output (e.g. to pipe straight into hypoinverse). Lines are 
+    #collected in memory and only handed to the file at event boundaries 
+    #(endEvent) once at least buffersize characters are waiting, so an event
+    #block is never split between writes; buffersize=0 flushes every event.
+    #Files opened by the sink are closed by close(), files or streams passed
+    #in are flushed but left open.
     
-def writeLength(oldstr, newstr):
-    #Function checks that any variable change is the correct length for 
-    #Hypoinverse format. Also converts variable to a string regardless of 
-    #input type
+    def __init__(self, target, mode='a', buffersize=BUFFER_SIZE):
+        self.buffersize = buffersize
+        self.pending = []
+        self.npending = 0
+        if target == '-':
+            self.stream = sys.stdout
+            self.owned = False
+        elif hasattr(target, 'write'):
+            self.stream = target
+            self.owned = False
+        else:
+            self.stream = open(target, mode)
+            self.owned = True
+        self.name = getattr(self.stream, 'name', str(target))
+        
+    def __str__(self):
+        return str(self.name)
     
-    accstr = oldstr #default return old string unless new string is right len
-    if len(str(oldstr)) == len(str(newstr)):
-        accstr=str(newstr)
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+        
+    def write(self, line):
+        self.pending.append(line)
+        self.npending += len(line)
+        
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+            
+    def endEvent(self):
+        #mark an event boundary; write out the buffer if it is full
+        if self.npending >= self.buffersize:
+            self.flush()
+            
+    def writeEvent(self, lines):
+        #write all lines of one event block followed by an event boundary
+        self.writelines(lines)
+        if _metrics is not None:
+            _metrics.count('counters', 'events written')
+            _metrics.count('counters', 'picks written', 
+                           sum(1 for line in lines if len(line) == 121))
+        self.endEvent()
+        
+    def flush(self):
+        with _stage('write'):
+            if self.pending:
+                self.stream.write(''.join(self.pending))
+                self.pending = []
+                self.npending = 0
+            self.stream.flush()
+        
+    def close(self):
+        self.flush()
+        if self.owned:
+            self.stream.close()
+
+@contextlib.contextmanager
+def openSink(target, mode='a', buffersize=BUFFER_SIZE):
+    #context manager giving an OutputSink for target. If target is already 
+    #an OutputSink it is used as is and left open for the caller
+    if isinstance(target, OutputSink):
+        yield target
     else:
-        print('Cannot change string, '+str(newstr)+' check proposed string length')
-    return accstr
-    
-def writeMdhm(etime):
-    #function converts epoch time in Antelope database to 8-char month day
-    #hour minute time format for hypoinverse    
-    mdhmstr = '';
-    mdhmstr += format(time.gmtime(etime).tm_mon,'02')
-    mdhmstr += format(time.gmtime(etime).tm_mday, '02')
-    mdhmstr += format(time.gmtime(etime).tm_hour, '02')
-    mdhmstr += format(time.gmtime(etime).tm_min, '02')
-    return mdhmstr
+        sink = OutputSink(target, mode, buffersize)
+        try:
+            yield sink
+        finally:
+            sink.close()
 
 def write2Hypoinverse(eventdb, ffname):
     #Takes in a dataframe eventdb created by getData and writes that data in 
     #the proper format to a text file ffname that is properly formatted for 
-    #Hypoinverse.
+    #Hypoinverse. ffname may also be an open file, '-' for standard output or
+    #an OutputSink shared between calls (see openSink)
+    lines = formatEvent(eventdb, ffname)
+    if len(lines) == 0:
+        return
+    with openSink(ffname, 'a') as sink:
+        sink.writeEvent(lines)
+    return
+
+def formatEvent(eventdb, ffname=None):
+    #Takes in a dataframe eventdb created by getData and returns the list of
+    #Hypoinverse archive lines (header, picks, terminator) for the event. 
+    #An empty list is returned if the event cannot be written. ffname is 
+    #only used in messages.
+
+    #check if dataframe is empty i.e. event id provided does not exist
+    if eventdb.empty == True:
+        logger.warning('DataFrame is empty. Check that event %s exists. Will '
+                       'not write to Hypoinverse file.', ffname)
+        _count('skipped', 'event: no data')
+        return []
+    
+    #all pick lines of the event are built at once by formatPickLines
+    with _stage('format'):
+        plines, plineok = formatPickLines(eventdb)
+    return formatBlock(eventdb['evid'].iloc[0], eventdb['time'].iloc[0], 
+                       eventdb['lat'].iloc[0], eventdb['lon'].iloc[0],
+                       eventdb['depth'].iloc[0], eventdb['nass'].iloc[0], 
+                       plines[plineok])
+
+def formatBlock(evid, ortime, lat, lon, depth, nass, picklines):
+    #Returns the Hypoinverse archive lines of one event from its origin 
+    #values (origin time, lat, lon, depth, number of associated phases) and
+    #its pick lines made by formatPickLines
 
     #This format starts with an event header line. Many of the blank variables
     #will be over-written by hypoinverse
     #The following lines include pick information for the event
     #Each event then has a terminator line with input information about the 
     #event, such as the trial earthquake origin location and time
+    
+    #an event row without any origin joins to NaN origin values
+    if math.isnan(ortime):
+        logger.warning('Event %s has no origin. Will not write to '
+                       'Hypoinverse file.', evid)
+        _count('skipped', 'event: no origin')
+        return []
+    logger.info('Writing event data to Hypoinverse file: %s', evid)
+    
+    with _stage('format'):
+        #PART 1: HEADER LINE
+        #fields are laid out by HEADER_LAYOUT, those not set here stay 
+        #blank. year, month-day-hour-minute and seconds all come from one 
+        #calendar decomposition of the origin time so a rounded second that
+        #carries into the next minute stays consistent across the fields
+        oryear, ormdhm, orcentisec = hypoTime(ortime)
+        header = {'year': oryear, 'mdhm': ormdhm, 'ortime': orcentisec,
+                  'latdeg': math.floor(abs(lat)),
+                  'latmin': round(abs(lat)%1*60*100),
+                  'londeg': math.floor(abs(lon)),
+                  'lonmin': round(abs(lon)%1*60*100),
+                  'dep': round(depth*100),
+                  'numt': "{}".format(nass),
+                  'evid': int(evid)}
+        if lat < 0:
+            header['ns'] = 'S'
+        if lon > 0:
+            header['ew'] = 'E'
+        headln, rejected = HEADER_LAYOUT.line(header)
+        _reportRejected(rejected, 'header')
+        
+        #PART 2: PICK LINES
+        lines = [headln]
+        lines.extend(picklines)
+        
+        #PART 3: TERMINATOR LINE
+        #set variables to proper input parameters - just event ID for now
+        #the trial origin is being skipped because current documentation 
+        #doesn't clearly indicate if negative degree locations are 
+        #appropriately considered by hypoinverse code when in terminator 
+        #line; inputting preliminary origin in header line instead
+        
+        #trial['trialhrmin'] = ormdhm[4:]
+        #trial['trialsec'] = header['ortime']
+        #trial['triallatdeg'] = header['latdeg']
+        #trial['triallatmin'] = header['latmin']
+        #trial['triallongdeg'] = header['londeg']
+        #trial['triallongmin'] = header['lonmin']
+        #trial['trialdepth'] = header['dep']
+        trial = {}
+        if 'evid' not in rejected:
+            trial['trialidnum'] = header['evid']
+        termline, rejected = TERMINATOR_LAYOUT.line(trial)
+        _reportRejected(rejected, 'terminator')
+        lines.append(termline)
+    
+    _count('counters', 'events formatted')
+    return lines
 
-    #check if dataframe is empty i.e. event id provided does not exist
-    if eventdb.empty == True:
-        print('DataFrame is empty. Check that event ' + str(ffname) + \
-        ' exists. Will not write to Hypoinverse file.\n')
-        return    
-    
-    print('Writing event data to Hypoinverse file: '+ \
-    str(eventdb['evid'].iloc[0]))    
-    
-    #initialize all variables as appropriately lengthed white space
-    wsp = ' ' #initialize all variables as appropriately lengthed white space    
-    
-    #PART 1: HEADER LINE
-    #Initialize summary header variables as right length of spaces
-    yr = wsp*4 #year (I4)
-    mdhm = wsp*8 #month, day, hour, minute (4I2)
-    ortime = wsp*4 #origin time in s (F4.2)
-    latdeg = wsp*2 #lat in degrees (F2.0)
-    ns = wsp #S for south, blank otherwise (A1)
-    latmin = wsp*4 #lat in min (F4.2)
-    londeg = wsp*3 #long in degrees (F3.0)
-    ew = wsp #E for east, otherwise blank (A1)
-    lonmin = wsp*4 #long in min (F4.2)
-    dep = wsp*5 #depth in km (F5.2)
-    mag = wsp*3 #magnitude from max S amplitude from NCSN stations (F3.2)
-    numt = wsp*3 #number p and s times (I3)
-    mazgap = wsp*3 #max azimuthal gap in degrees (I3)
-    stadist = wsp*3 #distance to nearest station in degrees (F3.0)
-    rmstt = wsp*4 #rms travel time residual (F4.2)
-    aziprin1 = wsp*3 #azimuth of largest principal error (F3.0)
-    dipprin1 = wsp*2 #dip of largest principal error (F2.0)
-    sizprin1 = wsp*4 #size of largest principal error (F4.2)
-    aziprin2 = wsp*3 #azimuth of intermediate principal error (F3.0)
-    dipprin2 = wsp*2 #dip of intermediate principal error (F2.0)
-    sizprin2 = wsp*4 #size of intermediate principal error (F4.2)
-    codamag = wsp*3 #coda duration magnitude from NCSN stations (F3.2)
-    evrmk = wsp*3 #event location remark (A3)
-    sizprin3 = wsp*4 #size of smallest principal error (F4.2)
-    auxrmk = wsp*2 #auxiliary remark (2A1)
-    numst = wsp*3 #num s times (I3)
-    horzerr = wsp*4 #horizontal error (F4.2)
-    verterr = wsp*4 #vertical error  (F4.2)
-    numpfm = wsp*3 #number of p first motions (I3)
-    smagweights = wsp*4 #sum of s amplitude mag weights ~num readings (F4.1)
-    durmagweights = wsp*4 #sum duration mag weights ~num readings (F4.1)
-    madsmag = wsp*3 #median absolute difference s-amp mag (F3.2)
-    maddurmag = wsp*3 #median absolute difference duration mag (F3.2)
-    emod = wsp*3 #3-letter code for crust/delay model (A3)
-    eqauth = wsp*1 #last authority for earthquake (A1)
-    scode = wsp*1 #most common P and S source code (A1)
-    durcode = wsp*1 #most common duration source code (A1)
-    ampcode = wsp*1 #most common amplitude source code (A1)
-    cdm = wsp*1 #coda duration magnitude type code (A1)
-    validpicks = wsp*3 #number valid p and s picks (I3)
-    smagcode = wsp*1 #s amp magnitude type code (A1)
-    extmagcode = wsp*1 #external amplitude mag type code (A1)
-    extmag = wsp*3 #external magnitude (F3.2)
-    extmagweights = wsp*3 #sum of external magnitude weights (F3.1)
-    altamptype = wsp*1 #alternate amplitude mag label code (A1)
-    altamp = wsp*3 #alternate amplitude magnitude (F3.2)    
-    altampweights = wsp*3 #sum of alternative magnitude weights (F3.2)
-    evid = wsp*10 #event ID (I10)
-    prefmaglab = wsp*1 #preferred mag label (A1)
-    prefmag = wsp*3 #preferred mag chosen by PRE command (F3.2)
-    prefmagweights = wsp*4 #sum of preferred mag weights (F4.1)
-    altdurmagtype = wsp*1 #alt code duration mag type code (A1)
-    altdurmag = wsp*3 #alt code duration magnitude (F3.2)
-    altdurmagweights = wsp*4 #sum of alt duration magnitude weights (F4.1)
-    versnum = wsp*1 #QDDS version number (A1)
-    oriversnum = wsp*1 #origin instance version num (A1)
-    
-    #set variables from whitespace to input database values
-    #using function writeLength to protect correct length format of variables
-    yr = writeLength(yr,str(eventdb['jdate'].iloc[0])[:4])  
-    
-    mdhm = writeLength(mdhm,writeMdhm(eventdb['time'].iloc[0]))   
-    
-    ortime = writeLength(ortime,"{:>4}".format(int(time.gmtime(\
-    (eventdb['time'].iloc[0])).tm_sec*100+round(eventdb['time']\
-    .iloc[0]%1*100,0))))
-    
-    latdeg = writeLength(latdeg,\
-    "{:>2}".format(int(np.floor(abs(eventdb['lat'].iloc[0])))))
-    
-    if eventdb['lat'].iloc[0] < 0:
-        ns = writeLength(ns,'S')
+def eventLines(eventid, dbid, dbfoldername, db=None, origin='prefor'):
+    #Returns the Hypoinverse archive lines of one event, the same as
+    #formatEvent(getData(eventid, ...)), without pandas or numpy: only the
+    #rows of the event are read from the plain text tables (see
+    #TableRows), through the join index saved alongside the database (see
+    #AntelopeDB.saveIndex) while it is up to date, otherwise by a scan of
+    #the key column. Events this path does not cover (compressed tables,
+    #missing origin, assoc or arrival rows, duplicate event rows) go
+    #through getData with AntelopeDB db instead
+    with _stage('index'):
+        event = _eventRows(eventid, dbid, dbfoldername, origin)
+    if event is None:
+        return formatEvent(getData(eventid, dbid, dbfoldername, db=db,
+                                   origin=origin), eventid)
+    logger.info('Fetching data for event %s', eventid)
+    if not event:
+        logger.warning('DataFrame is empty. Check that event %s exists. Will '
+                       'not write to Hypoinverse file.', eventid)
+        _count('skipped', 'event: no data')
+        return []
+    origins, picks = event
+    with _stage('format'):
+        picklines = formatPickRows(picks)
+    first = origins[0]
+    return formatBlock(eventid, first['time'], first['lat'], first['lon'],
+                       first['depth'], first['nass'], picklines)
+
+def convertEvent(eventid, dbid, dbfoldername, ffname, db=None,
+                 origin='prefor'):
+    #writes (appends) one event to ffname through eventLines, the fast
+    #equivalent of write2Hypoinverse(getData(eventid, ...), ffname)
+    lines = eventLines(eventid, dbid, dbfoldername, db, origin)
+    if len(lines) == 0:
+        return
+    with openSink(ffname, 'a') as sink:
+        sink.writeEvent(lines)
+
+def _eventRows(eventid, dbid, dbfoldername, origin):
+    #rows of one event for eventLines: the selected origins and the picks
+    #as dicts in the row order of joinTables, an empty tuple if the event
+    #does not exist or None where eventLines must fall back on getData
+    tables = {table: TableRows(findTable(dbfoldername + '/' + dbid + '.' +
+                                         table), table)
+              for table in JoinIndex.KEYS}
+    index = None
+    try:
+        if any(not (tables[table].plain and tables[table].aligned)
+               for table in tables):
+            return None
+        index = SavedIndex.open(dbfoldername + '/' + dbid + '.a2hindex.npz',
+                                {table: tables[table].path 
+                                 for table in tables})
+        def lookup(table, keys):
+            if index is not None and tables[table].fixed:
+                return tables[table].rows(index.lookup(table, keys))
+            return tables[table].find(JoinIndex.KEYS[table], keys)
         
-    latmin = writeLength(latmin,"{:>4}".format(\
-    int(np.round(abs(eventdb['lat'].iloc[0]%1)*60*100))))
+        events = lookup('event', [eventid])
+        if len(events) != 1:
+            return () if len(events) == 0 else None
+        origins = _selectOriginRows(events[0], lookup('origin', [eventid]),
+                                    origin)
+        if not origins:
+            return None
+        assocs = lookup('assoc', [row['orid'] for row in origins])
+        arrivals = {}
+        for row in lookup('arrival', sorted({row['arid'] for row in assocs})):
+            if row['arid'] in arrivals:
+                return None
+            arrivals[row['arid']] = row
+        nets = {}
+        for row in lookup('snetsta', sorted({row['sta'] for row in assocs})):
+            nets.setdefault(row['sta'], []).append(row)
+        chans = sorted({row['chan'] for row in arrivals.values()})
+        stachans = [(sta, chan) for sta in sorted({row['staid'] for rows
+                    in nets.values() for row in rows}) for chan in chans]
+        epochs = {}
+        for row in lookup('sitechan', stachans):
+            epochs.setdefault((row['sta'], row['chan']), []).append(row)
+    finally:
+        for table in tables.values():
+            table.close()
+        if index is not None:
+            index.close()
+
+    #rows in the order of the joinTables merges: origins, then the assoc
+    #rows of each, then the snetsta rows of each station
+    picks = []
+    for orow in origins:
+        oassocs = [row for row in assocs if row['orid'] == orow['orid']]
+        if not oassocs or any(row['arid'] not in arrivals for row in oassocs):
+            return None
+        for arow in oassocs:
+            arrival = arrivals[arow['arid']]
+            for net in nets.get(arow['sta'], [None]):
+                epoch = None
+                if net is not None:
+                    epoch = _activeEpoch(epochs.get((net['staid'],
+                                         arrival['chan']), []), orow['jdate'])
+                picks.append({'sta': arow['sta'],
+                              'netwk': None if net is None else net['net'],
+                              'chan': arrival['chan'],
+                              'iphase': arrival['iphase'],
+                              'fm': arrival['fm'],
+                              'time_arriv': arrival['time'],
+                              'jdate': orow['jdate'], 'epoch': epoch})
+    return origins, picks
+
+def _selectOriginRows(event, origins, origin='prefor'):
+    #selectOrigins for the origin rows (dicts, in table order) of a single
+    #event row, see eventLines
+    if isinstance(origin, str) and origin == 'all':
+        return origins
+    candidates = origins
+    if isinstance(origin, dict):
+        for col, values in origin.items():
+            if isinstance(values, str) or \
+            not isinstance(values, (list, tuple, set)):
+                values = [values]
+            candidates = [row for row in candidates if row[col] in values]
+    elif origin not in ('prefor', 'latest'):
+        raise ValueError('origin must be prefor, latest, all or a dict of '+\
+        'origin columns, not '+str(origin))
+    if origin == 'prefor':
+        preferred = [row for row in origins if row['orid'] == event['prefor']]
+        if preferred:
+            return preferred
+    if not candidates:
+        return []
+    #latest lddate (NaN after every date), the later row on ties
+    latest = max(range(len(candidates)), key=lambda i: (
+        math.isnan(candidates[i]['lddate']),
+        0.0 if math.isnan(candidates[i]['lddate'])
+        else candidates[i]['lddate'], i))
+    return [candidates[latest]]
+
+def _activeEpoch(epochs, date):
+    #EpochIndex.active for the sitechan rows (dicts, in table order) of one
+    #channel: the epoch with the latest ondate on or before date (the last
+    #row on ties) unless it is over by date, else None
+    started = [row for row in epochs if row['ondate'] <= date]
+    if not started:
+        return None
+    latest = max(row['ondate'] for row in started)
+    epoch = [row for row in started if row['ondate'] == latest][-1]
+    if epoch['offdate'] != -1 and epoch['offdate'] < date:
+        return None
+    return epoch
+
+def formatPickRows(picks):
+    #formatPickLines for the picks (dicts made by eventLines) of one event,
+    #one line at a time with PICK_LAYOUT.line. Returns the pick lines
+    lines = []
+    rejected = {}
+    nskipped = 0
+    for pick in picks:
+        #skip picks whose instrument was not operational on the event date
+        epoch = pick['epoch']
+        jdate = math.trunc(pick['jdate'])
+        if epoch is None or jdate < math.trunc(epoch['ondate']) or \
+        (jdate > math.trunc(epoch['offdate']) and epoch['offdate'] != -1):
+            nskipped += 1
+            continue
+        chan = pick['chan']
+        year, mdhm, centisec = hypoTime(pick['time_arriv'])
+        values = {'sta': pick['sta'], 'net': pick['netwk'],
+                  'comp1': 'V' if 'Z' in chan else 'H', 'comp3': chan[:3],
+                  'year': year, 'mdhm': mdhm}
+        if pick['iphase'] == 'P':
+            values.update(prmk='iP', pweight='2', psec=centisec)
+            if pick['fm'] in ('U', 'D'):
+                values['pfm'] = pick['fm']
+        elif pick['iphase'] == 'S':
+            values.update(ssec=centisec, srmk='ES', sweight='2')
+        line, bad = PICK_LAYOUT.line(values)
+        for fname in bad:
+            rejected.setdefault(fname, [False]*len(lines))
+        for fname in rejected:
+            rejected[fname].append(fname in bad)
+        lines.append(line)
+    _count('skipped', 'pick: channel not operational', nskipped)
+    _reportRejected(rejected, 'pick')
+    return lines
+
+class TableRows(object):
+    #Reads single rows of a plain CSS3.0 table file without parsing the
+    #whole table. find() scans the file (memory-mapped) for rows whose key
+    #columns hold given values with one regular expression anchored at the
+    #columns' offsets; rows() reads rows by position, which needs every
+    #record to be the schema length (fixed). Rows are dicts of the
+    #TABLE_USECOLS columns typed as readTable types them (codes as str).
+    #plain is False for compressed files and aligned is False for files 
+    #whose first record does not have the schema field offsets (e.g. split
+    #on white space); neither is read here.
+    
+    def __init__(self, path, table):
+        self.path = path
+        self.table = table
+        self.reclen = recordLength(table)
+        self.plain = tableCompression(path) is None
+        self.fields = {} #column -> (offset, width, type)
+        offset = 0
+        for name, width, ftype in TABLE_SCHEMA[table]:
+            self.fields[name] = (offset, width, ftype)
+            offset += width + 1
+        self.map = b''
+        self.file = None
+        if self.plain and os.path.getsize(path) > 0:
+            self.file = open(path, 'rb')
+            self.map = mmap.mmap(self.file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        self.fixed = len(self.map) % (self.reclen + 1) == 0
+        end = self.map.find(b'\n')
+        first = self.map[:end if end >= 0 else None].rstrip(b'\r')
+        self.aligned = len(first) <= self.reclen and all(
+            first[offset + width:offset + width + 1] in (b' ', b'')
+            for offset, width, ftype in list(self.fields.values())[:-1])
     
-    londeg = writeLength(londeg,\
-    "{:>3}".format(int(np.floor(abs(eventdb['lon'].iloc[0])))))   
+    def close(self):
+        if self.file is not None:
+            self.map.close()
+            self.file.close()
     
-    if eventdb['lon'].iloc[0] > 0:
-        ew = writeLength(ew,'E')
+    def parse(self, record):
+        #dict of the TABLE_USECOLS columns of one record (bytes)
+        row = {}
+        for name in TABLE_USECOLS[self.table]:
+            offset, width, ftype = self.fields[name]
+            text = record[offset:offset + width]
+            if ftype == 'i':
+                row[name] = int(text)
+            elif ftype == 'f':
+                row[name] = float(text)
+            else:
+                row[name] = text.strip().decode()
+        return row
+    
+    def rows(self, positions):
+        #rows at positions (record numbers), in the order given
+        rows = []
+        step = self.reclen + 1
+        for pos in positions:
+            record = self.map[pos*step:(pos + 1)*step]
+            if len(record) != step or record[-1:] != b'\n':
+                raise ValueError('Table '+self.path+' does not have '+\
+                'fixed-width CSS3.0 records')
+            rows.append(self.parse(record))
+        return rows
+    
+    def find(self, columns, keys):
+        #rows whose columns hold one of keys (values, or tuples of values
+        #for several columns), in table order. Key columns are written as
+        #Antelope writes them: numbers right and codes left justified
+        if len(keys) == 0:
+            return []
+        fields = sorted((self.fields[col] + (i,)) for i, col in
+                        enumerate(columns))
+        start = fields[0][0]
+        alternatives = []
+        for key in keys:
+            key = key if isinstance(key, tuple) else (key,)
+            pattern, end = b'', start
+            for offset, width, ftype, i in fields:
+                text = str(key[i])
+                text = text.rjust(width) if ftype in 'if' else \
+                text.ljust(width)
+                pattern += b'.'*(offset - end) + re.escape(text.encode())
+                end = offset + width
+            alternatives.append(pattern)
+        regex = re.compile(b'^.{' + str(start).encode() + b'}(?:' +
+                           b'|'.join(alternatives) + b')', re.M)
+        rows = []
+        for match in regex.finditer(self.map):
+            end = self.map.find(b'\n', match.start())
+            record = self.map[match.start():end if end >= 0 else None]
+            rows.append(self.parse(record.rstrip(b'\r').ljust(self.reclen)))
+        return rows
 
-    lonmin = writeLength(lonmin,"{:>4}".format(\
-    int(np.round(abs(eventdb['lon'].iloc[0])%1*60*100))))
+class SavedIndex(object):
+    #JoinIndex saved alongside a database (see JoinIndex.save) read without
+    #numpy for eventLines: the arrays of each table are loaded from the
+    #.npz file on first use and searched with bisect
     
-    dep = writeLength(dep, "{:>5}".format(int(np.round(\
-    eventdb['depth'].iloc[0]*100))))
+    def __init__(self, path):
+        self.archive = zipfile.ZipFile(path)
+        self.arrays = {}
     
-    #NOTE 0 PLACEHOLDER BECAUSE NCSN MAG NOT CALCULATED
-    mag = writeLength(mag,'  0')     
+    @classmethod
+    def open(cls, path, paths):
+        #the index saved at path if it exists, is up to date with the
+        #table files paths (table -> path) and every array of those tables
+        #can be read, otherwise None
+        if not os.path.exists(path):
+            return None
+        try:
+            index = cls(path)
+        except (OSError, zipfile.BadZipFile):
+            logger.info('Cannot read saved index %s, scanning tables', path)
+            return None
+        try:
+            stamps = json.loads(index.array('stamps'))
+            for table, tablepath in paths.items():
+                filestat = os.stat(tablepath)
+                if stamps.get(table) != [filestat.st_mtime_ns, 
+                                         filestat.st_size]:
+                    index.close()
+                    return None
+                index.array(table + '.keys')
+                index.array(table + '.rows')
+        except (KeyError, ValueError, SyntaxError, OSError,
+                zipfile.BadZipFile) as error:
+            #e.g. string keys pickled as object arrays by older versions
+            logger.info('Cannot read saved index %s (%s), scanning tables',
+                        path, error)
+            index.close()
+            return None
+        return index
     
-    numt = writeLength(numt, "{:>3}".format(eventdb['nass'].iloc[0]))    
+    def close(self):
+        self.archive.close()
     
-    evid = writeLength(evid,"{:>10}".format(int(eventdb['evid'].iloc[0])))
+    def array(self, name):
+        #contents of array name of the .npz file: an array.array of
+        #integers, a list of str or a single str
+        if name not in self.arrays:
+            with self.archive.open(name + '.npy') as npyfile:
+                self.arrays[name] = _readNpy(npyfile)
+        return self.arrays[name]
     
-    #concat variables to single line
-    headln = yr+mdhm+ortime+latdeg+ns+latmin+londeg+ew+lonmin+dep+mag+numt+ \
-    mazgap+stadist+rmstt+aziprin1+dipprin1+sizprin1+aziprin2+dipprin2+ \
-    sizprin2+codamag+evrmk+sizprin3+auxrmk+numst+horzerr+verterr+numpfm+ \
-    smagweights+durmagweights+madsmag+maddurmag+emod+eqauth+scode+durcode+ \
-    ampcode+cdm+validpicks+smagcode+extmagcode+extmag+extmagweights+ \
-    altamptype+altamp+altampweights+evid+prefmaglab+prefmag+prefmagweights+ \
-    altdurmagtype+altdurmag+altdurmagweights+versnum+oriversnum+'\n'
+    def lookup(self, table, keys):
+        #record numbers of table whose key is in keys, in table order (see
+        #JoinIndex.lookup); keys of several columns are tuples
+        sortedkeys = self.array(table + '.keys')
+        rows = self.array(table + '.rows')
+        positions = set()
+        for key in keys:
+            if isinstance(key, tuple):
+                key = '\t'.join(key)
+            first = bisect.bisect_left(sortedkeys, key)
+            last = bisect.bisect_right(sortedkeys, key)
+            positions.update(rows[first:last])
+        return sorted(positions)
+
+#.npy integer types (without byte order) -> array.array type code
+NPY_INTEGERS = {'i8': 'q', 'i4': 'i', 'i2': 'h', 'u8': 'Q', 'u4': 'I',
+                'u2': 'H'}
+
+def _readNpy(npyfile):
+    #array stored in an open .npy file, read without numpy: 1-d integer
+    #arrays as array.array, unicode arrays as a list of str (a str for a
+    #0-d one), as written by JoinIndex.save
+    if npyfile.read(6) != b'\x93NUMPY':
+        raise ValueError('not a .npy file')
+    major = npyfile.read(2)[0]
+    headerlen = int.from_bytes(npyfile.read(2 if major == 1 else 4), 'little')
+    header = ast.literal_eval(npyfile.read(headerlen).decode('latin1'))
+    descr, shape = header['descr'], header['shape']
+    data = npyfile.read()
+    if descr[1:] in NPY_INTEGERS:
+        values = array.array(NPY_INTEGERS[descr[1:]])
+        values.frombytes(data)
+        if (descr[0] == '<') != (sys.byteorder == 'little'):
+            values.byteswap()
+        return values
+    if descr.startswith(('<U', '>U')):
+        width = int(descr[2:])
+        text = data.decode('utf-32-le' if descr[0] == '<' else 'utf-32-be')
+        values = [text[i*width:(i + 1)*width].rstrip('\x00')
+                  for i in range(len(text)//width if width else 0)]
+        return values if shape else values[0]
+    raise ValueError('cannot read .npy arrays of type '+descr)
+
+def convertCatalog(dbid, dbfoldername, ffname, evids=None, db=None, 
+                   buffersize=BUFFER_SIZE, workers=1, order='evid', 
+                   origin='prefor', **filters):
+    #function converts many events to Hypoinverse format in one pass: the 
+    #event->origin->assoc->arrival->snetsta->sitechan join is done once for
+    #all events, the result is grouped by evid and every archive block is 
+    #written to ffname (appended) through a single OutputSink of buffersize
+    #characters; ffname may be a file name, open file, '-' for standard 
+    #output or an OutputSink. Output is the
+    #same as calling getData and write2Hypoinverse for each event in turn.
+    #evids is an optional list of event ids to convert, in output order; by
+    #default every event in the .event table is converted in evid order, or
+    #in origin time order with order='time'.
+    #workers > 1 formats the events in that many processes; the joined 
+    #catalog is shared with them (copy-on-write where processes are forked)
+    #and blocks are written in the same order as a serial run.
+    #origin chooses the origin joined to the picks of each event, see 
+    #selectOrigins.
+    #Keyword filters are those of selectEvents and are applied to the 
+    #origin chosen by origin before any join.
+    #Returns the number of events written.
     
-    #write to event file
-    with open(ffname, 'a') as the_file:
-        
-        if len(headln) != 165: #check that header line is the correct length 
-            print('error: header line is incorrect length, not writing event'+\
-            'to file\n')       
-            return
+    if db is None:
+        db = openDatabase(dbid, dbfoldername)
+    
+    eventinfo = selectEvents(db, origin=origin, **filters)
+    if evids is not None:
+        evids = list(evids)
+        eventinfo = eventinfo[eventinfo.evid.isin(evids)]
+    
+    catalog = joinTables(eventinfo, db, origin=origin)
+    reftypes = _joinTypes(catalog, db)
+    groups = catalog.groupby('evid', sort=True).indices
+    if evids is None:
+        evids = _eventOrder(catalog, groups, order)
+    
+    with openSink(ffname, 'a', buffersize) as sink:
+        if workers > 1:
+            blocks = _eventBlocksParallel(catalog, groups, evids, reftypes,
+                                          workers)
         else:
-            the_file.write(headln)    
+            blocks = _eventBlocks(catalog, groups, evids, reftypes)
+        nevents = 0
+        for lines in blocks:
+            if len(lines) > 0:
+                sink.writeEvent(lines)
+                nevents += 1
+    return nevents
+
+def _joinTypes(catalog, db, tables=None):
+    #integer column types a per-event join would give when nothing is 
+    #missing, for the catalog columns that a catalog-wide join widened
+    tables = {table: tbl.iloc[:0] for table, tbl in (tables or {}).items()}
+    reftypes = joinTables(db.table('event').iloc[:0], db, tables).dtypes
+    return {col: reftypes[col] for col in catalog.columns 
+            if pd.api.types.is_integer_dtype(reftypes[col]) and 
+            catalog[col].dtype != reftypes[col]}
+
+def _eventOrder(catalog, groups, order):
+    #evids of a joined catalog in output order: 'evid' or 'time' (earliest
+    #origin time, ties by evid)
+    if order == 'evid':
+        return sorted(groups)
+    if order == 'time':
+        ortimes = catalog.groupby('evid', sort=True)['time'].min()
+        return list(ortimes.sort_values(kind='stable').index)
+    raise ValueError('order must be evid or time, not '+str(order))
+
+def _eventBlocks(catalog, groups, evids, reftypes):
+    #generator yielding the archive lines of each event of a joined catalog
+    #in the order of evids; groups maps evid to catalog row positions and
+    #events missing from the catalog are skipped. The pick lines of all the
+    #events are formatted in one batch before the first block is yielded, 
+    #the header values are taken from the first row of each event
+    evids = [evid for evid in evids if evid in groups]
+    if not evids:
+        return
+    rows = np.concatenate([groups[evid] for evid in evids])
+    with _stage('format'):
+        plines, plineok = formatPickLines(
+            catalog.iloc[rows].reset_index(drop=True))
+        picktext = np.full(len(rows), None, dtype=object)
+        picktext[plines.index[plineok.values]] = plines[plineok].values
     
-    #PART 2: PICK LINES
-    #loop through picks
-    for iind, erow in eventdb.iterrows():
-        #skip row if instrument not operational when event recorded
-        if (int(erow['jdate']) < int(erow['ondate'])) | (int(erow['jdate']) > int(erow['offdate'])):
-            continue
+    #left joins over a whole catalog turn integer columns into floats when
+    #any event is missing a row; nass is cast back for events that have it
+    #so each event formats exactly as it would from getData
+    ortime, lat, lon, depth, nass = [catalog[col].values for col in 
+                                     ['time', 'lat', 'lon', 'depth', 'nass']]
+    nasstype = reftypes.get('nass')
+    start = 0
+    for evid in evids:
+        end = start + len(groups[evid])
+        first = groups[evid][0]
+        evnass = nass[first]
+        if nasstype is not None and not np.isnan(evnass):
+            evnass = nasstype.type(evnass)
+        picklines = [line for line in picktext[start:end] if line is not None]
+        start = end
+        yield formatBlock(evid, ortime[first], lat[first], lon[first], 
+                          depth[first], evnass, picklines)
 
-        #initialize pick data lines
-        statcode = wsp*5 #left justified 5 letter station code (A5)
-        statnet = wsp*2 #seismic network code (A2)
-        comp1code = wsp*1 #station component code 1 letter (A1)
-        comp3code = wsp*3 #station component code 3 letter (A3)
-        prmk = wsp*2 #P remark (A2)
-        pfm = wsp*1 #P first motion (A1)
-        pweightcode = wsp*1 #P weight code (I1)
-        pyr = wsp*4 #pick year (I4)
-        pmdhm = wsp*8 #pick month, day, hour, minute (4I2)
-        psec = wsp*5 #P pick second (F5.2)
-        presid = wsp*4 #P pick residual (F4.2)
-        normpwt = wsp*3 #normalized P weight (F3.2)
-        ssec = wsp*5 #S arrival second (F5.2)
-        srmk = wsp*2 #S remark (A2)
-        sweightcode = wsp*1 #s weight code (I1)
-        sresid = wsp*4 #s travel time residual (F4.2)
-        amp = wsp*7 #amplitude peak-to-peak (F7.2)
-        ampunitcd = wsp*2 #amp units code (I2)
-        normswt = wsp*3 #s weight used (F3.2)
-        pdelay = wsp*4 #P delay time (F4.2)
-        sdelay = wsp*4 #S delay time (F4.2)
-        epidist = wsp*4 #epicentral distance (F4.1)
-        emang = wsp*3 #emergence angle at source (F3.0)
-        ampmagwtcode = wsp*1 #amplitude magnitude weight code (I1)
-        durmagwtcode = wsp*1 #duration magnitude weight code (I1)
-        amppd = wsp*3 #period at which station amplitude measured (F3.2)
-        statrmk = wsp*1 #station remark (A1)
-        codadur = wsp*4 #coda duration in s (F4.0)
-        azi2stat = wsp*3 #azimuth to station in deg E of N (F3.0)
-        durmag = wsp*3 #station duration magnitude (F3.2)
-        ampmag = wsp*3 #amplitude magnitude (F3.2)
-        impP = wsp*4 #importance of P arrival (F4.3)
-        impS = wsp*4 #importance of S arrival (F4.3)
-        dscode = wsp*1 #data source code (A1)
-        durmagcode = wsp*1 #duration magnitude code (A1)
-        ampmagcode = wsp*1 #amplitude magnitude code (A1)
-        statloccode = wsp*2 #2 letter stat location code (A2)
-        amptype = wsp*2 #amplitude type (I2)
-        acomp3code = wsp*3 #alternate 3-letter component code (A3)
-        ampmagyn = wsp*1 #X if station amplitude mag not used in event mag (A1)
-        durmagyn = wsp*1 #X if station duration mag not used in event mag (A1)
-        
-        #set necessary variables to input database values
-        
-        statcode = writeLength(statcode,"{:<5}".format(erow['sta']))
-        
-        statnet = writeLength(statnet,"{:<2}".format(erow['netwk']))
+def _writeEvents(catalog, evids, reftypes, sink):
+    #group a joined catalog by evid and write the block of each event to 
+    #sink, in the order of evids (or increasing evid if None). Returns the
+    #number of events written
+    groups = catalog.groupby('evid', sort=True).indices
+    if evids is None:
+        evids = sorted(groups)
+    nevents = 0
+    for lines in _eventBlocks(catalog, groups, evids, reftypes):
+        if len(lines) > 0:
+            sink.writeEvent(lines)
+            nevents += 1
+    return nevents
+
+_workerstate = {} #joined catalog shared with worker processes
+
+def _initWorker(catalog, groups, reftypes):
+    _workerstate['catalog'] = (catalog, groups, reftypes)
+
+def _formatEventsWorker(evids):
+    #format a run of events in a worker process
+    catalog, groups, reftypes = _workerstate['catalog']
+    return list(_eventBlocks(catalog, groups, evids, reftypes))
+
+def _eventBlocksParallel(catalog, groups, evids, reftypes, workers):
+    #parallel version of _eventBlocks: contiguous runs of evids are 
+    #formatted by a pool of worker processes and the blocks are yielded back
+    #in the order of evids
+    evids = [evid for evid in evids if evid in groups]
+    nchunks = min(len(evids), workers*8)
+    if nchunks == 0:
+        return
+    chunks = [evids[i*len(evids)//nchunks:(i + 1)*len(evids)//nchunks]
+              for i in range(nchunks)]
     
-        if 'Z' in erow['chan']:
-            comp1code = writeLength(comp1code,'V')
-        else:
-            comp1code = writeLength(comp1code,'H')
-            
-        comp3code = writeLength(comp3code,"{:<3}".format(erow['chan'][:3]))
-        
-        pyr = writeLength(pyr,time.gmtime(erow['time_arriv']).tm_year)
-        pmdhm = writeLength(pmdhm,writeMdhm(erow['time_arriv'])) 
-        #write P versus S arrival info in different variables    
-        if erow['iphase'] == 'P':
-            prmk = writeLength(prmk,'iP')
-        
-            #assign first motion direction if available            
-            if erow['fm'] == 'U':
-                pfm = writeLength(pfm,'U')
-            elif erow['fm'] == 'D':
-                pfm = writeLength(pfm,'D')
-    
-            #DEFAULTS ALL WEIGHTS TO 2...
-            pweightcode = writeLength(pweightcode,2)
-    
-            psec = writeLength(psec,"{:>5}".format(int(time.gmtime\
-            ((erow['time_arriv'])).tm_sec*100+round(erow['time_arriv']\
-            %1*100,0))))
-            
-        elif erow['iphase'] == 'S':
-            srmk = writeLength(srmk,'ES')
-            
-            sweightcode = writeLength(sweightcode,2)
-            
-            ssec = writeLength(ssec,"{:>5}".format(int(time.gmtime\
-            ((erow['time_arriv'])).tm_sec*100+\
-            round(erow['time_arriv']%1*100,0))))
+    if 'fork' in multiprocessing.get_all_start_methods():
+        #forked workers see the catalog without it being copied or pickled
+        context = multiprocessing.get_context('fork')
+        _workerstate['catalog'] = (catalog, groups, reftypes)
+        initargs = None
+    else:
+        context = multiprocessing.get_context()
+        initargs = (catalog, groups, reftypes)
+    try:
+        with context.Pool(workers, _initWorker if initargs else None,
+                          initargs or ()) as pool:
+            for blocks in pool.imap(_formatEventsWorker, chunks):
+                for lines in blocks:
+                    yield lines
+    finally:
+        _workerstate.clear()
+
+def eventFingerprints(catalog):
+    #fingerprint of every event of a joined catalog: a 64-bit hash of the 
+    #contents and order of all its rows (event, origin, assoc, arrival, 
+    #snetsta and sitechan columns, including lddate), so any change to the 
+    #rows an event's archive block is made from changes its fingerprint.
+    #Returns a series of 16-digit hex strings indexed by evid
+    rowhash = pd.util.hash_pandas_object(catalog, index=False).values
+    position = catalog.groupby('evid', sort=False).cumcount().values
+    weighted = pd.Series(rowhash*(position.astype('uint64')*2 + 1),
+                         index=catalog['evid'].values)
+    combined = weighted.groupby(level=0).sum()
+    return combined.map(lambda h: format(int(h) % 2**64, '016x'))
+
+def _splitArchive(text):
+    #split Hypoinverse archive text into (evid, block) pairs, each block 
+    #running from a header line to its terminator line; evid is read from
+    #the terminator. Lines outside a header..terminator block are kept as 
+    #blocks with evid None
+    blocks = []
+    current = []
+    for line in text.splitlines(True):
+        current.append(line)
+        if len(line.rstrip('\n')) == 72 and \
+        len(current[0].rstrip('\n')) == 164:
+            evid = line[62:72].strip()
+            blocks.append((int(evid) if evid.isdigit() else None, 
+                           ''.join(current)))
+            current = []
+        elif len(current) == 1 and len(line.rstrip('\n')) != 164:
+            blocks.append((None, line))
+            current = []
+    if current:
+        blocks.append((None, ''.join(current)))
+    return blocks
+
+def convertIncremental(dbid, dbfoldername, ffname, statefile=None, db=None,
+                       origin='prefor', **filters):
+    #Incremental version of convertCatalog for re-running on a database 
+    #that only gains or edits a few events. A fingerprint of each event's 
+    #rows (see eventFingerprints) is kept in statefile (default ffname + 
+    #'.state.json'). Only new or changed events are formatted: new events are
+    #appended to the archive ffname, changed events have their block 
+    #replaced in place and blocks of events no longer in the database are 
+    #removed. If nothing but new events is found the archive is only 
+    #appended to, otherwise it is rewritten through a temporary file.
+    #origin is as for convertCatalog, keyword filters are those of 
+    #selectEvents.
+    #Returns a dict with the number of new, changed, deleted and unchanged 
+    #events
+    
+    if db is None:
+        db = openDatabase(dbid, dbfoldername)
+    if statefile is None:
+        statefile = ffname + '.state.json'
+    
+    #previous fingerprints, only trusted while the archive still exists. 
+    #An archive without a state file (e.g. written by convertCatalog) is 
+    #seeded with the evids of its blocks and no fingerprint, so that its 
+    #events are replaced rather than appended a second time
+    oldprints = {}
+    if os.path.exists(statefile) and os.path.exists(ffname):
+        with open(statefile) as stfile:
+            oldprints = {int(evid): fprint for evid, fprint 
+                         in json.load(stfile)['events'].items()}
+    elif os.path.exists(ffname):
+        with open(ffname) as arcfile:
+            oldprints = {evid: None for evid, block 
+                         in _splitArchive(arcfile.read()) if evid is not None}
+    
+    catalog = joinTables(selectEvents(db, origin=origin, **filters), db, 
+                         origin=origin)
+    fingerprints = eventFingerprints(catalog)
+    newprints = {int(evid): fprint for evid, fprint in fingerprints.items()}
+    
+    added = [evid for evid in sorted(newprints) if evid not in oldprints]
+    changed = [evid for evid in sorted(newprints) 
+               if evid in oldprints and oldprints[evid] != newprints[evid]]
+    deleted = set(evid for evid in oldprints if evid not in newprints)
+    counts = {'new': len(added), 'changed': len(changed), 
+              'deleted': len(deleted), 
+              'unchanged': len(newprints) - len(added) - len(changed)}
+    
+    #format only the events that are new or changed
+    reftypes = _joinTypes(catalog, db)
+    groups = catalog.groupby('evid', sort=True).indices
+    newblocks = {}
+    for evid, lines in zip(added + changed, 
+                           _eventBlocks(catalog, groups, added + changed, 
+                                        reftypes)):
+        newblocks[evid] = ''.join(lines)
+    
+    if len(changed) == 0 and len(deleted) == 0:
+        with openSink(ffname, 'a') as sink:
+            for evid in added:
+                sink.writeEvent([newblocks[evid]])
+    else:
+        with open(ffname) as arcfile:
+            blocks = _splitArchive(arcfile.read())
+        tmpname = ffname + '.tmp'
+        with openSink(tmpname, 'w') as sink:
+            for evid, block in blocks:
+                if evid in deleted:
+                    continue
+                sink.writeEvent([newblocks.pop(evid, block)])
+            for evid in added + changed:
+                if evid in newblocks:
+                    sink.writeEvent([newblocks.pop(evid)])
+        os.replace(tmpname, ffname)
+    
+    with open(statefile + '.tmp', 'w') as stfile:
+        json.dump({'events': {str(evid): fprint for evid, fprint 
+                              in newprints.items()}}, stfile)
+    os.replace(statefile + '.tmp', statefile)
+    return counts
+
+WATCH_TABLES = ['event','origin','assoc','arrival']
+
+def _watchedEvids(db, newrows):
+    #evids touched by rows appended to the event, origin, assoc and arrival
+    #tables (newrows maps table name to the new rows)
+    evids = set(newrows['event'].evid) | set(newrows['origin'].evid)
+    orids = set(newrows['assoc'].orid)
+    arids = set(newrows['arrival'].arid)
+    if arids:
+        assoctbl = db.table('assoc')
+        orids |= set(assoctbl.orid[assoctbl.arid.isin(arids)])
+    if orids:
+        ortbl = db.table('origin')
+        evids |= set(ortbl.evid[ortbl.orid.isin(orids)])
+    return sorted(int(evid) for evid in evids)
+
+def _changedRows(oldtbl, newtbl):
+    #rows of dataframe newtbl that are not in oldtbl followed by the rows 
+    #of oldtbl that are not in newtbl, i.e. the rows added, removed or 
+    #edited when a table is reloaded
+    oldhash = pd.util.hash_pandas_object(oldtbl, index=False).values
+    newhash = pd.util.hash_pandas_object(newtbl, index=False).values
+    return pd.concat([newtbl[~np.isin(newhash, oldhash)], 
+                      oldtbl[~np.isin(oldhash, newhash)]], ignore_index=True)
+
+def watchDatabase(dbid, dbfoldername, ffname='-', spooldir=None, latency=1.0,
+                  maxpolls=None, emitexisting=False, db=None, 
+                  origin='prefor'):
+    #Long-running watch on a live Antelope database. Every latency seconds 
+    #the event, origin, assoc and arrival tables are checked for appended 
+    #rows (by file offset, see AntelopeDB.refresh) and only the new bytes 
+    #are parsed. Each event touched by new rows is converted again and its
+    #whole archive block written, either appended to ffname (a file name, 
+    #open stream or '-' for standard output, flushed after every event) or,
+    #if spooldir is given, to spooldir/<evid>.arc, replacing the previous 
+    #version of that event. An event updated several times therefore appears
+    #several times in a stream, the latest block being current.
+    #A table file that shrinks, changes without growing or is compressed is
+    #reloaded whole and compared with the rows held before, so the events 
+    #of edited or removed rows are written again too; rows edited in place
+    #in the same poll as rows are appended are not seen. 
+    #emitexisting=True first writes the events already in the database. 
+    #maxpolls stops after that many checks (default: run until 
+    #interrupted). origin is as for convertCatalog.
+    #Returns the number of event blocks written.
+    
+    if db is None:
+        db = openDatabase(dbid, dbfoldername)
+    for table in WATCH_TABLES:
+        db.refresh(table)
+    if spooldir is not None:
+        os.makedirs(spooldir, exist_ok=True)
     
-        #placeholder 0s or no weights(4) where no measurements available
-        #amp = writeLength(amp, "{:>7}".format(0))    
+    def emit(evids, sink):
+        evtbl = db.table('event')
+        catalog = joinTables(evtbl[evtbl.evid.isin(evids)], db, 
+                             origin=origin)
+        groups = catalog.groupby('evid', sort=True).indices
+        reftypes = _joinTypes(catalog, db)
+        nblocks = 0
+        for evid in evids:
+            lines = next(_eventBlocks(catalog, groups, [evid], reftypes), 
+                         [])
+            if len(lines) == 0:
+                continue
+            if spooldir is None:
+                sink.writeEvent(lines)
+            else:
+                spoolname = os.path.join(spooldir, str(evid) + '.arc')
+                with open(spoolname + '.tmp', 'w') as spoolfile:
+                    spoolfile.writelines(lines)
+                os.replace(spoolname + '.tmp', spoolname)
+            nblocks += 1
+        return nblocks
+    
+    nblocks = 0
+    polls = 0
+    with openSink(ffname if spooldir is None else io.StringIO(), 'a', 0) \
+    as sink:
+        if emitexisting:
+            nblocks += emit(sorted(set(db.table('event').evid)), sink)
+        while maxpolls is None or polls < maxpolls:
+            started = time.time()
+            newrows = {}
+            for table in WATCH_TABLES:
+                oldtbl = db.reported[table][2]
+                newrows[table] = db.refresh(table)
+                if newrows[table] is None:
+                    #compare with the rows held before the reload so the 
+                    #events of edited, added or removed rows are written 
+                    #again
+                    newrows[table] = _changedRows(oldtbl, db.table(table))
+                    logger.warning('Table %s was rewritten, reloaded it '
+                                   '(%d rows changed)', db.tablePath(table),
+                                   len(newrows[table]))
+            evids = _watchedEvids(db, newrows)
+            if evids:
+                nblocks += emit(evids, sink)
+            polls += 1
+            if maxpolls is None or polls < maxpolls:
+                time.sleep(max(0.0, latency - (time.time() - started)))
+    return nblocks
+
+def iterTableChunks(path, table, columns=None, chunkrows=100000):
+    #generator reading table at path in chunks of about chunkrows records,
+    #yielding each chunk as a dataframe (see parseRecords); compressed 
+    #tables are decompressed a chunk at a time
+    reclen = recordLength(table)
+    with openTable(path) as tablefile:
+        while True:
+            data = tablefile.read(chunkrows*(reclen + 1))
+            if not data:
+                break
+            if not data.endswith(b'\n'):
+                data += tablefile.readline()
+            chunk = parseRecords(data, table, columns)
+            if chunk is None:
+                raise ValueError('Table '+path+' does not have fixed-width '+\
+                'CSS3.0 records, cannot read it in chunks')
+            _count('tablerows', table, len(chunk))
+            yield chunk
+
+def _dumpPartition(path, rows):
+    #append a dataframe to a partition file; the file is opened for each 
+    #dump so the number of open files does not grow with the partitions
+    if len(rows) > 0:
+        with open(path, 'ab') as partfile:
+            pickle.dump(rows, partfile, pickle.HIGHEST_PROTOCOL)
+
+def _loadPartition(path, template):
+    #read back all dataframes dumped to a partition file and concatenate 
+    #them; template gives the columns and types of an empty partition
+    parts = []
+    if os.path.exists(path):
+        with open(path, 'rb') as partfile:
+            while True:
+                try:
+                    parts.append(pickle.load(partfile))
+                except EOFError:
+                    break
+    if len(parts) == 0:
+        return template
+    return pd.concat(parts, ignore_index=True)
+
+def convertCatalogStreaming(dbid, dbfoldername, ffname, maxmemory=256, 
+                            evids=None, db=None, buffersize=BUFFER_SIZE,
+                            tmpdir=None, origin='prefor', **filters):
+    #Streaming version of convertCatalog for databases whose assoc and 
+    #arrival tables do not fit in memory; output is the same. The small 
+    #tables (event, origin, snetsta, sitechan) are held in memory through 
+    #db while assoc and arrival are read in bounded chunks and spilled to 
+    #temporary partition files (in tmpdir) by event group:
+    #  1. assoc chunks are split by the group of their orid's event, and 
+    #     (arid, group) pairs are split by arid
+    #  2. arrival chunks are split by arid
+    #  3. each arid partition is joined to its pairs to send arrivals to the
+    #     event groups that need them
+    #  4. each event group is joined and written in turn, so its archive 
+    #     blocks are emitted as soon as the group is complete
+    #maxmemory (MB) bounds the chunk and group sizes, so peak memory does not
+    #grow with the size of the catalog. Only the assoc rows of the origins
+    #chosen by origin (see selectOrigins) are kept.
+    #Returns the number of events written.
+    
+    if db is None:
+        db = openDatabase(dbid, dbfoldername)
     
-        #ampunitcd = writeLength(ampunitcd, "{:>2}".format(0))
+    eventinfo = selectEvents(db, origin=origin, **filters)
+    if evids is None:
+        evids = sorted(set(eventinfo.evid))
+    else:
+        selected = set(eventinfo.evid)
+        evids = [evid for evid in dict.fromkeys(evids) if evid in selected]
+    eventinfo = eventinfo[eventinfo.evid.isin(evids)]
     
-        #durmagwtcode = writeLength(durmagwtcode, 4)
+    assocpath = db.tablePath('assoc')
+    arrivpath = db.tablePath('arrival')
+    assoccols = db.columns['assoc']
+    arrivcols = db.columns['arrival']
+    assoctemplate = parseRecords(b'', 'assoc', assoccols)
+    arrivtemplate = parseRecords(b'', 'arrival', arrivcols)
     
-        #codadur = writeLength(codadur, "{:>4}".format(0))    
+    #size chunks and event groups so one chunk plus one group of parsed 
+    #rows (about four times the text size) stays within maxmemory
+    maxbytes = maxmemory*1024*1024
+    rowbytes = 4*(recordLength('assoc') + recordLength('arrival'))
+    chunkrows = int(max(1000, maxbytes//(2*rowbytes)))
+    textbytes = tableSize(assocpath) + tableSize(arrivpath)
+    ngroups = max(1, int(np.ceil(4*textbytes/(maxbytes/2))))
+    ngroups = min(ngroups, max(1, len(evids)))
     
-        #durmag = writeLength(durmag, "{:>3}".format(0))
+    #event groups are contiguous runs of the output order
+    evgroup = pd.Series(np.arange(len(evids))*ngroups//max(1, len(evids)),
+                        index=evids)
+    ortbl = selectOrigins(eventinfo, db.table('origin'), origin)
+    ortbl = ortbl[ortbl.evid.isin(evids)]
+    orgroup = pd.Series(evgroup[ortbl.evid].values, index=ortbl.orid.values)
+    orgroup = orgroup[~orgroup.index.duplicated()]
+    
+    with tempfile.TemporaryDirectory(dir=tmpdir) as workdir:
+        def part(kind, ipart):
+            return os.path.join(workdir, kind + str(ipart))
         
-        #concat to single line
-        pline = statcode+statnet+wsp+comp1code+comp3code+wsp+prmk+pfm+\
-        pweightcode+pyr+pmdhm+psec+presid+normpwt+ssec+srmk+wsp+\
-        sweightcode+sresid+amp+ampunitcd+normswt+pdelay+sdelay+epidist+\
-        emang+ampmagwtcode+durmagwtcode+amppd+statrmk+codadur+azi2stat+\
-        durmag+ampmag+impP+impS+dscode+durmagcode+ampmagcode+statloccode+\
-        amptype+acomp3code+ampmagyn+durmagyn+'\n' 
+        #1. split assoc rows by event group and arid pairs by arid
+        row0 = 0
+        for chunk in iterTableChunks(assocpath, 'assoc', assoccols, chunkrows):
+            chunk['_row'] = np.arange(row0, row0 + len(chunk))
+            row0 += len(chunk)
+            chunk = chunk[chunk.orid.isin(orgroup.index)]
+            chunkgroup = orgroup[chunk.orid].values
+            for igroup in np.unique(chunkgroup):
+                _dumpPartition(part('assoc', igroup), 
+                               chunk[chunkgroup == igroup])
+            pairs = pd.DataFrame({'arid': chunk.arid.values, 
+                                  'group': chunkgroup}).drop_duplicates()
+            for ipart in np.unique(pairs.arid % ngroups):
+                _dumpPartition(part('pairs', ipart),
+                               pairs[pairs.arid % ngroups == ipart])
         
-        #write to event file
-        with open(ffname, 'a') as the_file:
-            if len(pline) != 121: #check that pick line is the correct length 
-                print('error:pick line is incorrect length, not writing pick'+\
-                'to file')        
-            else:
-                the_file.write(pline)
-                
-        #END OF LOOP FOR WRITING PICK LINES
+        #2. split arrival rows by arid
+        row0 = 0
+        for chunk in iterTableChunks(arrivpath, 'arrival', arrivcols, 
+                                     chunkrows):
+            chunk['_row'] = np.arange(row0, row0 + len(chunk))
+            row0 += len(chunk)
+            for ipart in np.unique(chunk.arid % ngroups):
+                _dumpPartition(part('arrivpart', ipart),
+                               chunk[chunk.arid % ngroups == ipart])
+        
+        #3. send arrival rows to the event groups that associate them
+        pairtemplate = pd.DataFrame({'arid': np.zeros(0, dtype='int64'),
+                                     'group': np.zeros(0, dtype='int64')})
+        arrivtemplate['_row'] = np.zeros(0, dtype='int64')
+        assoctemplate['_row'] = np.zeros(0, dtype='int64')
+        for ipart in range(ngroups):
+            pairs = _loadPartition(part('pairs', ipart), pairtemplate)
+            if len(pairs) == 0:
+                continue
+            arrivals = _loadPartition(part('arrivpart', ipart), arrivtemplate)
+            arrivals = arrivals.merge(pairs.drop_duplicates(), on='arid')
+            for igroup in np.unique(arrivals.group):
+                _dumpPartition(part('arrival', igroup), 
+                               arrivals[arrivals.group == igroup]\
+                               .drop(columns='group'))
+            os.remove(part('arrivpart', ipart))
+        
+        #4. join and write each event group
+        nevents = 0
+        with openSink(ffname, 'a', buffersize) as sink:
+            for igroup in range(ngroups):
+                groupevids = list(evgroup.index[evgroup.values == igroup])
+                assoctbl = _loadPartition(part('assoc', igroup), 
+                                          assoctemplate)
+                arrivtbl = _loadPartition(part('arrival', igroup), 
+                                          arrivtemplate)
+                assoctbl = assoctbl.sort_values('_row', kind='stable')
+                arrivtbl = arrivtbl.sort_values('_row', kind='stable')
+                assoctbl = assoctbl.drop(columns='_row')
+                arrivtbl = arrivtbl.drop(columns='_row')
                 
-            
-    #PART 3: TERMINATOR LINE
-    #initialize terminator line variables to correct length        
-    trialhrmin = wsp*4 #trial hour and minute (A4)
-    trialsec = wsp*4 #trial second (2I2)
-    triallatdeg = wsp*2 #trial latitude (F2.0)
-    triallatmin = wsp*4 #trial latitude minutes (F4.2)
-    triallongdeg = wsp*3 #trial longitude (F3.0)
-    triallongmin= wsp*4 #trial longitude minutes (F4.2)
-    trialdepth = wsp*5 #trial depth (F5.2)
-    trialidnum = wsp*10 #trial ID number (I10)
-    
-    #set variables to proper input parameters - just event ID for now
-    #this is being skipped because current documentation doesn't clearly 
-    #indicate if negative degree locations are appropriately considered by
-    #hypoinverse code when in terminator line; inputting preliminary origin
-    #in header line instead
-    
-    #trialhrmin = writeLength(trialhrmin,mdhm[4:])
-    #trialsec = writeLength(trialsec,ortime)
-    #triallatdeg = writeLength(triallatdeg,latdeg)
-    #triallatmin = writeLength(triallatmin,latmin)
-    #triallongdeg = writeLength(triallongdeg,londeg)
-    #triallongmin = writeLength(triallongmin,lonmin)
-    #trialdepth = writeLength(trialdepth,dep)
-    trialidnum = writeLength(trialidnum,evid)
-    
-
-    #concat to a single line
-    termline=wsp*6+trialhrmin+trialsec+triallatdeg+wsp+triallatmin+\
-    triallongdeg+wsp+triallongmin+trialdepth+wsp*28+trialidnum+'\n'  
-    
-    #write line to event file   
-    with open(ffname, 'a') as the_file:
-        if len(termline) != 73: #check that pick line is the correct length 
-            print('error: terminator line is incorrect length, not writing '+\
-            'to file') 
-        else:
-            the_file.write(termline)
+                tables = {'assoc': assoctbl, 'arrival': arrivtbl}
+                catalog = joinTables(eventinfo[eventinfo.evid.isin(groupevids)],
+                                     db, tables, origin)
+                #each group is widened by its own missing rows
+                reftypes = _joinTypes(catalog, db, tables)
+                nevents += _writeEvents(catalog, groupevids, reftypes, sink)
+                sink.flush()
+    return nevents
     
-    return
+#instrument type codes guessed from a text search of the instrument name,
+#first match wins. Note that this does not distinguish between inst types 1
+#and 3, 1 Hz L4C velocity transducers where one type has attenuation history
+#and the other has CAL factor history; defaults to type 1
+INSTRUMENT_TYPES = [('Wood-Anderson','0'), ('L4C','1'), ('Sprengnether','1'),
+                    ('Nanometrics','4'), ('Guralp','5'), ('STS-1','6'),
+                    ('STS-2','7')]
+
+#Hypoinverse station line
+STATION_LAYOUT = RecordLayout('station', [
+    ('sta', 5, 's', '<'), #station code (A5, 1X)
+    (None, 1, ' ', None),
+    ('net', 2, 's', '<'), #network code (A2, 1X)
+    (None, 1, ' ', None),
+    ('comp1', 1, 's', '<'), #station component code, 1 letter (A1)
+    ('comp3', 3, 's', '<'), #station component code, 3 letters (A3, 1X)
+    (None, 1, ' ', None),
+    ('weight', 1, 's', '<'), #station weight (A1)
+    ('latdeg', 2, 'i', '>'), #latitude in degrees (I2, 1X)
+    (None, 1, ' ', None),
+    ('latmin', 7, 'i', '>'), #latitude minutes (F7.4)
+    ('ns', 1, 's', '<'), #S for south (A1)
+    ('londeg', 3, 'i', '>'), #longitude in degrees (I3, 1X)
+    (None, 1, ' ', None),
+    ('lonmin', 7, 'i', '>'), #longitude minutes (F7.4)
+    ('ew', 1, 's', '<'), #E for east (A1)
+    ('elev', 4, 'i', '>'), #elevation in m (I4)
+    #period at which amplitude measured (F3.1, 2X), alternate crustal model
+    #and delay remark, P delays for sets 1 and 2 (F5.2, 1X) and amplitude 
+    #and duration magnitude corrections (F5.2, 1X) default to 0, uncertain 
+    #antelope table equivalent
+    (None, 3, '0.0', None),
+    (None, 4, ' '*4, None),
+    (None, 24, ' 0.00 '*4, None),
+    ('itype', 1, 's', '<'), #instrument type code (I1)
+    ('calib', 6, 's', '>'), #instrument calibration factor (F6.2)
+    #magnitude weights, 2 letter station code, alternate component code and
+    #negative depth flag are left blank
+    (None, 6, ' '*6, None),
+    (None, 1, '\n', None)], 87)
+
+def formatStationLines(stadb):
+    #Builds the Hypoinverse station line for every row of dataframe stadb 
+    #(the site/sitechan/sensor/instrument/snetsta join made in 
+    #writeSta2Hypoinverse) in one batch with STATION_LAYOUT.
+    #Returns a series of 87-character lines (including newline) indexed like
+    #stadb and a boolean mask of the lines that have the correct length
+    
+    if len(stadb) == 0:
+        empty = pd.Series([], dtype=object)
+        return empty, empty.astype(bool)
+    
+    #station component code is V for vertical channels, H otherwise
+    chan = np.asarray(stadb['chan'].values, dtype=str)
+    lat = stadb['lat'].values.astype(float)
+    lon = stadb['lon'].values.astype(float)
     
-def writeSta2Hypoinverse(dbid, dbfoldername, ffname, append_stations=False):
+    #instrument type code from the instrument name
+    insname = np.asarray(stadb['insname'].values, dtype=str)
+    itype = np.select([np.char.find(insname, name) >= 0
+                       for name, code in INSTRUMENT_TYPES],
+                      [code for name, code in INSTRUMENT_TYPES], default=' ')
+    
+    #instrument calibration factor based on ncalib value in table
+    ncalib = stadb['ncalib'].values.astype(float)
+    calib = np.where(np.isnan(ncalib), '0.0', 
+                     np.round(np.nan_to_num(ncalib)*100).astype('int64')\
+                     .astype(str))
+    
+    values = {'sta': stadb['sta'].values, 'net': stadb['net'].values,
+              'comp1': np.where(np.char.find(chan, 'Z') >= 0, 'V', 'H'),
+              'comp3': chan.astype('U3'),
+              'latdeg': np.floor(np.abs(lat)).astype('int64'),
+              'latmin': np.round(np.abs(lat) % 1*60*10000).astype('int64'),
+              'ns': 'S',
+              'londeg': np.floor(np.abs(lon)).astype('int64'),
+              'lonmin': np.round(np.abs(lon) % 1*60*10000).astype('int64'),
+              'ew': 'E',
+              'elev': np.trunc(stadb['elev'].values.astype(float)*1000)\
+              .astype('int64'),
+              'itype': itype, 'calib': calib}
+    where = {'ns': lat < 0, 'ew': lon > 0}
+    staline, rejected = STATION_LAYOUT.lines(values, len(stadb), where)
+    _reportRejected(rejected, 'station')
+    
+    staline = pd.Series(staline, index=stadb.index, dtype=object)
+    return staline, staline.str.len() == 87
+
+def writeSta2Hypoinverse(dbid, dbfoldername, ffname, append_stations=False,
+                         db=None, buffersize=BUFFER_SIZE, jdate=None):
     #function uses Antelope tables to write a hypoinverse station file
     #dbid is the name of the database within working directory that holds
     #the antelope tables
@@ -424,203 +2548,954 @@ def writeSta2Hypoinverse(dbid, dbfoldername, ffname, append_stations=False):
     #ffname is the name of the station file to write to
     #append stations is a T/F variable to indicate whether to append to file
     #ffname (True) or to over-write ffname (False)
-
-    stadb = [] #initialize master station dataframe
-    newlines = [] #initialize variable to test for duplicate station lines    
+    #db is an optional AntelopeDB handle, see getData
+    #ffname may also be an open file, '-' for standard output or an 
+    #OutputSink; lines are written through one buffer of buffersize chars
+    #jdate (YYYYDDD) limits the file to channels operating on that date; by
+    #default every sitechan epoch is written, with the site and sensor 
+    #epochs active when the channel epoch starts
     
-    #Paths to antelope tables with station data
-    pathnetwktbl = dbfoldername + '/' + dbid + '.snetsta'
-    pathinsttbl = dbfoldername + '/' + dbid + '.instrument'
-    pathsensortbl = dbfoldername + '/' + dbid + '.sensor'
-    pathsitetbl = dbfoldername + '/' + dbid + '.site'
-    pathsitechantbl = dbfoldername + '/' + dbid + '.sitechan'
-    pathinsttbl = dbfoldername + '/' + dbid + '.instrument'
+    if db is None:
+        db = openDatabase(dbid, dbfoldername)
     
     if append_stations==False:
         openvar = 'w'
     else:
         openvar = 'a'
-        
+    
+    stadb = joinStations(db, jdate)
+    _writeStationLines(stadb, ffname, openvar, buffersize)
+    return stadb
+
+def joinStations(db, jdate=None):
+    #joins the site, sitechan, sensor, instrument and snetsta tables of 
+    #AntelopeDB db into one row per station line, see writeSta2Hypoinverse
+    
     #load and join tables into a single dataframe
-    sitetbl = pd.read_fwf(pathsitetbl,header=None,colspecs='infer',
-                          names=['sta','ondate','offdate','lat','lon',
-                                 'elev','staname','statype','refsta',
-                                 'dnorth','deast','lddate'])
-    sitechantbl = pd.read_csv(pathsitechantbl,header=None,
-                              delim_whitespace=True,names=['sta','chan',
-                              'ondate','chanid','offdate','ctype','edepth',
-                              'hang','vang','descrip','lddate'])
-    sensortbl = pd.read_fwf(pathsensortbl,header=None,colspecs='infer',
-                            names=['sta','chan','time','endtime','inid',
-                                   'chanid','jdate','calratio','calper',
-                                   'tshift','instant','lddate'])
-    insttbl = pd.read_fwf(pathinsttbl,header=None,colspecs='infer',
-                          names=['inid','insname','instype','band','digital',
-                                 'samprate','ncalib','ncalper','dir','dfile',
-                                 'rsptype','lddate'])
-    nettbl = pd.read_fwf(pathnetwktbl,header=None,colspecs='infer',
-                         names=['net','sta','staid','lddate'])
+    sitetbl = db.table('site')
+    sitechantbl = db.table('sitechan')
+    sensortbl = db.table('sensor')
+    insttbl = db.table('instrument')
+    nettbl = db.table('snetsta')
                                     
-    stadb = pd.merge(sitetbl,sitechantbl,on='sta',how='left',
-                     suffixes=['','_chan'])
-    #if sensor type changes during deployment then this may add rows
-    stadb = stadb.merge(sensortbl,on=['sta','chan'],
-                        how='left',suffixes=['','_sens'])
-    stadb = stadb.merge(insttbl,on='inid',how='left',suffixes=['','_inst'])                                
-    stadb = stadb.merge(nettbl,on='sta',how='left',suffixes=['','_netwk'])
-    
-    #loop through stations and write station into for file ffname
-    for iind,erow in stadb.iterrows():
-        #initialize properly-lengthed variables for Hypoinverse station file
-        wsp = ' '    
-        statcode = wsp*5 #left justified 5 letter station code (A5, 1X)
-        statnet = wsp*2 #seismic network code (A2, 1X)
-        comp1code = wsp*1 #station component code 1 letter (A1)
-        comp3code = wsp*3 #station component code 3 letter (A3, 1X)
-        statweight = wsp*1 #station weight (A1)    
-        latdeg = wsp*2 #latitude in degrees (I2, 1X)    
-        latmin = wsp*7 #latitude in minutes (F7.4)
-        ns = wsp*1 #blank for N, S for south (A1)
-        longdeg = wsp*3 #longitude in degrees (I3,1X)
-        longmin = wsp*7 #longitude in minutes (F7.4)
-        ew = wsp*1 #blank for W, E for east (A1)
-        elev = wsp*4 #elevation in m (I4)
-        amppd = wsp*3 #period at which station amplitude measured (F3.1,2X)    
-        altcrust = wsp*1 #2 or A indicates using an alternate crustal model(A1)
-        stadelayrmk = wsp*1 #optional station delay remark (A1)
-        pdelay1 = wsp*5 #P delay (s) for set 1 (F5.2, 1X)
-        pdelay2= wsp*5 #P delay (s) for set 2 (F5.2, 1X)
-        ampmagadj = wsp*5 #amplitude magnitude correction (F5.2)
-        ampmagwt = wsp*1 #amplitude magnitude weight (A1)
-        durmagadj = wsp*5 #duration magnitude correction (F5.2)
-        durmagwt = wsp*1 #duration magnitude weight (A1)
-        itype = wsp*1 #instrument type code (I1)
-        icalib = wsp*6 #instrument calibration factor (F6.2)
-        sta2code = wsp*2 #2 letter station code (A2)
-        sta3altcode = wsp*3 #3 letter alternate component code (A3)
-        negdep = wsp*1 #make depth negative regardless of sign (A1)
-        
-        #set station line variables using data from tables
-        statcode = writeLength(statcode,"{:<5}".format(erow['sta']))
-        
-        statnet = writeLength(statnet,"{:<2}".format(erow['net']))
-        
-        if 'Z' in erow['chan']:
-            comp1code = writeLength(comp1code,'V')
+    with _stage('station join'):
+        #channel epochs to write and the date each one is resolved on
+        if jdate is None:
+            dates = sitechantbl['ondate'].values
         else:
-            comp1code = writeLength(comp1code,'H')
-                
-        comp3code = writeLength(comp3code,"{:<3}".format(erow['chan'][:3]))
+            #channels without an epoch active on jdate are dropped
+            chanrow = EpochIndex.fromTable(sitechantbl, ['sta','chan'], 
+                                           'ondate', 'offdate').active(
+                keyValues(sitechantbl, ['sta','chan']), 
+                np.full(len(sitechantbl), jdate))
+            sitechantbl = sitechantbl.iloc[chanrow[chanrow >= 0]]
+            sitechantbl = sitechantbl.drop_duplicates()
+            dates = np.full(len(sitechantbl), jdate)
     
-        latdeg = writeLength(latdeg,\
-        "{:>2}".format(int(np.floor(abs(erow['lat'])))))    
-        
-        if erow['lat'] < 0:
-            ns = writeLength(ns,'S')
-            
-        latmin = writeLength(latmin,"{:>7}".format(\
-        int(np.round(abs(erow['lat']%1)*60*10000))))
-        
-        longdeg = writeLength(longdeg,\
-        "{:>3}".format(int(np.floor(abs(erow['lon'])))))   
-        
-        if erow['lon'] > 0:
-            ew = writeLength(ew,'E')
+        #site epoch of each channel epoch, channels without a site are dropped
+        siterow = EpochIndex.fromTable(sitetbl, ['sta'], 'ondate', 'offdate')\
+        .active(sitechantbl['sta'].values, dates)
+        order = np.argsort(siterow, kind='stable')
+        order = order[siterow[order] >= 0]
+        _count('skipped', 'station: no site epoch', len(siterow) - len(order))
+        sitechantbl = sitechantbl.iloc[order]
+        dates = dates[order]
+        stadb = _attachRows(sitetbl.iloc[siterow[order]], sitechantbl, 
+                            np.arange(len(sitechantbl)), ['sta'], '_chan')
+        _count('mergerows', 'station site', len(stadb))
     
-        longmin = writeLength(longmin,"{:>7}".format(\
-        int(np.round(abs(erow['lon'])%1*60*10000))))
-        
-        elev = writeLength(elev,"{:>4}".format(int(erow['elev']*1000)))
-        
-        #instrument type code - does a text search to guess instrument type
-        #note that this does not distinguish between inst types 1 and 3, 1 Hz
-        #L4C velocity transducers where one type has attenuation history and  
-        #the other has CAL factor history; defaults to type 1
-        if str(erow['insname']).find('Wood-Anderson')>-1:
-            itype = writeLength(itype,0)
-        elif str(erow['insname']).find('L4C')>-1:
-            itype = writeLength(itype,1)
-        elif str(erow['insname']).find('Sprengnether')>-1:
-            itype = writeLength(itype,1)
-        elif str(erow['insname']).find('Nanometrics')>-1:
-            itype = writeLength(itype,4)
-        elif str(erow['insname']).find('Guralp')>-1:
-            itype = writeLength(itype,5)
-        elif str(erow['insname']).find('STS-1')>-1:
-            itype = writeLength(itype,6)
-        elif str(erow['insname']).find('STS-2')>-1:
-            itype = writeLength(itype,7)
-        
-        #calib factor -- based on ncalib value in table  
-        if np.isnan(erow['ncalib']) == False:        
-            icalib = writeLength(icalib,"{:>6}".format(\
-            int(round(erow['ncalib']*100))))
+        #sensor (and so instrument) in place on the channel date, the sensor 
+        #may change during a deployment
+        sensorrow = EpochIndex.fromTable(sensortbl, ['sta','chan'], 'time', 
+                                         'endtime')\
+        .active(keyValues(stadb, ['sta','chan']), 
+                jdateToEpoch(dates) + 86399.0)
+        stadb = _attachRows(stadb, sensortbl, sensorrow, ['sta','chan'], 
+                            '_sens')
+        stadb = stadb.merge(insttbl,on='inid',how='left',
+                            suffixes=['','_inst'])                                
+        _count('mergerows', 'station instrument', len(stadb))
+        stadb = stadb.merge(nettbl,on='sta',how='left',suffixes=['','_netwk'])
+        _count('mergerows', 'station snetsta', len(stadb))
+    return stadb
+
+def _writeStationLines(stadb, ffname, openvar, buffersize):
+    #format all station lines of joined stations stadb at once, then write
+    #them to file ffname (opened with mode openvar) without duplicates
+    with _stage('station format'):
+        stalines, stalineok = formatStationLines(stadb)
+    if len(stalines) == 0:
+        return
+    
+    #drop lines that duplicate one already written, keeping the first
+    duplicate = stalines.duplicated(keep='first').values
+    if duplicate.any():
+        logger.info('%d station line duplicates not written to station file',
+                    duplicate.sum())
+        _count('skipped', 'station: duplicate', duplicate.sum())
+        stalines = stalines[~duplicate]
+        stalineok = stalineok[~duplicate]
+    
+    #check station lines are the correct length
+    if not stalineok.all():
+        logger.error('%d station lines are incorrect length, not writing '
+                     'them to file', (~stalineok).sum())
+        _count('skipped', 'station: incorrect length', (~stalineok).sum())
+    
+    with openSink(ffname, openvar, buffersize) as sink:
+        sink.writelines(stalines[stalineok])
+    _count('counters', 'station lines written', stalineok.sum())
+
+def writeStations(dbs, ffname, append_stations=False, buffersize=BUFFER_SIZE,
+                  jdate=None):
+    #writes one Hypoinverse station file for several databases: the station
+    #tables of each AntelopeDB of dbs are joined as in writeSta2Hypoinverse
+    #and every line is written once, however many databases hold it.
+    #Returns the joined station dataframe of all the databases
+    stadb = pd.concat([joinStations(db, jdate) for db in dbs], 
+                      ignore_index=True)
+    _writeStationLines(stadb, ffname, 'a' if append_stations else 'w', 
+                       buffersize)
+    return stadb
+
+def convertDatabases(databases, ffname, stafile=None, order='time', 
+                     origin='prefor', buffersize=BUFFER_SIZE, jdate=None,
+                     cachedir=None, **filters):
+    #converts several Antelope databases in one run. databases is a list of
+    #(dbfoldername, dbid) pairs, opened with openDatabase (and cachedir, 
+    #see AntelopeDB); a table file shared by databases is parsed once.
+    #If stafile is given the station tables of all the databases are 
+    #written to it as one station file (over-writing it, see writeStations).
+    #Each catalog is joined once as in convertCatalog and the events of all
+    #the databases are appended to ffname through one OutputSink, ordered 
+    #by origin time (order='time', the default) or by evid (order='evid'),
+    #ties going to the database listed first. An event block identical to
+    #one already written (the same event in two databases) is written 
+    #once; a different event reusing an evid is written and logged, as the
+    #id no longer identifies one event in the archive.
+    #origin and the keyword filters of selectEvents apply to every 
+    #database. Returns the number of events written
+    dbs = [openDatabase(dbid, dbfoldername, cachedir=cachedir) 
+           for dbfoldername, dbid in databases]
+    if stafile is not None:
+        writeStations(dbs, stafile, buffersize=buffersize, jdate=jdate)
+    
+    #join every catalog, then sort the events of all of them together on
+    #(origin time or evid, database number, evid)
+    catalogs = []
+    sortkeys, numbers, evids = [], [], []
+    for number, db in enumerate(dbs):
+        catalog = joinTables(selectEvents(db, origin=origin, **filters), 
+                             db, origin=origin)
+        groups = catalog.groupby('evid', sort=True).indices
+        catalogs.append((catalog, groups, _joinTypes(catalog, db)))
+        if order == 'time':
+            ortimes = catalog.groupby('evid', sort=True)['time'].min()
+            sortkeys.append(ortimes.values.astype(float))
+            evids.append(ortimes.index.values)
+        elif order == 'evid':
+            evids.append(np.array(sorted(groups), dtype='int64'))
+            sortkeys.append(evids[-1].astype(float))
         else:
-            icalib = writeLength(icalib,"{:>6}".format(0.0))
-        
-        #these variables default to 0, uncertain antelope table equivalent
-        amppd = writeLength(amppd,"0.0")    
-        pdelay1 = writeLength(pdelay1," 0.00")    
-        pdelay2 = writeLength(pdelay2," 0.00")
-        ampmagadj = writeLength(ampmagadj," 0.00")
-        durmagadj = writeLength(durmagadj," 0.00")
-        
-        #concat variables to a single line
-        staline = statcode+wsp+statnet+wsp+comp1code+comp3code+wsp+statweight+\
-        latdeg+wsp+latmin+ns+longdeg+wsp+longmin+ew+elev+amppd+wsp*2+altcrust+\
-        stadelayrmk+pdelay1+wsp+pdelay2+wsp+ampmagadj+ampmagwt+durmagadj+\
-        durmagwt+itype+icalib+sta2code+sta3altcode+negdep+'\n'
-    
-        #check that the line is not a duplicate already written to file
-        if staline not in newlines:            
-            newlines.append(staline)
-            
-            #write line to file and add to newlines
-            with open(ffname, openvar) as the_file:
-                if len(staline) != 87: #check pick line is the correct length 
-                    print(len(staline))
-                    print('error: terminator line is incorrect length, '+ \
-                    'not writing to file\n') 
-                else:
-                    the_file.write(staline)
-        
+            raise ValueError('order must be evid or time, not '+str(order))
+        numbers.append(np.full(len(evids[-1]), number))
+    sortkeys, numbers, evids = [np.concatenate(values) if values else 
+                                np.array([]) for values in 
+                                [sortkeys, numbers, evids]]
+    ranks = np.lexsort((evids, numbers, sortkeys))
+    numbers, evids = numbers[ranks].astype('int64'), evids[ranks].tolist()
+    
+    #one block generator per database, each given its events in the 
+    #merged order and read from in turn
+    blocks = [_eventBlocks(catalog, groups, 
+                           [evid for evid, n in zip(evids, numbers) 
+                            if n == number], reftypes)
+              for number, (catalog, groups, reftypes) in enumerate(catalogs)]
+    written = {} #evid -> SHA-256 digests of the blocks written for it
+    nevents = 0
+    with openSink(ffname, 'a', buffersize) as sink:
+        for evid, number in zip(evids, numbers):
+            lines = next(blocks[number])
+            if len(lines) == 0:
+                continue
+            blockhash = hashlib.sha256(''.join(lines).encode()).digest()
+            if blockhash in written.get(evid, ()):
+                logger.info('Event %s of %s is already written', evid, 
+                            '/'.join(databases[number]))
+                _count('skipped', 'event: duplicate')
+                continue
+            if evid in written:
+                logger.warning('Event %s of %s differs from an event with '
+                               'the same id already written', evid, 
+                               '/'.join(databases[number]))
+            written.setdefault(evid, set()).add(blockhash)
+            sink.writeEvent(lines)
+            nevents += 1
+    return nevents
+
+#archive line layouts by line length (including the newline)
+ARCHIVE_LAYOUTS = {layout.length: layout for layout in
+                   [HEADER_LAYOUT, PICK_LAYOUT, TERMINATOR_LAYOUT]}
+PARSE_BATCH = 65536 #lines gathered from the file at a time by HypoFile.parse
+PROBLEM_COLUMNS = ['kind', 'field', 'archive', 'source']
+
+class HypoFile(object):
+    #Read-only memory map of a Hypoinverse archive or station file. Opening
+    #it only finds the byte offset of every line (one scan for newlines, a
+    #chunk of the map at a time); fields are parsed from the map when asked
+    #for with the RecordLayout that wrote them, so a file of many GB is
+    #never read into memory whole. starts and lengths hold the offset and
+    #length (including the newline) of every line. Usable as a context
+    #manager, close() releases the map.
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        except ValueError: #an empty file cannot be mapped
+            self.map = b''
+        self.buf = np.frombuffer(self.map, dtype=np.uint8)
+        self.starts = _lineStarts(self.buf)
+        self.lengths = np.diff(np.append(self.starts, len(self.buf)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.buf = None
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+        self.file.close()
+
+    def text(self, start, end):
+        #text of the file from byte start to byte end
+        return self.map[start:end].decode('utf-8', 'replace')
+
+    def parse(self, lines, layout, names=None):
+        #fields of lines (line numbers of lines of layout.length characters)
+        #as a dict of field name -> array, see RecordLayout.parse
+        lines = np.asarray(lines, dtype='int64')
+        columns = np.arange(layout.length)
+        parts = [layout.parse(np.empty((0, layout.length), np.uint8), names)]
+        for first in range(0, len(lines), PARSE_BATCH):
+            rows = self.starts[lines[first:first + PARSE_BATCH], None]
+            parts.append(layout.parse(self.buf[rows + columns], names))
+        return {fname: np.concatenate([part[fname] for part in parts])
+                for fname in parts[0]}
+
+def _lineStarts(buf, chunksize=1 << 26):
+    #byte offset of the start of every line of array buf, searched for
+    #newlines chunksize bytes at a time
+    starts = [np.zeros(1, dtype='int64')]
+    for pos in range(0, len(buf), chunksize):
+        newlines = np.flatnonzero(buf[pos:pos + chunksize] == ord('\n'))
+        starts.append(newlines.astype('int64') + pos + 1)
+    starts = np.concatenate(starts)
+    return starts[starts < len(buf)]
+
+def hypoEpochs(year, mdhm, centisec):
+    #epoch times (s) of Hypoinverse year, month-day-hour-minute and
+    #hundredths of second fields, the reverse of hypoTimes. Fields may be
+    #numbers or strings; the time is NaN where a field is blank or the date
+    #is not valid
+    year = np.asarray(year, dtype=float)
+    mdhm = pd.to_numeric(np.asarray(mdhm), errors='coerce').astype(float)
+    centisec = np.asarray(centisec, dtype=float)
+    bad = np.isnan(year) | np.isnan(mdhm) | np.isnan(centisec)
+    mdhm = np.nan_to_num(mdhm).astype('int64')
+    month = mdhm//1000000
+    day = mdhm//10000 % 100
+    bad |= (month < 1) | (month > 12) | (day < 1) | (day > 31)
+    months = (np.nan_to_num(year).astype('int64') - 1970)*12 + month - 1
+    days = months.astype('datetime64[M]').astype('datetime64[D]')\
+    .astype('int64') + day - 1
+    minutes = (days*24 + mdhm//100 % 100)*60 + mdhm % 100
+    return np.where(bad, np.nan, minutes*60 + centisec/100)
+
+def _writtenCodes(values, width):
+    #codes as written to a string field of width characters, which is left
+    #blank for codes that are too long (see RecordLayout)
+    values = np.asarray(values, dtype=str)
+    return np.where(np.char.str_len(values) <= width, values, '')
+
+def _problems(kind, keys, field='', archive='', source='', keyname='evid'):
+    #dataframe of problems found by verifyArchive or verifyStations, one
+    #row per entry of keys (event ids or station codes); the other
+    #arguments are a value for every row or an array of one per row
+    problems = pd.DataFrame({keyname: np.asarray(keys)},
+                            columns=[keyname] + PROBLEM_COLUMNS)
+    for col, value in zip(PROBLEM_COLUMNS, [kind, field, archive, source]):
+        problems[col] = value if np.ndim(value) == 0 else list(value)
+    return problems
+
+class HypoArchive(HypoFile):
+    #Hypoinverse archive file (see convertCatalog) opened as a HypoFile,
+    #with an index of its event blocks. A block starts at a header line and
+    #runs to the next header; its event id is the header evid, or the id of
+    #its terminator line where the header one is blank (-1 if neither is
+    #readable). blocks (line number of the header), offsets and ends (byte
+    #range) and evids have an entry per block in file order.
+    #event(evid) returns the text of one event from the byte offset index
+    #without reading the rest of the file; an event written more than once
+    #(e.g. appended again by a later run) is found at its last block.
+
+    def __init__(self, path):
+        HypoFile.__init__(self, path)
+        self.blocks = np.flatnonzero(self.lengths == HEADER_LAYOUT.length)
+        self.offsets = self.starts[self.blocks]
+        self.ends = np.append(self.offsets[1:], len(self.buf))
+        lastlines = np.append(self.blocks[1:], len(self.starts)) - 1
+
+        #event id of each block from the header, else the terminator
+        self.headerids = self.parse(self.blocks, HEADER_LAYOUT,
+                                    ['evid'])['evid']
+        self.terminated = self.lengths[lastlines] == TERMINATOR_LAYOUT.length
+        self.termids = np.full(len(self.blocks), np.nan)
+        self.termids[self.terminated] = self.parse(
+            lastlines[self.terminated], TERMINATOR_LAYOUT,
+            ['trialidnum'])['trialidnum']
+        evids = np.where(np.isnan(self.headerids), self.termids,
+                         self.headerids)
+        self.evids = np.nan_to_num(evids, nan=-1).astype('int64')
+
+        #blocks sorted by event id for lookups, later blocks of an event
+        #after earlier ones
+        self.order = np.argsort(self.evids, kind='stable')
+        self.sortedids = self.evids[self.order]
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __contains__(self, evid):
+        return self.find(evid) >= 0
+
+    def find(self, evid):
+        #number of the (last) block of event evid, -1 if it is not in the
+        #file
+        i = np.searchsorted(self.sortedids, evid, side='right') - 1
+        if i < 0 or self.sortedids[i] != evid:
+            return -1
+        return self.order[i]
+
+    def event(self, evid):
+        #archive lines (header, picks, terminator) of event evid as text
+        block = self.find(evid)
+        if block < 0:
+            raise KeyError('event '+str(evid)+' is not in '+str(self.path))
+        return self.text(self.offsets[block], self.ends[block])
+
+    def latest(self):
+        #numbers of the last block of every event id, in file order
+        last = np.append(self.sortedids[1:] != self.sortedids[:-1], True)
+        return np.sort(self.order[last[:len(self.order)]])
+
+    def headers(self, blocks=None):
+        #dataframe of the header fields of blocks (default: all, in file
+        #order) with the block number, its event id and the decoded origin
+        #time (epoch s), lat, lon and depth (km)
+        if blocks is None:
+            blocks = np.arange(len(self.blocks))
+        fields = self.parse(self.blocks[blocks], HEADER_LAYOUT)
+        headers = pd.DataFrame(fields)
+        headers['evid'] = self.evids[blocks]
+        headers.insert(0, 'block', blocks)
+        headers['time'] = hypoEpochs(fields['year'], fields['mdhm'],
+                                     fields['ortime'])
+        headers['lat'] = (fields['latdeg'] + fields['latmin']/6000)*\
+        np.where(fields['ns'] == 'S', -1, 1)
+        headers['lon'] = (fields['londeg'] + fields['lonmin']/6000)*\
+        np.where(fields['ew'] == 'E', 1, -1)
+        headers['depth'] = fields['dep']/100
+        return headers
+
+    def picks(self, blocks=None):
+        #dataframe of the pick lines of blocks (default: all) with their
+        #line number, block number, event id, phase (P or S from the
+        #column holding the second, blank for neither) and decoded time
+        #(epoch s, to the minute for other phases)
+        lines = np.flatnonzero(self.lengths == PICK_LAYOUT.length)
+        lineblocks = np.searchsorted(self.blocks, lines, side='right') - 1
+        keep = lineblocks >= 0
+        if blocks is not None:
+            keep &= np.isin(lineblocks, blocks)
+        lines, lineblocks = lines[keep], lineblocks[keep]
+        fields = self.parse(lines, PICK_LAYOUT)
+        picks = pd.DataFrame(fields)
+        picks.insert(0, 'line', lines)
+        picks.insert(1, 'block', lineblocks)
+        picks.insert(2, 'evid', self.evids[lineblocks])
+        isP, isS = ~np.isnan(fields['psec']), ~np.isnan(fields['ssec'])
+        picks['phase'] = np.select([isP, isS], ['P', 'S'], default='')
+        picks['time'] = hypoEpochs(fields['year'], fields['mdhm'],
+                                   np.select([isP, isS], [fields['psec'],
+                                   fields['ssec']], default=0))
+        return picks
+
+    def check(self):
+        #structural problems of the file, as a dataframe of verifyArchive:
+        #lines that are not a header, pick or terminator, lines before the
+        #first header, terminators inside a block, blocks without a
+        #terminator and terminator ids that differ from the header evid
+        problems = []
+        lineblocks = np.searchsorted(self.blocks, np.arange(len(self.starts)),
+                                     side='right') - 1
+        lineevids = np.where(lineblocks >= 0, self.evids[lineblocks], -1)
+        known = np.isin(self.lengths, list(ARCHIVE_LAYOUTS))
+        lines = np.flatnonzero(~known)
+        problems.append(_problems('malformed line', lineevids[lines], 'line',
+                                  lines + 1, self.lengths[lines] - 1))
+        lines = np.flatnonzero(known & (lineblocks < 0))
+        problems.append(_problems('line outside event', lineevids[lines],
+                                  'line', lines + 1))
+        lastlines = np.append(self.blocks[1:], len(self.starts)) - 1
+        lines = np.flatnonzero(self.lengths == TERMINATOR_LAYOUT.length)
+        lines = lines[~np.isin(lines, lastlines)]
+        problems.append(_problems('misplaced terminator', lineevids[lines],
+                                  'line', lines + 1))
+        problems.append(_problems('missing terminator',
+                                  self.evids[~self.terminated]))
+        differ = self.terminated & ~np.isnan(self.headerids) & \
+        (self.termids != self.headerids)
+        problems.append(_problems('terminator', self.evids[differ],
+                                  'trialidnum', self.termids[differ],
+                                  self.headerids[differ]))
+        return pd.concat(problems, ignore_index=True)
+
+class HypoStations(HypoFile):
+    #Hypoinverse station file (see writeSta2Hypoinverse) opened as a
+    #HypoFile
+
+    def stations(self):
+        #dataframe of the fields of every station line with its line number
+        #and the decoded lat, lon (degrees) and elev (m)
+        lines = np.flatnonzero(self.lengths == STATION_LAYOUT.length)
+        fields = self.parse(lines, STATION_LAYOUT)
+        stations = pd.DataFrame(fields)
+        stations.insert(0, 'line', lines)
+        stations['lat'] = (fields['latdeg'] + fields['latmin']/600000)*\
+        np.where(fields['ns'] == 'S', -1, 1)
+        stations['lon'] = (fields['londeg'] + fields['lonmin']/600000)*\
+        np.where(fields['ew'] == 'E', 1, -1)
+        return stations
+
+    def check(self):
+        #lines that are not station lines, as a dataframe of verifyStations
+        lines = np.flatnonzero(self.lengths != STATION_LAYOUT.length)
+        return _problems('malformed line', np.full(len(lines), ''), 'line',
+                         lines + 1, self.lengths[lines] - 1, keyname='sta')
+
+def verifyArchive(arcfile, dbid, dbfoldername, db=None, evids=None,
+                  origin='prefor', **filters):
+    #Round-trip check of the Hypoinverse archive arcfile (a file name or
+    #HypoArchive) against the Antelope tables it was converted from. The
+    #events convertCatalog would write for the same evids, origin and
+    #selectEvents filters are joined once and compared with the decoded
+    #archive: that every event is written once, the header origin time
+    #(to the hundredth of a second), lat and lon (to the written hundredth
+    #of a minute), depth and number of phases, and the station, phase and
+    #time of every operational pick. An event written more than once is
+    #compared at its last block.
+    #Returns a dataframe with a row per problem (columns evid, kind, field,
+    #archive and source values), including those of HypoArchive.check; it
+    #is empty when the archive matches the tables
+    if db is None:
+        db = openDatabase(dbid, dbfoldername)
+    if isinstance(arcfile, HypoArchive):
+        archive = arcfile
+    else:
+        archive = HypoArchive(arcfile)
+
+    try:
+        with _stage('verify'):
+            problems = [archive.check()]
+            eventinfo = selectEvents(db, origin=origin, **filters)
+            if evids is not None:
+                eventinfo = eventinfo[eventinfo.evid.isin(list(evids))]
+            catalog = joinTables(eventinfo, db, origin=origin)
+
+            #events in the tables and the archive
+            blocks = archive.latest()
+            headers = archive.headers(blocks)
+            #events without an origin are not written (see formatBlock)
+            sourceids = np.unique(catalog['evid'].values[
+                catalog['time'].notna().values])
+            problems.append(_problems('missing event',
+                            np.setdiff1d(sourceids, headers['evid'].values)))
+            problems.append(_problems('extra event',
+                            np.setdiff1d(headers['evid'].values, sourceids)))
+
+            #header values against the first joined row of each event,
+            #which is the row formatBlock writes
+            headers = headers[headers['evid'].isin(sourceids)]
+            evids = headers['evid'].values
+            source = catalog.drop_duplicates('evid').set_index('evid')\
+            .loc[evids]
+            sourcetime = source['time'].values.astype(float)
+            nass = source['nass'].values.astype(float)
+            numt = pd.to_numeric(headers['numt'].values, errors='coerce')
+            tolerance = 0.005/60 + 1e-9
+            for field, archived, expected, same in [
+                    ('time', headers['time'].values, sourcetime,
+                     np.round(headers['time'].values*100) ==
+                     np.floor(sourcetime)*100 + np.round(sourcetime % 1*100)),
+                    ('lat', headers['lat'].values, source['lat'].values,
+                     np.abs(headers['lat'].values - source['lat'].values) <=
+                     tolerance),
+                    ('lon', headers['lon'].values, source['lon'].values,
+                     np.abs(headers['lon'].values - source['lon'].values) <=
+                     tolerance),
+                    ('depth', headers['depth'].values, source['depth'].values,
+                     np.abs(headers['depth'].values -
+                            source['depth'].values) <= 0.005 + 1e-9),
+                    ('numt', numt, nass, (numt == nass) |
+                     (np.isnan(numt) & np.isnan(nass)))]:
+                problems.append(_problems('header', evids[~same], field,
+                                          archived[~same], expected[~same]))
+
+            #picks, compared as counts of (evid, sta, phase, time) so a
+            #pick written twice or not at all is found
+            picks = archive.picks(blocks)
+            picks = picks[picks['evid'].isin(sourceids)]
+            expected = catalog[operationalPicks(catalog)]
+            expected = expected[expected['evid'].isin(evids)]
+            iphase = expected['iphase'].values
+            centisec = expected['time_arriv'].values.astype(float)
+            centisec = np.floor(centisec)*100 + np.round(centisec % 1*100)
+            isPS = (iphase == 'P') | (iphase == 'S')
+            keys = ['evid', 'sta', 'phase', 'centisec']
+            expected = pd.DataFrame({
+                'evid': expected['evid'].values,
+                'sta': _writtenCodes(expected['sta'].values, 5),
+                'phase': np.where(isPS, iphase, ''),
+                'centisec': np.where(isPS, centisec,
+                                     centisec - centisec % 6000)})
+            archived = pd.DataFrame({
+                'evid': picks['evid'].values, 'sta': picks['sta'].values,
+                'phase': picks['phase'].values,
+                'centisec': np.round(picks['time'].values*100)})
+            counts = pd.concat([archived.groupby(keys).size()\
+                                .rename('archive'),
+                                expected.groupby(keys).size()\
+                                .rename('source')], axis=1)\
+            .fillna(0).astype('int64').reset_index()
+            counts = counts[counts['archive'] != counts['source']]
+            field = counts['sta'] + ' ' + counts['phase'] + ' ' + \
+            (counts['centisec']/100).map('{:.2f}'.format)
+            missing = (counts['archive'] < counts['source']).values
+            problems.append(_problems('missing pick',
+                            counts['evid'].values[missing],
+                            field.values[missing],
+                            counts['archive'].values[missing],
+                            counts['source'].values[missing]))
+            problems.append(_problems('extra pick',
+                            counts['evid'].values[~missing],
+                            field.values[~missing],
+                            counts['archive'].values[~missing],
+                            counts['source'].values[~missing]))
+    finally:
+        if archive is not arcfile:
+            archive.close()
+
+    problems = pd.concat(problems, ignore_index=True)
+    logger.info('Verified %d events and %d picks of %s: %d problems',
+                len(headers), len(picks), arcfile, len(problems))
+    _count('counters', 'verify problems', len(problems))
+    return problems
+
+def verifyStations(stafile, dbid, dbfoldername, db=None, jdate=None):
+    #Round-trip check of the Hypoinverse station file stafile (a file name
+    #or HypoStations) against the site and sitechan tables it was written
+    #from: every line must match the position (to the written precision)
+    #and elevation of a site epoch of its station and a channel of the
+    #sitechan table, and every channel of a station in the site table
+    #must be written. jdate (YYYYDDD) is that of writeSta2Hypoinverse,
+    #when given only channels operating on that date are expected.
+    #Returns a dataframe of problems like verifyArchive, keyed by sta
+    if db is None:
+        db = openDatabase(dbid, dbfoldername)
+    if isinstance(stafile, HypoStations):
+        stations = stafile
+    else:
+        stations = HypoStations(stafile)
+
+    try:
+        with _stage('verify'):
+            problems = [stations.check()]
+            lines = stations.stations()
+    finally:
+        if stations is not stafile:
+            stations.close()
+
+    with _stage('verify'):
+        site = db.table('site')
+        site = pd.DataFrame({'sta': _writtenCodes(site['sta'].values, 5),
+                             'sitelat': site['lat'].values.astype(float),
+                             'sitelon': site['lon'].values.astype(float),
+                             'siteelev': np.trunc(site['elev'].values\
+                                                  .astype(float)*1000)})
+        sitechan = db.table('sitechan')
+        if jdate is not None:
+            offdate = sitechan['offdate'].values
+            sitechan = sitechan[(sitechan['ondate'].values <= jdate) &
+                                ((offdate >= jdate) | (offdate == -1))]
+        channels = pd.DataFrame({
+            'sta': _writtenCodes(sitechan['sta'].values, 5),
+            'comp3': np.asarray(sitechan['chan'].values, dtype=str)\
+            .astype('U3')}).drop_duplicates()
+
+        #position of each line against the site epochs of its station
+        known = lines['sta'].isin(site['sta']).values
+        problems.append(_problems('unknown station', lines['sta'].values\
+                                  [~known], 'line',
+                                  lines['line'].values[~known] + 1,
+                                  keyname='sta'))
+        pairs = lines[known].merge(site, on='sta', how='left')
+        tolerance = 0.00005/60 + 1e-9
+        pairs['match'] = (np.abs(pairs['lat'] - pairs['sitelat']) <=
+                          tolerance) & (np.abs(pairs['lon'] -
+                          pairs['sitelon']) <= tolerance) & \
+                          (pairs['elev'] == pairs['siteelev'])
+        matched = pairs.groupby('line', sort=False)['match'].any()
+        unmatched = lines.set_index('line').loc[matched.index[~matched.values]]
+        problems.append(_problems('station', unmatched['sta'].values,
+                                  'position',
+                                  ['{:.6f} {:.6f} {:.0f}'.format(*row) for row
+                                   in unmatched[['lat', 'lon', 'elev']]\
+                                   .values], keyname='sta'))
+
+        #channels written against the sitechan table
+        written = lines[['sta', 'comp3']].drop_duplicates()
+        both = written.merge(channels, how='outer', indicator=True)
+        unknown = both[both['_merge'] == 'left_only']
+        problems.append(_problems('unknown channel', unknown['sta'].values,
+                                  unknown['comp3'].values, keyname='sta'))
+        missing = both[(both['_merge'] == 'right_only') &
+                       both['sta'].isin(site['sta'])]
+        problems.append(_problems('missing channel', missing['sta'].values,
+                                  missing['comp3'].values, keyname='sta'))
+
+    problems = pd.concat(problems, ignore_index=True)
+    logger.info('Verified %d station lines of %s: %d problems', len(lines),
+                stafile, len(problems))
+    _count('counters', 'verify problems', len(problems))
+    return problems
+
+def parseEvids(text):
+    #turn an event id list such as "1,5,10-20" into a list of integers; 
+    #ranges include both ends
+    evids = []
+    for part in text.replace(' ', '').split(','):
+        if not part:
+            continue
+        start, dash, end = part.partition('-')
+        if dash:
+            evids.extend(range(int(start), int(end) + 1))
+        else:
+            evids.append(int(part))
+    return evids
+
+def parseOrigin(text):
+    #origin choice of selectOrigins from text: prefor, latest, all or 
+    #column=value pairs such as "auth=oa,algorithm=locsat" (a column given 
+    #more than once accepts any of its values). Columns are those loaded 
+    #from the origin table and values are converted to the column type, so
+    #"orid=2" matches the integer orid
+    if text in ('prefor', 'latest', 'all'):
+        return text
+    types = {name: ftype for name, width, ftype in TABLE_SCHEMA['origin']}
+    convert = {'i': int, 'f': float}
+    origin = {}
+    for part in text.split(','):
+        col, equals, value = part.partition('=')
+        col = col.strip()
+        if not equals or col not in TABLE_USECOLS['origin']:
+            raise ValueError('origin must be prefor, latest, all or '+\
+            'column=value pairs of the columns '+\
+            ','.join(TABLE_USECOLS['origin'])+', not '+text)
+        value = convert.get(types[col], str)(value.strip())
+        origin.setdefault(col, []).append(value)
+    return origin
+
+def parseDatabase(text):
+    #(dbfoldername, dbid) of a database given as the path prefix of its 
+    #tables, e.g. AntDB/AntDB for tables AntDB/AntDB.origin, ...
+    dbfoldername, dbid = os.path.split(text)
+    return dbfoldername or '.', dbid
+
+def _eventFilters(args):
+    #keyword filters of selectEvents from parsed command line arguments
+    filters = {}
+    for name in ['starttime', 'endtime', 'minlat', 'maxlat', 'minlon', 
+                 'maxlon', 'mindepth', 'maxdepth', 'etype', 'auth']:
+        if getattr(args, name) is not None:
+            filters[name] = getattr(args, name)
+    return filters
+
+def _addFilterArguments(parser):
+    #options of the selectEvents filters, see _eventFilters
+    for name, ftype, text in [
+            ('starttime', float, 'earliest origin time (epoch s)'),
+            ('endtime', float, 'latest origin time (epoch s)'),
+            ('minlat', float, None), ('maxlat', float, None), 
+            ('minlon', float, None), ('maxlon', float, None),
+            ('mindepth', float, None), ('maxdepth', float, None)]:
+        parser.add_argument('--' + name, type=ftype, help=text)
+    parser.add_argument('--etype', action='append',
+                        help='origin event type, may be repeated')
+    parser.add_argument('--auth', action='append',
+                        help='origin author, may be repeated')
+
+def buildParser():
+    #command line interface, see main
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Convert an Antelope (CSS3.0) database to Hypoinverse '+\
+        'station and archive files')
+    parser.add_argument('--db-folder', default='GADBPart2_1_EQsAndBlasts',
+                        help='directory holding the database tables '+\
+                        '(default: %(default)s)')
+    parser.add_argument('--db-name', default='GADBPart2',
+                        help='database name, tables are <db-folder>/'+\
+                        '<db-name>.<table> (default: %(default)s)')
+    parser.add_argument('--cache-dir', 
+                        help='keep parsed tables in this directory so '+\
+                        'later runs skip text parsing')
+    parser.add_argument('--save-index', action='store_true',
+                        help='save the join index next to the tables for '+\
+                        'fast single-event lookups')
+    parser.add_argument('--origin', type=parseOrigin, default='prefor',
+                        help='origin of each event whose picks are '+\
+                        'written: prefor (default, falling back to the '+\
+                        'latest), latest, all or column=value pairs such '+\
+                        'as auth=oa,algorithm=locsat or orid=12 (columns: '+\
+                        ','.join(TABLE_USECOLS['origin'])+')')
+    parser.add_argument('--metrics', 
+                        help='write stage timings and counts to this JSON '+\
+                        'file')
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help='log progress (-v) and every rejected field '+\
+                        '(-vv)')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='only log errors')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    
+    stations = subparsers.add_parser('stations', 
+                                     help='write the station file')
+    stations.add_argument('-o', '--output', 
+                          help='station file (default: <db-name>.sta, '+\
+                          '- for standard output)')
+    stations.add_argument('--append', action='store_true',
+                          help='append to the station file instead of '+\
+                          'over-writing it')
+    stations.add_argument('--jdate', type=int,
+                          help='only channels operating on this date '+\
+                          '(YYYYDDD)')
+    
+    events = subparsers.add_parser('events', 
+                                   help='convert events one at a time')
+    events.add_argument('evids', type=parseEvids,
+                        help='event ids, e.g. 1,5,10-20')
+    events.add_argument('-o', '--output',
+                        help='archive file to append every event to '+\
+                        '(default: <evid>.arc per event)')
+    
+    catalog = subparsers.add_parser('catalog', 
+                                    help='convert many events in one pass')
+    catalog.add_argument('-o', '--output',
+                         help='archive file to append to (default: '+\
+                         '<db-folder>.arc, - for standard output)')
+    catalog.add_argument('--evids', type=parseEvids,
+                         help='event ids, e.g. 1,5,10-20 (default: all)')
+    catalog.add_argument('--order', choices=['evid', 'time'], 
+                         default='evid', help='output order of events')
+    catalog.add_argument('-j', '--workers', type=int, default=1,
+                         help='processes formatting events')
+    mode = catalog.add_mutually_exclusive_group()
+    mode.add_argument('--incremental', action='store_true',
+                      help='only convert events added or changed since '+\
+                      'the last incremental run')
+    mode.add_argument('--max-memory', type=float,
+                      help='stream assoc/arrival with about this many MB')
+    _addFilterArguments(catalog)
+    
+    watch = subparsers.add_parser('watch', 
+                                  help='convert events as they are added')
+    watch.add_argument('-o', '--output', default='-',
+                       help='archive file or - for standard output')
+    watch.add_argument('--spool-dir', 
+                       help='write each event to <spool-dir>/<evid>.arc')
+    watch.add_argument('--latency', type=float, default=1.0,
+                       help='seconds between checks for new rows')
+    watch.add_argument('--existing', action='store_true',
+                       help='first write the events already present')
+    
+    batch = subparsers.add_parser('batch', 
+                                  help='convert several databases into '+\
+                                  'one station and one archive file')
+    batch.add_argument('databases', nargs='+', type=parseDatabase,
+                       help='databases as <folder>/<name>, the prefix of '+\
+                       'their table files (--db-folder and --db-name are '+\
+                       'not used)')
+    batch.add_argument('-o', '--output', required=True,
+                       help='archive file to append to, - for standard '+\
+                       'output')
+    batch.add_argument('--stations', 
+                       help='station file to write for all the databases')
+    batch.add_argument('--jdate', type=int,
+                       help='only channels operating on this date '+\
+                       '(YYYYDDD)')
+    batch.add_argument('--order', choices=['time', 'evid'], default='time',
+                       help='output order of events (default: %(default)s)')
+    _addFilterArguments(batch)
+    
+    verify = subparsers.add_parser('verify', 
+                                   help='check archive and station files '+\
+                                   'against the database')
+    verify.add_argument('archive', nargs='?', 
+                        help='archive file to check')
+    verify.add_argument('--stations', 
+                        help='station file to check')
+    verify.add_argument('--evids', type=parseEvids,
+                        help='event ids the archive holds, e.g. 1,5,10-20 '+\
+                        '(default: all)')
+    verify.add_argument('--jdate', type=int,
+                        help='the station file only holds channels '+\
+                        'operating on this date (YYYYDDD)')
+    verify.add_argument('-o', '--output', default='-',
+                        help='CSV file of the problems found (default: '+\
+                        'standard output)')
+    _addFilterArguments(verify)
+    
+    extract = subparsers.add_parser('extract', 
+                                    help='copy events out of an archive file')
+    extract.add_argument('archive', help='archive file to read')
+    extract.add_argument('evids', type=parseEvids,
+                         help='event ids, e.g. 1,5,10-20')
+    extract.add_argument('-o', '--output', default='-',
+                         help='archive file to append the events to '+\
+                         '(default: standard output)')
+    return parser
+
+def runCommand(args, db):
+    #run the subcommand of parsed command line arguments args on AntelopeDB db
+    #returns the exit status of verify and extract (None for the others)
+    if args.command == 'stations':
+        output = args.output or args.db_name + '.sta'
+        writeSta2Hypoinverse(args.db_name, args.db_folder, output, 
+                             append_stations=args.append, db=db, 
+                             jdate=args.jdate)
+    elif args.command == 'events':
+        for evid in args.evids:
+            output = args.output or str(evid) + '.arc'
+            convertEvent(evid, args.db_name, args.db_folder, output, db=db,
+                         origin=args.origin)
+    elif args.command == 'catalog':
+        output = args.output or args.db_folder + '.arc'
+        filters = _eventFilters(args)
+        if args.incremental:
+            convertIncremental(args.db_name, args.db_folder, output, db=db,
+                               origin=args.origin, **filters)
+        elif args.max_memory is not None:
+            convertCatalogStreaming(args.db_name, args.db_folder, output, 
+                                    maxmemory=args.max_memory, 
+                                    evids=args.evids, db=db, 
+                                    origin=args.origin, **filters)
         else:
-            print('station line duplicate not written to station file\n')
-            print('duplicate line '+staline+'\n')
+            convertCatalog(args.db_name, args.db_folder, output, 
+                           evids=args.evids, db=db, workers=args.workers,
+                           order=args.order, origin=args.origin, **filters)
+    elif args.command == 'watch':
+        try:
+            watchDatabase(args.db_name, args.db_folder, args.output, 
+                          spooldir=args.spool_dir, latency=args.latency,
+                          emitexisting=args.existing, db=db, 
+                          origin=args.origin)
+        except KeyboardInterrupt:
+            pass
+    elif args.command == 'batch':
+        convertDatabases(args.databases, args.output, stafile=args.stations,
+                         order=args.order, origin=args.origin, 
+                         jdate=args.jdate, cachedir=args.cache_dir, 
+                         **_eventFilters(args))
+        if args.save_index:
+            for dbfoldername, dbid in args.databases:
+                openDatabase(dbid, dbfoldername).saveIndex()
+    elif args.command == 'verify':
+        problems = []
+        if args.archive is not None:
+            problems.append(verifyArchive(args.archive, args.db_name, 
+                                          args.db_folder, db=db, 
+                                          evids=args.evids, 
+                                          origin=args.origin, 
+                                          **_eventFilters(args)))
+        if args.stations is not None:
+            problems.append(verifyStations(args.stations, args.db_name, 
+                                           args.db_folder, db=db, 
+                                           jdate=args.jdate))
+        problems = pd.concat(problems, ignore_index=True)
+        #archive rows are keyed by evid and station rows by sta; evid stays
+        #an integer (blank on station rows) and the keys come first
+        if 'evid' in problems:
+            problems['evid'] = problems['evid'].astype('Int64')
+        problems = problems[[col for col in ['evid', 'sta'] 
+                             if col in problems] + PROBLEM_COLUMNS]
+        for kind, nproblems in problems['kind'].value_counts().items():
+            logger.warning('%d %s', nproblems, kind)
+        output = sys.stdout if args.output == '-' else args.output
+        problems.to_csv(output, index=False)
+        return 1 if len(problems) else 0
+    elif args.command == 'extract':
+        missing = 0
+        with HypoArchive(args.archive) as archive, \
+        openSink(args.output, 'a') as sink:
+            for evid in args.evids:
+                if evid in archive:
+                    sink.writeEvent(archive.event(evid).splitlines(True))
+                else:
+                    logger.warning('Event %s is not in %s', evid, 
+                                   args.archive)
+                    missing += 1
+        return 1 if missing else 0
+
+def main(argv=None):
+    #command line entry point, e.g.
+    #  python Antelope2HypoInverse.py --db-folder AntDB --db-name AntDB stations
+    #  python Antelope2HypoInverse.py events 69,99,200-210
+    #  python Antelope2HypoInverse.py catalog -o all.arc --workers 4
+    #  python Antelope2HypoInverse.py verify all.arc --stations GADBPart2.sta
+    #  python Antelope2HypoInverse.py batch DB1/DB1 DB2/DB2 -o all.arc --stations all.sta
+    parser = buildParser()
+    args = parser.parse_args(argv)
+    if getattr(args, 'incremental', False) and args.evids is not None:
+        parser.error('--incremental converts every event, drop --evids')
+    if args.command == 'verify' and args.archive is None and \
+    args.stations is None:
+        parser.error('verify needs an archive file, --stations or both')
+    #log messages go to standard error so archive output can be piped
+    if args.quiet:
+        level = logging.ERROR
+    else:
+        level = [logging.WARNING, logging.INFO, logging.DEBUG]\
+        [min(args.verbose, 2)]
+    logging.basicConfig(stream=sys.stderr, level=level, 
+                        format='%(levelname)s: %(message)s')
     
-        openvar='a' #add remaining station entries to file
-    return stadb
-#######################MODIFY BELOW HERE#######################
-    
-#Database name - put tables in folder in working directory that matches dbname
-#Or change paths to files in function getData
-dbfoldername = 'GADBPart2_1_EQsAndBlasts'
-dbname = 'GADBPart2'
-
-#PART 1 for writing station master file
-stadb = writeSta2Hypoinverse(dbname,dbfoldername,dbname+'.sta',append_stations=False)
-
-#PART 2a for fetching 1 event's data from tables and writing output to file
-#Database event id - integer corresponding to event to prep for hypoinverse 
-#eventid = 99
-#Arc file name for writing hypoinverse-compatible output
-#arcfname = str(eventid) + '.arc'
-#Get data for this event id
-#ev1dbm = getData(eventid,dbname)
-#Write data in hypoinverse format in file ffname
-#write2Hypoinverse(ev1dbm,arcfname)
-
-#PART 2b for multiple event's data from tables and writing output to file
-#evidlist = [69,99,2504,202,246,296,366,415,2507,435,577,653,1074,1104,1241,1282,1331,
-#            1383,1474,1510,1593,1594,1682,1798,1901,1905,1952,2028,2151,2241,
-#            2263,2308,2336,2360,2362,2406,2419,2420,2421,2436,
-#            2437,2445,2457,2517,2468,2470,2473,2476,2478]
-
-#Work-around for getting through every event in a database
-maxevid = 5000 #maximum event id value in database
-evidlist = list(range(maxevid))
-
-arcfname = 'GADBPart2_1_EQsAndBlasts.arc'
-for seisevent in evidlist:
-    evdbm = getData(seisevent,dbname,dbfoldername)
-    write2Hypoinverse(evdbm,arcfname)
\ No newline at end of file
+    db = openDatabase(args.db_name, args.db_folder, cachedir=args.cache_dir)
+    if args.metrics:
+        with collectMetrics() as metrics:
+            status = runCommand(args, db)
+        metrics.toJson(args.metrics)
+    else:
+        status = runCommand(args, db)
+    
+    if args.save_index and args.command != 'batch':
+        db.saveIndex()
+    return status or 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of Antelope2HypoInverse on synthetic CSS3.0 databases
+
+Generates an Antelope database with a chosen number of events, picks per
+event, stations and sitechan epochs per channel, then times the converter end
+to end (writeSta2Hypoinverse, getData + write2Hypoinverse and convertEvent per
+event and convertCatalog) and by stage (parse, join, format, write).
+Throughput (events/s, picks/s) and peak resident memory are written as JSON
+so runs of different versions can be compared, e.g.
+
+python benchmark.py --events 2000 --picks 30 --output bench.json
+python benchmark.py --db-folder mydb --db-name mydb   (existing database)
+"""
+import argparse
+import contextlib
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import Antelope2HypoInverse as a2h
+
+PHASES = ['P', 'S', 'Pn', 'Sn', 'Pg']
+CHANNELS = ['HHZ', 'HHN', 'HHE']
+INSTRUMENTS = ['Guralp_CMG-40T', 'Nanometrics_Trillium', 'STS-2_broadband',
+               'L4C_1Hz', 'Wood-Anderson']
+
+def jdate(epoch):
+    #Antelope julian date (YYYYDDD) of epoch time
+    return int(time.strftime('%Y%j', time.gmtime(epoch)))
+
+def generateDatabase(dbfoldername, dbid, nevents=1000, npicks=20,
+                     nstations=50, nepochs=2, norigins=1, seed=1):
+    #write a synthetic CSS3.0 database dbfoldername/dbid.<table> with
+    #nevents events of norigins origins each, npicks picks per event spread
+    #over nstations stations of 3 channels, each channel having nepochs
+    #sitechan/sensor epochs (the last one open). Returns the number of
+    #arrivals written
+    rand = random.Random(seed)
+    os.makedirs(dbfoldername, exist_ok=True)
+    def path(table):
+        return os.path.join(dbfoldername, dbid + '.' + table)
+
+    stations = ['S%04d' % i for i in range(nstations)]
+    with open(path('instrument'), 'w') as instfile:
+        for inid, name in enumerate(INSTRUMENTS, 1):
+            instfile.write('%8d %-50s %-6s %-1s %-1s %11.7f %16.6f %16.6f '
+                           '%-64s %-32s %-6s %17.5f\n' % (inid, name, 'b',
+                           'b', 'd', 100.0, rand.choice([1.0, 0.5, 2.345]),
+                           1.0, '-', '-', 'paz', 1.5e9))
+    with open(path('snetsta'), 'w') as netfile, \
+         open(path('site'), 'w') as sitefile:
+        for i, sta in enumerate(stations):
+            netfile.write('%-8s %-6s %-6s %17.5f\n' % (['GA','AU','S1'][i%3],
+                                                      sta, sta, 1.5e9))
+            sitefile.write('%-6s %8d %8d %9.4f %9.4f %9.4f %-50s %-4s %-6s '
+                           '%9.4f %9.4f %17.5f\n' % (sta, 2000001, -1,
+                           rand.uniform(-40, 40), rand.uniform(-180, 180),
+                           rand.uniform(-0.5, 2), '-', 'ss', '-', 0, 0,
+                           1.5e9))
+
+    #channel epochs split 2000-2030 evenly, the last epoch left open
+    years = [2000 + (30*k)//nepochs for k in range(nepochs + 1)]
+    with open(path('sitechan'), 'w') as chanfile, \
+         open(path('sensor'), 'w') as sensorfile:
+        chanid = 1
+        for sta in stations:
+            for chan in CHANNELS:
+                for k in range(nepochs):
+                    ondate = years[k]*1000 + 1 + (k > 0)
+                    offdate = -1 if k == nepochs - 1 else years[k+1]*1000+1
+                    chanfile.write('%-6s %-8s %8d %8d %8d %-4s %9.4f %6.1f '
+                                   '%6.1f %-50s %17.5f\n' % (sta, chan,
+                                   ondate, chanid, offdate, 'n', 0, 0, 0,
+                                   '-', 1.5e9))
+                    ontime = time.mktime(time.strptime(str(ondate), '%Y%j'))
+                    sensorfile.write('%-6s %-8s %17.5f %17.5f %8d %8d %8d '
+                                     '%16.6f %16.6f %6.2f %-1s %17.5f\n' % (
+                                     sta, chan, ontime - time.timezone,
+                                     9999999999.999,
+                                     rand.randint(1, len(INSTRUMENTS)),
+                                     chanid, ondate, 1, 1, 0, 'o', 1.5e9))
+                    chanid += 1
+
+    arid = 1
+    orid = 1
+    assocrows = []
+    with open(path('event'), 'w') as eventfile, \
+         open(path('origin'), 'w') as originfile, \
+         open(path('arrival'), 'w') as arrivalfile:
+        for evid in range(1, nevents + 1):
+            ortime = 1.3e9 + evid*3600 + rand.random()*1000
+            orids = []
+            for k in range(norigins):
+                originfile.write('%9.4f %9.4f %9.4f %17.5f %8d %8d %8d %4d '
+                                 '%4d %4d %8d %8d %-7s %-4s %9.4f %-1s %7.2f '
+                                 '%8d %7.2f %8d %7.2f %8d %-15s %-15s %8d '
+                                 '%17.5f\n' % (rand.uniform(-40, 40),
+                                 rand.uniform(-180, 180),
+                                 rand.uniform(0, 30), ortime + k*0.3, orid,
+                                 evid, jdate(ortime), npicks, npicks, -1, 1,
+                                 1, rand.choice(['eq','qb','ex']), '-', -999,
+                                 '-', -999, -1, -999, -1,
+                                 rand.choice([1.2, -999]), -1, 'locsat',
+                                 'oa', -1, 1.5e9 + evid + k))
+                orids.append(orid)
+                orid += 1
+            eventfile.write('%8d %-15s %8d %-15s %8d %17.5f\n' % (evid, '-',
+                            orids[-1], 'oa', -1, 1.5e9 + evid))
+            for k in range(npicks):
+                sta = rand.choice(stations)
+                phase = rand.choice(PHASES)
+                artime = ortime + rand.uniform(1, 100)
+                arrivalfile.write('%-6s %17.5f %8d %8d %8d %8d %-8s %-8s '
+                                  '%-1s %6.3f %7.2f %7.2f %7.2f %7.2f %7.2f '
+                                  '%7.3f %10.1f %7.2f %7.2f %-1s %-2s %10.2f'
+                                  ' %-1s %-15s %8d %17.5f\n' % (sta, artime,
+                                  arid, jdate(artime), -1, -1,
+                                  rand.choice(CHANNELS), phase, '-', 0.1, -1,
+                                  -1, -1, -1, -1, -1, -1, -1, -999, '-',
+                                  rand.choice(['c.','d.','-']), -1, '-',
+                                  'dbp:bench', -1, 1.5e9))
+                for assocorid in orids:
+                    assocrows.append((arid, assocorid, sta, phase,
+                                      rand.uniform(0, 10)))
+                arid += 1
+    with open(path('assoc'), 'w') as assocfile:
+        for row in assocrows:
+            assocfile.write('%8d %8d %-6s %-8s %4.2f %8.3f %7.2f %7.2f %8.3f '
+                            '%-1s %7.1f %-1s %7.2f %-1s %7.1f %6.3f %-15s %8d'
+                            ' %17.5f\n' % (row[0], row[1], row[2], row[3], 1,
+                            row[4], 0, 0, 0.1, 'd', -999, 'n', -999, 'n',
+                            -999, 1, 'iasp91', -1, 1.5e9))
+    return arid - 1
+
+def peakRss():
+    #peak resident memory of this process in MB (ru_maxrss is in kB on
+    #Linux and bytes on macOS)
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return maxrss/1024.0/1024.0
+    return maxrss/1024.0
+
+def countPicks(lines):
+    #number of pick lines in Hypoinverse archive lines
+    return sum(1 for line in lines if len(line) == 121)
+
+class Timer(object):
+    #collects wall times of named runs; use as timer.run(name) context
+
+    def __init__(self):
+        self.results = {}
+
+    @contextlib.contextmanager
+    def run(self, name):
+        started = time.perf_counter()
+        yield
+        self.results[name] = time.perf_counter() - started
+
+def runBenchmark(dbfoldername, dbid, workdir, nsingle=100, repeat=1):
+    #time the converter on database dbid in dbfoldername, writing output
+    #files in workdir; nsingle events go through getData and
+    #write2Hypoinverse one at a time, then through convertEvent. Returns the
+    #results dict
+    timer = Timer()
+    results = {}
+    def output(name):
+        path = os.path.join(workdir, name)
+        if os.path.exists(path):
+            os.remove(path)
+        return path
+
+    for attempt in range(repeat):
+        #stages of the catalog path, each from a cold database handle
+        db = a2h.AntelopeDB(dbid, dbfoldername)
+        with timer.run('parse'):
+            for table in ['event','origin','assoc','arrival','snetsta',
+                          'sitechan']:
+                db.table(table)
+        with timer.run('join'):
+            catalog = a2h.joinTables(db.table('event'), db)
+            reftypes = a2h._joinTypes(catalog, db)
+            groups = catalog.groupby('evid', sort=True).indices
+        with timer.run('format'):
+            blocks = [lines for lines in a2h._eventBlocks(catalog, groups,
+                      sorted(groups), reftypes) if len(lines) > 0]
+        with timer.run('write'):
+            with a2h.OutputSink(output('stages.arc'), 'w') as sink:
+                for lines in blocks:
+                    sink.writeEvent(lines)
+        nevents = len(blocks)
+        npicks = sum(countPicks(lines) for lines in blocks)
+        del catalog, blocks
+
+        #end to end runs
+        db = a2h.AntelopeDB(dbid, dbfoldername)
+        with timer.run('stations'):
+            a2h.writeSta2Hypoinverse(dbid, dbfoldername, output('bench.sta'),
+                                     db=db)
+        db = a2h.AntelopeDB(dbid, dbfoldername)
+        with timer.run('catalog'), a2h.collectMetrics() as metrics:
+            a2h.convertCatalog(dbid, dbfoldername, output('catalog.arc'),
+                               db=db)
+        db = a2h.AntelopeDB(dbid, dbfoldername)
+        evids = sorted(db.table('event').evid)[:nsingle]
+        singlefile = output('single.arc')
+        with timer.run('single'):
+            for evid in evids:
+                a2h.write2Hypoinverse(a2h.getData(evid, dbid, dbfoldername,
+                                                  db=db), singlefile)
+        with open(singlefile) as arcfile:
+            singlepicks = countPicks(arcfile)
+        #the same events through the pandas-free path, with the index saved
+        #alongside the database
+        db.saveIndex()
+        leanfile = output('lean.arc')
+        with timer.run('lean'):
+            for evid in evids:
+                a2h.convertEvent(evid, dbid, dbfoldername, leanfile)
+
+        for name, seconds in timer.results.items():
+            best = results.get(name)
+            if best is None or seconds < best:
+                results[name] = seconds
+
+    with open(os.path.join(workdir, 'bench.sta')) as stafile:
+        nstations = sum(1 for line in stafile)
+    def rates(seconds, nevents, npicks):
+        return {'seconds': round(seconds, 6),
+                'events_per_s': round(nevents/seconds, 2) if seconds else None,
+                'picks_per_s': round(npicks/seconds, 2) if seconds else None}
+    stages = {name: {'seconds': round(results[name], 6)}
+              for name in ['parse', 'join', 'format', 'write']}
+    for name in stages:
+        stages[name].update(rates(results[name], nevents, npicks))
+    return {
+        'events': nevents,
+        'picks': npicks,
+        'stages': stages,
+        'catalog': rates(results['catalog'], nevents, npicks),
+        'single_event': dict(rates(results['single'], len(evids),
+                                   singlepicks), events=len(evids)),
+        'single_event_lean': dict(rates(results['lean'], len(evids),
+                                        singlepicks), events=len(evids)),
+        'stations': {'seconds': round(results['stations'], 6),
+                     'lines': nstations,
+                     'lines_per_s': round(nstations/results['stations'], 2)},
+        'peak_rss_mb': round(peakRss(), 1),
+        'catalog_metrics': metrics.report(),
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark '+\
+                                     'Antelope2HypoInverse on a synthetic '+\
+                                     'or existing Antelope database')
+    parser.add_argument('--events', type=int, default=1000)
+    parser.add_argument('--picks', type=int, default=20,
+                        help='picks per event')
+    parser.add_argument('--stations', type=int, default=50)
+    parser.add_argument('--epochs', type=int, default=2,
+                        help='sitechan epochs per channel')
+    parser.add_argument('--origins', type=int, default=1,
+                        help='origins per event')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--single', type=int, default=100,
+                        help='events timed through getData one at a time')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='runs per measurement, the fastest is kept')
+    parser.add_argument('--db-folder',
+                        help='benchmark this existing database instead')
+    parser.add_argument('--db-name')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the generated database and outputs')
+    parser.add_argument('-o', '--output', default='benchmark.json',
+                        help='results file (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='a2hbench')
+    try:
+        params = {}
+        if args.db_folder:
+            dbfoldername = args.db_folder
+            dbid = args.db_name or os.path.basename(args.db_folder.rstrip('/'))
+        else:
+            dbfoldername = os.path.join(workdir, 'db')
+            dbid = 'BENCH'
+            params = {'events': args.events, 'picks_per_event': args.picks,
+                      'stations': args.stations, 'epochs': args.epochs,
+                      'origins_per_event': args.origins, 'seed': args.seed}
+            started = time.perf_counter()
+            generateDatabase(dbfoldername, dbid, args.events, args.picks,
+                             args.stations, args.epochs, args.origins,
+                             args.seed)
+            params['generate_seconds'] = round(time.perf_counter() -
+                                               started, 3)
+        #per-event warnings would be timed too, keep only errors
+        a2h.logger.setLevel(logging.ERROR)
+        results = runBenchmark(dbfoldername, dbid, workdir, args.single,
+                               args.repeat)
+    finally:
+        if args.keep:
+            print('Kept benchmark files in ' + workdir)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'database': params or {'folder': dbfoldername, 'name': dbid},
+        'environment': {'python': platform.python_version(),
+                        'pandas': a2h.pd.__version__,
+                        'numpy': a2h.np.__version__,
+                        'platform': platform.platform()},
+        'results': results,
+    }
+    with open(args.output, 'w') as outfile:
+        json.dump(report, outfile, indent=2)
+    print(json.dumps(results, indent=2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+"""
+Regression tests of Antelope2HypoInverse: every conversion path must write
+the same archive for a synthetic database (see benchmark.generateDatabase)
+
+Run with python -m pytest
+"""
+import bz2
+import gc
+import gzip
+import io
+import json
+import logging
+import lzma
+import os
+import shutil
+
+import pytest
+
+import Antelope2HypoInverse as a2h
+import benchmark
+
+DBID = 'TDB'
+EVIDS = list(range(1, 41))
+
+@pytest.fixture(scope='module')
+def dbfolder(tmp_path_factory):
+    #40 events of 2 origins and 12 picks each; the last event row has no
+    #origin
+    folder = str(tmp_path_factory.mktemp('db'))
+    benchmark.generateDatabase(folder, DBID, nevents=len(EVIDS), npicks=12,
+                               nstations=10, norigins=2)
+    with open(os.path.join(folder, DBID + '.event'), 'a') as evfile:
+        evfile.write('%8d %-15s %8d %-15s %8d %17.5f\n' %
+                     (999, '-', 99999, '-', -1, 1.5e9))
+    logging.getLogger('Antelope2HypoInverse').setLevel(logging.ERROR)
+    return folder
+
+def catalog(folder, **kwargs):
+    #archive text written by convertCatalog
+    out = io.StringIO()
+    a2h.convertCatalog(DBID, folder, out, **kwargs)
+    return out.getvalue()
+
+def compressedCopy(folder, target):
+    #copy of the database in folder with its joined tables compressed
+    shutil.copytree(folder, target)
+    compressors = [('assoc', '.gz', gzip.open), ('origin', '.bz2', bz2.open),
+                   ('sitechan', '.xz', lzma.open)]
+    for table, suffix, opener in compressors:
+        path = os.path.join(target, DBID + '.' + table)
+        with open(path, 'rb') as plain, opener(path + suffix, 'wb') as packed:
+            packed.write(plain.read())
+        os.remove(path)
+    return target
+
+@pytest.mark.parametrize('origin', ['prefor', 'latest', 'all'])
+def test_catalogPathsAgree(dbfolder, origin):
+    expected = catalog(dbfolder, evids=EVIDS + [999], origin=origin)
+    assert expected.count('\n') > len(EVIDS)*10
+
+    single = io.StringIO()
+    for evid in EVIDS + [999]:
+        a2h.write2Hypoinverse(a2h.getData(evid, DBID, dbfolder,
+                                          origin=origin), single)
+    assert single.getvalue() == expected
+
+    assert catalog(dbfolder, evids=EVIDS, origin=origin, workers=2) == \
+    expected
+
+    streamed = io.StringIO()
+    a2h.convertCatalogStreaming(DBID, dbfolder, streamed, maxmemory=0.05,
+                                evids=EVIDS + [999], origin=origin)
+    assert streamed.getvalue() == expected
+
+def test_noOriginSkipped(dbfolder):
+    with a2h.collectMetrics() as metrics:
+        assert a2h.eventLines(999, DBID, dbfolder) == []
+        text = catalog(dbfolder)
+    assert metrics.report()['skipped']['event: no origin'] == 2
+    assert text == catalog(dbfolder, evids=EVIDS)
+
+@pytest.mark.parametrize('origin', ['prefor', 'all', {'auth': 'oa'}])
+def test_convertEvent(dbfolder, tmp_path, origin):
+    #the pandas-free single event path, by table scan then through a saved
+    #index
+    expected = catalog(dbfolder, evids=EVIDS, origin=origin)
+    folder = str(tmp_path / 'db')
+    shutil.copytree(dbfolder, folder)
+    for save in [False, True]:
+        if save:
+            a2h.AntelopeDB(DBID, folder).saveIndex()
+        out = io.StringIO()
+        for evid in EVIDS:
+            a2h.convertEvent(evid, DBID, folder, out, origin=origin)
+        assert out.getvalue() == expected
+
+def test_compressedTables(dbfolder, tmp_path):
+    folder = compressedCopy(dbfolder, str(tmp_path / 'db'))
+    expected = catalog(dbfolder, evids=EVIDS)
+    assert catalog(folder, evids=EVIDS) == expected
+
+    streamed = io.StringIO()
+    a2h.convertCatalogStreaming(DBID, folder, streamed, maxmemory=0.05,
+                                evids=EVIDS)
+    assert streamed.getvalue() == expected
+
+    out = io.StringIO()
+    for evid in EVIDS:
+        a2h.convertEvent(evid, DBID, folder, out)
+    assert out.getvalue() == expected
+
+def test_verifyArchive(dbfolder, tmp_path):
+    arcfile = str(tmp_path / 'out.arc')
+    with open(arcfile, 'w') as out:
+        out.write(catalog(dbfolder))
+    assert len(a2h.verifyArchive(arcfile, DBID, dbfolder)) == 0
+
+def test_incremental(dbfolder, tmp_path):
+    #an archive written by the catalog command is taken over without
+    #duplicating its events, later runs only touch what changed
+    arcfile = str(tmp_path / 'out.arc')
+    expected = catalog(dbfolder)
+    with open(arcfile, 'w') as out:
+        out.write(expected)
+    counts = a2h.convertIncremental(DBID, dbfolder, arcfile)
+    assert counts['changed'] == len(EVIDS)
+    with open(arcfile) as arc:
+        assert arc.read() == expected
+    assert os.path.exists(arcfile + '.state.json')
+
+    counts = a2h.convertIncremental(DBID, dbfolder, arcfile)
+    assert counts['new'] == counts['changed'] == counts['deleted'] == 0
+    maxlat = a2h.openDatabase(DBID, dbfolder).table('origin').lat.median()
+    counts = a2h.convertIncremental(DBID, dbfolder, arcfile, maxlat=maxlat)
+    deleted = counts['deleted']
+    assert deleted > 0
+    counts = a2h.convertIncremental(DBID, dbfolder, arcfile)
+    assert counts['new'] == deleted and counts['deleted'] == 0
+    with open(arcfile) as arc:
+        assert sorted(a2h._splitArchive(arc.read())) == \
+        sorted(a2h._splitArchive(expected))
+
+def truncatedCopy(dbfolder, target, nevents):
+    #copy of the database in folder with only the rows of the first 
+    #nevents events in its event and origin tables; returns the rows left
+    #out of each
+    shutil.copytree(dbfolder, target)
+    rest = {}
+    for table, evidcol in [('event', slice(0, 8)), ('origin', slice(57, 65))]:
+        path = os.path.join(target, DBID + '.' + table)
+        with open(path, 'rb') as tablefile:
+            lines = tablefile.readlines()
+        keep = [line for line in lines if int(line[evidcol]) <= nevents]
+        with open(path, 'wb') as tablefile:
+            tablefile.writelines(keep)
+        rest[table] = [line for line in lines if line not in keep]
+    return rest
+
+def test_refresh(dbfolder, tmp_path):
+    #rows appended are reported once by refresh, even when table() has 
+    #loaded them first
+    folder = str(tmp_path / 'db')
+    rest = truncatedCopy(dbfolder, folder, 10)['event']
+    path = os.path.join(folder, DBID + '.event')
+    db = a2h.AntelopeDB(DBID, folder)
+    assert len(db.refresh('event')) == 0
+    with open(path, 'ab') as tablefile:
+        tablefile.writelines(rest[:5])
+    assert len(db.table('event')) == 15
+    with open(path, 'ab') as tablefile:
+        tablefile.writelines(rest[5:8])
+    assert list(db.refresh('event').evid) == list(range(11, 19))
+    assert list(db.table('event').evid) == list(range(1, 19))
+    assert len(db.refresh('event')) == 0
+    with open(path, 'ab') as tablefile:
+        tablefile.write(rest[8][:20])
+    assert len(db.refresh('event')) == 0
+    with open(path, 'ab') as tablefile:
+        tablefile.write(rest[8][20:])
+    assert list(db.refresh('event').evid) == [19]
+
+def test_watch(dbfolder, tmp_path, monkeypatch):
+    #events whose rows are appended between two polls are written
+    folder = str(tmp_path / 'db')
+    rest = truncatedCopy(dbfolder, folder, 10)
+
+    def append(seconds):
+        for table in rest:
+            with open(os.path.join(folder, DBID + '.' + table), 'ab') as tbl:
+                tbl.writelines(rest[table])
+    monkeypatch.setattr(a2h.time, 'sleep', append)
+    out = io.StringIO()
+    assert a2h.watchDatabase(DBID, folder, out, maxpolls=2) == len(EVIDS) - 10
+    assert out.getvalue() == catalog(dbfolder, evids=EVIDS[10:])
+
+def test_whitespaceTables(dbfolder, tmp_path):
+    #tables whose fields are separated by any white space are split on it
+    folder = str(tmp_path / 'db')
+    shutil.copytree(dbfolder, folder)
+    for table in ['event', 'origin', 'assoc', 'arrival', 'snetsta',
+                  'sitechan']:
+        path = os.path.join(folder, DBID + '.' + table)
+        with open(path, 'rb') as tablefile:
+            lines = [b' '.join(line.split()) + b'\n' for line in tablefile]
+        with open(path, 'wb') as tablefile:
+            tablefile.writelines(lines)
+        assert a2h.parseRecords(b''.join(lines), table) is None
+    expected = catalog(dbfolder)
+    assert catalog(folder) == expected
+
+    out = io.StringIO()
+    for evid in EVIDS:
+        a2h.convertEvent(evid, DBID, folder, out)
+    assert out.getvalue() == expected
+
+def test_streamingOpenFiles(dbfolder):
+    #the partition files of streaming are not held open: one event group
+    #per event must fit in a few more descriptors than are open already
+    resource = pytest.importorskip('resource')
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if not os.path.isdir('/proc/self/fd'):
+        pytest.skip('cannot count open files')
+    nopen = len(os.listdir('/proc/self/fd'))
+    expected = catalog(dbfolder, evids=EVIDS)
+    streamed = io.StringIO()
+    resource.setrlimit(resource.RLIMIT_NOFILE, (nopen + len(EVIDS), hard))
+    try:
+        a2h.convertCatalogStreaming(DBID, dbfolder, streamed, maxmemory=1e-4,
+                                    evids=EVIDS)
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+    assert streamed.getvalue() == expected
+
+def test_damagedIndex(dbfolder, tmp_path):
+    #a saved index that cannot be read is rebuilt (getData) or the tables
+    #scanned (convertEvent)
+    np = pytest.importorskip('numpy')
+    folder = str(tmp_path / 'db')
+    shutil.copytree(dbfolder, folder)
+    db = a2h.AntelopeDB(DBID, folder)
+    db.saveIndex()
+    indexpath = db.indexPath()
+    with open(indexpath, 'rb') as indexfile:
+        saved = indexfile.read()
+    #an index of object arrays, as pickled by pandas 3 string columns
+    pickled = io.BytesIO()
+    arrays = {table + suffix: np.array(['x'], dtype=object)
+              for table in a2h.JoinIndex.KEYS for suffix in ['.keys', '.rows']}
+    np.savez(pickled, stamps=np.array(json.dumps(
+        db.tableStamps(a2h.JoinIndex.KEYS))), **arrays)
+
+    blocks = [block for evid, block in
+              a2h._splitArchive(catalog(dbfolder, evids=EVIDS[:3]))]
+    for damaged in [saved[:len(saved)//2], b'', pickled.getvalue()]:
+        with open(indexpath, 'wb') as indexfile:
+            indexfile.write(damaged)
+        out = io.StringIO()
+        for evid in EVIDS[:3]:
+            a2h.write2Hypoinverse(a2h.getData(evid, DBID, folder), out)
+            a2h.convertEvent(evid, DBID, folder, out)
+        assert out.getvalue() == ''.join(block*2 for block in blocks)
+
+def test_stationFile(dbfolder, tmp_path):
+    #one line per channel epoch (identical lines once), read back to the 
+    #positions of the site table on both sides of the equator
+    stafile = str(tmp_path / 'out.sta')
+    stadb = a2h.writeSta2Hypoinverse(DBID, dbfolder, stafile)
+    with open(stafile) as sta:
+        lines = sta.readlines()
+    assert len(stadb) == 60
+    assert lines == list(dict.fromkeys(a2h.formatStationLines(stadb)[0]))
+    assert all(len(line) == 87 for line in lines)
+    assert len(a2h.verifyStations(stafile, DBID, dbfolder)) == 0
+    south = set(stadb.sta[stadb.lat < 0])
+    assert 0 < len(south) < len(set(stadb.sta))
+    assert {line[:5].strip() for line in lines if line[25] == 'S'} == south
+
+def setOffdate(folder, sta, chan, ondate, offdate):
+    #end the sitechan epoch of sta, chan starting on ondate at offdate
+    path = os.path.join(folder, DBID + '.sitechan')
+    with open(path) as tablefile:
+        lines = tablefile.readlines()
+    for i, line in enumerate(lines):
+        if line[:6].strip() == sta and line[7:15].strip() == chan and \
+        int(line[16:24]) == ondate:
+            lines[i] = line[:34] + '%8d' % offdate + line[42:]
+    with open(path, 'w') as tablefile:
+        tablefile.writelines(lines)
+
+def test_epochs(dbfolder, tmp_path):
+    #channels resolve to the epoch active on the event or station date; 
+    #open epochs (offdate -1) do not end
+    folder = str(tmp_path / 'db')
+    shutil.copytree(dbfolder, folder)
+    setOffdate(folder, 'S0000', 'HHZ', 2000001, 2005001)
+    setOffdate(folder, 'S0001', 'HHZ', 2015002, 2015200)
+
+    stafile = str(tmp_path / 'out.sta')
+    for jdate, missing in [(2016001, ['S0001']), (2015100, []),
+                           (2010001, ['S0000'])]:
+        stadb = a2h.writeSta2Hypoinverse(DBID, folder, stafile, jdate=jdate)
+        assert len(stadb) == 30 - len(missing)
+        with open(stafile) as sta:
+            lines = sta.readlines()
+        assert sorted(line[:5] for line in lines if line[10:13] == 'HHZ') == \
+        sorted(set('S%04d' % i for i in range(10)) - set(missing))
+        assert len(lines) == 30 - len(missing)
+        assert len(a2h.verifyStations(stafile, DBID, folder,
+                                      jdate=jdate)) == 0
+
+    #picks of S0000 HHZ are not written, their channel epoch ended first
+    def picks(text, sta, chan):
+        return sum(1 for line in text.splitlines()
+                   if line[:5] == sta and line[9:12] == chan)
+    expected = catalog(dbfolder, evids=EVIDS)
+    assert picks(expected, 'S0000', 'HHZ') > 0
+    with a2h.collectMetrics() as metrics:
+        text = catalog(folder, evids=EVIDS)
+    assert picks(text, 'S0000', 'HHZ') == 0
+    assert picks(text, 'S0000', 'HHN') == picks(expected, 'S0000', 'HHN')
+    assert metrics.report()['skipped']['pick: channel not operational'] == \
+    picks(expected, 'S0000', 'HHZ')
+
+    out = io.StringIO()
+    for evid in EVIDS:
+        a2h.convertEvent(evid, DBID, folder, out)
+    assert out.getvalue() == text
+
+def test_sidecarCache(dbfolder, tmp_path, monkeypatch):
+    #sidecar files are used while their table file is unchanged, and kept
+    #apart for databases of the same name in different folders
+    cachedir = str(tmp_path / 'cache')
+    folders = [str(tmp_path / name) for name in ['a', 'b']]
+    shutil.copytree(dbfolder, folders[0])
+    truncatedCopy(dbfolder, folders[1], 10)
+    for folder, nrows in zip(folders, [len(EVIDS) + 1, 10]):
+        assert len(a2h.AntelopeDB(DBID, folder, cachedir).table('event')) \
+        == nrows
+    assert len(os.listdir(cachedir)) == 4
+    gc.collect()
+
+    def noParse(*args):
+        raise AssertionError('table parsed instead of read from its sidecar')
+    monkeypatch.setattr(a2h, 'readTable', noParse)
+    for folder, nrows in zip(folders, [len(EVIDS) + 1, 10]):
+        assert len(a2h.AntelopeDB(DBID, folder, cachedir).table('event')) \
+        == nrows
+    monkeypatch.undo()
+    gc.collect()
+
+    #a changed table file, or an unreadable sidecar description, is parsed
+    #again
+    with open(os.path.join(folders[1], DBID + '.event'), 'a') as evfile:
+        evfile.write('%8d %-15s %8d %-15s %8d %17.5f\n' %
+                     (998, '-', 99998, '-', -1, 1.5e9))
+    assert len(a2h.AntelopeDB(DBID, folders[1], cachedir).table('event')) \
+    == 11
+    for name in os.listdir(cachedir):
+        if name.endswith('.json'):
+            with open(os.path.join(cachedir, name), 'w') as meta:
+                meta.write('{')
+    gc.collect()
+    db = a2h.AntelopeDB(DBID, folders[0], cachedir)
+    assert catalog(folders[0], db=db) == catalog(dbfolder)